@@ -0,0 +1,123 @@
+import os
+import sys
+import glob
+import hashlib
+import argparse
+import functools
+import subprocess
+
+import torch
+from torch.utils.cpp_extension import load, CUDA_HOME
+
+# the CUDA extensions (hashencoder, shencoder, raymarching, ffmlp) are JIT-compiled on first use, not at import,
+# and the build artifacts are cached under a directory keyed on the sources, the flags and the toolkit version,
+# so a worker only pays for the extensions it actually calls, and a warm cache is never rebuilt.
+# prebuild everything ahead of time with: python extensions.py
+
+PACKAGES = ['hashencoder', 'shencoder', 'raymarching', 'ffmlp']
+
+EXTENSIONS = {}
+
+
+def cache_root():
+    return os.environ.get('INSTANT_NSR_EXTENSIONS_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'instant_nsr', 'extensions'))
+
+
+@functools.lru_cache(maxsize=None)
+def toolkit_version():
+    # nvcc release line if available, else the CUDA version torch was built with.
+    if CUDA_HOME is not None:
+        try:
+            out = subprocess.check_output([os.path.join(CUDA_HOME, 'bin', 'nvcc'), '--version'], stderr=subprocess.STDOUT).decode()
+            return out.strip().splitlines()[-1]
+        except (OSError, subprocess.CalledProcessError):
+            pass
+    return f'cuda {torch.version.cuda}'
+
+
+class CUDAExtension:
+    def __init__(self, name, src_path, sources, extra_cflags=None, extra_cuda_cflags=None, extra_include_paths=None):
+        self.name = name
+        self.src_path = src_path
+        self.sources = [os.path.join(src_path, 'src', f) for f in sources]
+        self.extra_cflags = extra_cflags or []
+        self.extra_cuda_cflags = extra_cuda_cflags or []
+        self.extra_include_paths = extra_include_paths or []
+
+        self._module = None
+        self._error = None
+
+        EXTENSIONS[name] = self
+
+    def build_key(self):
+        # hash of every source and header the build depends on, the flags and the toolchain.
+        h = hashlib.sha256()
+        files = list(self.sources)
+        for path in [os.path.join(self.src_path, 'src')] + self.extra_include_paths:
+            files += glob.glob(os.path.join(path, '**', '*.h'), recursive=True)
+            files += glob.glob(os.path.join(path, '**', '*.cuh'), recursive=True)
+        for f in sorted(set(files)):
+            h.update(os.path.relpath(f, self.src_path).encode())
+            with open(f, 'rb') as fp:
+                h.update(fp.read())
+        h.update(repr((self.extra_cflags, self.extra_cuda_cflags, os.environ.get('TORCH_CUDA_ARCH_LIST', ''))).encode())
+        h.update(toolkit_version().encode())
+        return f'torch{torch.__version__}-cu{torch.version.cuda}-py{sys.version_info.major}{sys.version_info.minor}-{h.hexdigest()[:16]}'
+
+    def build_directory(self):
+        return os.path.join(cache_root(), self.name, self.build_key())
+
+    def load(self, verbose=False):
+        if self._module is None:
+            build_directory = self.build_directory()
+            os.makedirs(build_directory, exist_ok=True)
+            self._module = load(name=self.name,
+                                extra_cflags=self.extra_cflags,
+                                extra_cuda_cflags=self.extra_cuda_cflags,
+                                extra_include_paths=self.extra_include_paths,
+                                sources=self.sources,
+                                build_directory=build_directory,
+                                verbose=verbose,
+                                )
+        return self._module
+
+    def available(self):
+        # True if the extension can be used, building it on the first call. Failures are reported once.
+        if self._module is None and self._error is None:
+            if not torch.cuda.is_available():
+                self._error = RuntimeError('CUDA is not available')
+            else:
+                try:
+                    self.load()
+                except Exception as e:
+                    self._error = e
+                    print(f'[WARN] failed to build the {self.name} CUDA extension ({e})')
+        return self._module is not None
+
+    def __getattr__(self, attr):
+        # forward kernel lookups (e.g. _backend.hash_encode_forward) to the built module.
+        if attr.startswith('__'):
+            raise AttributeError(attr)
+        return getattr(self.load(), attr)
+
+    def __repr__(self):
+        return f'CUDAExtension: name={self.name} loaded={self._module is not None}'
+
+
+def prebuild(packages=PACKAGES, verbose=False):
+    import importlib
+    for package in packages:
+        importlib.import_module(f'{package}.backend')
+    for name, extension in EXTENSIONS.items():
+        print(f'[INFO] building {name} in {extension.build_directory()} ...')
+        extension.load(verbose=verbose)
+    print(f'[INFO] built {len(EXTENSIONS)} extensions.')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='compile the CUDA extensions ahead of time')
+    parser.add_argument('packages', nargs='*', default=PACKAGES, choices=PACKAGES)
+    parser.add_argument('--verbose', action='store_true')
+    opt = parser.parse_args()
+
+    prebuild(opt.packages, opt.verbose)
@@ -1,18 +1,20 @@
 import os
-from torch.utils.cpp_extension import load
+from extensions import CUDAExtension
 
 _src_path = os.path.dirname(os.path.abspath(__file__))
 
-_backend = load(name='_hash_encoder',
-                extra_cflags=['-O3', '-std=c++14'],
-                extra_cuda_cflags=[
-                    '-O3', '-std=c++14',
-                    '-U__CUDA_NO_HALF_OPERATORS__', '-U__CUDA_NO_HALF_CONVERSIONS__', '-U__CUDA_NO_HALF2_OPERATORS__',
-                ],
-                sources=[os.path.join(_src_path, 'src', f) for f in [
-                    'hashencoder.cu',
-                    'bindings.cpp',
-                ]],
-                )
+# built lazily on first use, HashEncoder falls back to hashgrid_torch.py when it is not available.
+_backend = CUDAExtension(name='_hash_encoder',
+                         src_path=_src_path,
+                         extra_cflags=['-O3', '-std=c++14'],
+                         extra_cuda_cflags=[
+                             '-O3', '-std=c++14',
+                             '-U__CUDA_NO_HALF_OPERATORS__', '-U__CUDA_NO_HALF_CONVERSIONS__', '-U__CUDA_NO_HALF2_OPERATORS__',
+                         ],
+                         sources=[
+                             'hashencoder.cu',
+                             'bindings.cpp',
+                         ],
+                         )
 
-__all__ = ['_backend']
\ No newline at end of file
+__all__ = ['_backend']
@@ -7,6 +7,7 @@ from torch.autograd.function import once_differentiable
 from torch.cuda.amp import custom_bwd, custom_fwd 
 
 from .backend import _backend
+from .hashgrid_torch import hash_encode_torch
 
 class _hash_encode(Function):
     @staticmethod
@@ -134,10 +135,14 @@ class HashEncoder(nn.Module):
         prefix_shape = list(inputs.shape[:-1])
         inputs = inputs.view(-1, self.input_dim)
         
-        outputs = hash_encode(inputs, self.embeddings, self.offsets, self.per_level_scale, self.base_resolution, inputs.requires_grad)
+        if not inputs.is_cuda or not _backend.available():
+            # CPU-only machines (or no nvcc): same layout as hash_encode, gradients from autograd.
+            outputs = hash_encode_torch(inputs, self.embeddings, self.offsets, self.per_level_scale, self.base_resolution)
+        else:
+            outputs = hash_encode(inputs, self.embeddings, self.offsets, self.per_level_scale, self.base_resolution, inputs.requires_grad)
         
         outputs = outputs.view(prefix_shape + [self.output_dim])
 
         #print('outputs', outputs.shape, outputs.dtype, outputs.min().item(), outputs.max().item())
 
-        return outputs
\ No newline at end of file
+        return outputs
@@ -0,0 +1,119 @@
+import numpy as np
+
+import torch
+
+# pure-PyTorch multiresolution hash encoding, with the same layout as the CUDA kernels in src/hashencoder.cu:
+# same offsets, same hashing primes, same level order, and the same float32 grid arithmetic.
+
+PRIMES = [1, 2654435761, 805459861, 3674653429, 2097192037, 1434869437, 2165219737]
+
+
+def level_params(offsets, level, per_level_scale, base_resolution):
+    # offsets: list of L + 1 int
+    # return: scale, resolution, hashmap_size of this level, as computed by kernel_grid.
+    S = np.float32(np.log2(per_level_scale))
+    scale = np.float32(np.exp2(np.float32(level) * S)) * np.float32(base_resolution) - np.float32(1.0)
+    resolution = int(np.ceil(scale)) + 1
+    hashmap_size = int(offsets[level + 1] - offsets[level])
+    return float(scale), resolution, hashmap_size
+
+
+def grid_index(pos_grid, hashmap_size, resolution):
+    # pos_grid: [..., D], int64 grid coordinates
+    # return: [...], row into this level's embeddings
+    D = pos_grid.shape[-1]
+    if (resolution + 1) ** D <= hashmap_size:
+        # dense level: one row per grid vertex.
+        index = torch.zeros_like(pos_grid[..., 0])
+        stride = 1
+        for d in range(D):
+            index = index + pos_grid[..., d] * stride
+            stride *= resolution + 1
+    else:
+        # fast_hash, uint32 arithmetic emulated in int64.
+        index = torch.zeros_like(pos_grid[..., 0])
+        for d in range(D):
+            index = index ^ ((pos_grid[..., d] * PRIMES[d]) & 0xFFFFFFFF)
+    return index % hashmap_size
+
+
+def corners(D, device):
+    # return: [2^D, D], bit d of corner idx selects pos_grid[d] + 1 (same order as kernel_grid)
+    return torch.tensor([[(idx >> d) & 1 for d in range(D)] for idx in range(1 << D)], dtype=torch.int64, device=device)
+
+
+def locate(inputs, scale):
+    # return: pos_grid [B, D] int64, pos [B, D] fractional position in the cell
+    pos = inputs * scale + 0.5
+    pos_grid = torch.floor(pos)
+    return pos_grid.long(), pos - pos_grid
+
+
+def hash_encode_torch(inputs, embeddings, offsets, per_level_scale, base_resolution):
+    # inputs: [B, D], float in [0, 1]
+    # embeddings: [sO, C], float
+    # offsets: [L + 1], int
+    # return: [B, L * C], differentiable w.r.t. inputs and embeddings
+    B, D = inputs.shape
+    L = offsets.shape[0] - 1
+    offsets = offsets.tolist()
+    if inputs.dtype == torch.half:
+        inputs = inputs.float()
+
+    # out of bound inputs are encoded as 0
+    inside = ((inputs >= 0) & (inputs <= 1)).all(dim=-1, keepdim=True) # [B, 1]
+    bits = corners(D, inputs.device) # [2^D, D]
+
+    outputs = []
+    for level in range(L):
+        scale, resolution, hashmap_size = level_params(offsets, level, per_level_scale, base_resolution)
+        pos_grid, pos = locate(inputs, scale) # [B, D]
+
+        w = torch.where(bits.bool().unsqueeze(0), pos.unsqueeze(1), 1 - pos.unsqueeze(1)).prod(dim=-1) # [B, 2^D]
+        index = grid_index(pos_grid.unsqueeze(1) + bits.unsqueeze(0), hashmap_size, resolution) + offsets[level] # [B, 2^D]
+
+        output = (w.unsqueeze(-1).to(embeddings.dtype) * embeddings[index]).sum(dim=1) # [B, C]
+        outputs.append(output * inside)
+
+    return torch.cat(outputs, dim=-1)
+
+
+def hash_encode_jacobian_torch(inputs, embeddings, offsets, per_level_scale, base_resolution):
+    # inputs: [B, D], float in [0, 1]
+    # embeddings: [sO, C], float
+    # offsets: [L + 1], int
+    # return: [B, L * C, D], d outputs / d inputs (dy_dx of kernel_grid), differentiable w.r.t. embeddings,
+    #         so a loss on the jacobian (e.g. eikonal) can be backpropagated into the hash grid.
+    B, D = inputs.shape
+    L = offsets.shape[0] - 1
+    offsets = offsets.tolist()
+    if inputs.dtype == torch.half:
+        inputs = inputs.float()
+
+    inside = ((inputs >= 0) & (inputs <= 1)).all(dim=-1, keepdim=True) # [B, 1]
+    bits = corners(D - 1, inputs.device) # [2^(D-1), D-1]
+
+    jacobian = []
+    for level in range(L):
+        scale, resolution, hashmap_size = level_params(offsets, level, per_level_scale, base_resolution)
+        pos_grid, pos = locate(inputs, scale) # [B, D]
+
+        grads = []
+        for gd in range(D):
+            # the derivative along gd is the difference across the cell, interpolated over the other dims.
+            others = [d for d in range(D) if d != gd]
+            pos_others = pos[:, others] # [B, D-1]
+            w = scale * torch.where(bits.bool().unsqueeze(0), pos_others.unsqueeze(1), 1 - pos_others.unsqueeze(1)).prod(dim=-1) # [B, 2^(D-1)]
+
+            local = pos_grid.unsqueeze(1).repeat(1, bits.shape[0], 1) # [B, 2^(D-1), D]
+            local[..., others] = local[..., others] + bits.unsqueeze(0)
+            index_left = grid_index(local, hashmap_size, resolution) + offsets[level]
+            local[..., gd] = local[..., gd] + 1
+            index_right = grid_index(local, hashmap_size, resolution) + offsets[level]
+
+            grad = (w.unsqueeze(-1).to(embeddings.dtype) * (embeddings[index_right] - embeddings[index_left])).sum(dim=1) # [B, C]
+            grads.append(grad)
+
+        jacobian.append(torch.stack(grads, dim=-1) * inside.unsqueeze(-1)) # [B, C, D]
+
+    return torch.cat(jacobian, dim=1)
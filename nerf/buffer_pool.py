@@ -0,0 +1,54 @@
+import math
+from collections import OrderedDict
+
+import torch
+
+
+def size_class(n):
+    # round n up to 4 classes per power of two (at most 25% unused), so slightly different sizes share a buffer.
+    if n <= 4:
+        return max(n, 1)
+    step = 1 << (int(math.log2(n)) - 2)
+    return (n + step - 1) // step * step
+
+
+class BufferPool(object):
+    # preallocated tensors reused across calls, one per name: the name tells apart buffers that are used at the same time.
+    # take() returns a view of the pooled tensor, valid until the next take() of the same name. the tensor is replaced
+    # (and the old one released) when the size class of the first dim, the other dims, the dtype or the device change,
+    # so the pool holds at most one buffer per name.
+    # max_bytes further bounds the pooled memory: the least recently used buffers are released past it (None = no bound).
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes
+        self.buffers = OrderedDict()
+
+    def take(self, name, shape, dtype, device, fill=None):
+        # shape: list of int, the first dim is rounded up to its size class
+        # fill: value to fill the returned view with, None to leave it uninitialized.
+        shape = list(shape)
+        device = torch.device(device)
+        capacity = size_class(shape[0])
+        buffer = self.buffers.pop(name, None)
+        if buffer is None or buffer.shape[0] != capacity or list(buffer.shape[1:]) != shape[1:] or buffer.dtype != dtype or buffer.device != device:
+            buffer = None # release the old buffer before allocating the new one
+            buffer = torch.empty([capacity] + shape[1:], dtype=dtype, device=device)
+            self.buffers[name] = buffer
+            if self.max_bytes is not None:
+                self.trim(self.max_bytes)
+        else:
+            self.buffers[name] = buffer
+        view = buffer[:shape[0]]
+        if fill is not None:
+            view.fill_(fill)
+        return view
+
+    def nbytes(self):
+        return sum(buffer.numel() * buffer.element_size() for buffer in self.buffers.values())
+
+    def trim(self, max_bytes=0):
+        # release the least recently used buffers until the pool holds at most max_bytes.
+        # tensors already handed out stay valid, they are only no longer reused.
+        while self.buffers and self.nbytes() > max_bytes:
+            self.buffers.popitem(last=False)
+        if max_bytes == 0 and torch.cuda.is_available():
+            torch.cuda.empty_cache()
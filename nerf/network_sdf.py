@@ -23,9 +23,13 @@ class NeRFNetwork(NeRFRenderer):
                  weight_norm = True,
                  cuda_ray=False,
                  include_input = True,
-                 curvature_loss = False
+                 curvature_loss = False,
+                 fd_stencil = 'central',
+                 skip_empty = False,
+                 grid_resolution = 128,
+                 grid_cascades = 1,
                  ):
-        super().__init__(cuda_ray, curvature_loss)
+        super().__init__(cuda_ray, curvature_loss, fd_stencil, skip_empty, grid_resolution, grid_cascades)
 
         # sdf network
         self.num_layers = num_layers
@@ -190,25 +194,6 @@ class NeRFNetwork(NeRFRenderer):
         #not allowed auto gradient, using fd instead
         return self.finite_difference_normals_approximator(x, bound, epsilon)
 
-    def finite_difference_normals_approximator(self, x, bound, epsilon = 0.0005):
-        # finite difference
-        # f(x+h, y, z), f(x, y+h, z), f(x, y, z+h) - f(x-h, y, z), f(x, y-h, z), f(x, y, z-h)
-        pos_x = x + torch.tensor([[epsilon, 0.00, 0.00]], device=x.device)
-        dist_dx_pos = self.forward_sdf(pos_x.clamp(-bound, bound), bound)[:,:1]
-        pos_y = x + torch.tensor([[0.00, epsilon, 0.00]], device=x.device)
-        dist_dy_pos = self.forward_sdf(pos_y.clamp(-bound, bound), bound)[:,:1]
-        pos_z = x + torch.tensor([[0.00, 0.00, epsilon]], device=x.device)
-        dist_dz_pos = self.forward_sdf(pos_z.clamp(-bound, bound), bound)[:,:1]
-
-        neg_x = x + torch.tensor([[-epsilon, 0.00, 0.00]], device=x.device)
-        dist_dx_neg = self.forward_sdf(neg_x.clamp(-bound, bound), bound)[:,:1]
-        neg_y = x + torch.tensor([[0.00, -epsilon, 0.00]], device=x.device)
-        dist_dy_neg  = self.forward_sdf(neg_y.clamp(-bound, bound), bound)[:,:1]
-        neg_z = x + torch.tensor([[0.00, 0.00, -epsilon]], device=x.device)
-        dist_dz_neg  = self.forward_sdf(neg_z.clamp(-bound, bound), bound)[:,:1]
-
-        return torch.cat([0.5*(dist_dx_pos - dist_dx_neg) / epsilon, 0.5*(dist_dy_pos - dist_dy_neg) / epsilon, 0.5*(dist_dz_pos - dist_dz_neg) / epsilon], dim=-1)
-
 
 class SingleVarianceNetwork(nn.Module):
     def __init__(self, init_val):
@@ -1,8 +1,13 @@
 from builtins import print
+from collections import OrderedDict
 from operator import index
 import os
 import time
 import glob
+import math
+import hashlib
+from itertools import repeat
+from concurrent.futures import ThreadPoolExecutor
 from turtle import down
 import numpy as np
 
@@ -12,13 +17,14 @@ from tqdm import tqdm
 
 import torch
 import torch.nn.functional as F
+import torch.distributed as dist
 from torch.utils.data import DataLoader, Dataset
 
 from scipy.spatial.transform import Slerp, Rotation
 
 # NeRF dataset
 import json
-from .utils import get_rays
+from .utils import get_rays, get_rays_from_pixels, build_direction_tables, camera_key, direction_cache
 
 # ref: https://github.com/NVlabs/instant-ngp/blob/b76004c8cf478880227401ae763be4c02f80b62f/include/neural-graphics-primitives/nerf_loader.h#L50
 def nerf_matrix_to_ngp(pose, aabb, bound):
@@ -53,63 +59,196 @@ def nerf_matrix_to_ngp_scale(pose, scale=0.33):
     return new_pose
 
 
+def load_image(f_path, W, H):
+    # return: uint8 [H, W, 3/4], RGB(A) resized to (W, H)
+    image = cv2.imread(f_path, cv2.IMREAD_UNCHANGED) # [H, W, 3] o [H, W, 4]
+
+    # add support for the alpha channel as a mask.
+    if image.shape[-1] == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    else:
+        image = cv2.cvtColor(image, cv2.COLOR_BGRA2RGBA)
+    image = cv2.resize(image, (W, H), interpolation=cv2.INTER_AREA)
+
+    return image
+
+
+def load_images(f_paths, W, H, num_workers=None):
+    # W, H: int, or one value per path for cameras of different resolutions.
+    # yield: uint8 [H, W, 3/4] for each path, in the same order as f_paths.
+    # cv2 releases the GIL while decoding/resizing, so a thread pool scales with cores.
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    num_workers = min(num_workers, len(f_paths))
+    Ws = W if np.ndim(W) > 0 else repeat(W)
+    Hs = H if np.ndim(H) > 0 else repeat(H)
+
+    if num_workers <= 1:
+        for f_path, W, H in zip(f_paths, Ws, Hs):
+            yield load_image(f_path, int(W), int(H))
+    else:
+        with ThreadPoolExecutor(max_workers=num_workers) as pool:
+            yield from pool.map(load_image, f_paths, map(int, Ws), map(int, Hs))
+
+
+# the decoded uint8 frames are cached as a single .npy, keyed by dataset path, split, size and file mtimes.
+# later runs memory-map it (no decoding, no copy), images are converted to float lazily.
+def image_cache_path(cache_dir, root_path, type, downscale, H, W, f_paths):
+    # H, W: int, or per-path lists for ragged datasets.
+    stats = []
+    for f_path in f_paths:
+        st = os.stat(f_path)
+        stats.append([os.path.relpath(f_path, root_path), st.st_mtime_ns, st.st_size])
+    meta = [os.path.abspath(root_path), type, downscale, H, W, stats]
+    key = hashlib.md5(json.dumps(meta).encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, f'images_{type}_{key}.npy')
+
+
+def load_images_cached(cache_file, f_paths, W, H, num_workers=None, offsets=None):
+    # offsets: [N + 1], pixel offsets of each image for ragged storage, None if all images share H, W.
+    # return: uint8 [N, H, W, 3/4] (or [offsets[-1], 3/4] if ragged), memory-mapped read-only
+    if os.path.exists(cache_file):
+        try:
+            return np.load(cache_file, mmap_mode='r')
+        except ValueError:
+            print(f'[WARN] corrupted image cache {cache_file}, rebuilding ...')
+
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+
+    # write into a temporary memmap first, so an interrupted run never leaves a half-written cache.
+    tmp_file = cache_file + f'.{os.getpid()}.tmp'
+    images = None
+    for i, image in enumerate(tqdm(load_images(f_paths, W, H, num_workers), total=len(f_paths), unit=" images", desc=f"Caching Images")):
+        if images is None:
+            shape = (len(f_paths), *image.shape) if offsets is None else (int(offsets[-1]), image.shape[-1])
+            images = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=np.uint8, shape=shape)
+        if offsets is None:
+            images[i] = image
+        else:
+            images[offsets[i]:offsets[i + 1]] = image.reshape(-1, image.shape[-1])
+    images.flush()
+    del images
+    os.replace(tmp_file, cache_file)
+
+    return np.load(cache_file, mmap_mode='r')
+
+
+def build_error_map(images, resolution=128, mask_floor=0.05):
+    # images: uint8 [N, H, W, 3/4], or a list of [H_i, W_i, 3/4]
+    # return: [N, R * R], initial ray sampling weights. The alpha channel (if any) is used as a prior,
+    # so rays concentrate on the subject, mask_floor keeps some samples on the background.
+    error_map = np.ones((len(images), resolution * resolution), dtype=np.float32)
+    for i in range(len(images)):
+        if images[i].shape[-1] == 4:
+            alpha = cv2.resize(np.ascontiguousarray(images[i][..., 3]), (resolution, resolution), interpolation=cv2.INTER_AREA)
+            error_map[i] = alpha.reshape(-1).astype(np.float32) / 255 + mask_floor
+    return error_map
+
+
+def load_intrinsic(meta, H, W, downscale=1):
+    # H, W: already downscaled image size
+    # return: float [3, 3], from 'K' or fl_x/fl_y/cx/cy/camera_angle_x/y, None if meta has no intrinsics.
+    if 'K' in meta:
+        intrinsic = np.array(meta['K'], dtype=np.float32)[:3, :3]
+        intrinsic[:2, :] = intrinsic[:2, :] / downscale
+        return intrinsic
+
+    if not any(k in meta for k in ['fl_x', 'fl_y', 'cx', 'cy', 'camera_angle_x', 'camera_angle_y']):
+        return None
+
+    cx = (meta['cx'] / downscale) if 'cx' in meta else (W / 2)
+    cy = (meta['cy'] / downscale) if 'cy' in meta else (H / 2)
+
+    if 'fl_x' in meta or 'fl_y' in meta:
+        fl_x = (meta['fl_x'] if 'fl_x' in meta else meta['fl_y']) / downscale
+        fl_y = (meta['fl_y'] if 'fl_y' in meta else meta['fl_x']) / downscale
+    elif 'camera_angle_x' in meta or 'camera_angle_y' in meta:
+        # blender, assert in radians. already downscaled since we use H/W
+        fl_x = W / (2 * np.tan(meta['camera_angle_x'] / 2)) if 'camera_angle_x' in meta else None
+        fl_y = H / (2 * np.tan(meta['camera_angle_y'] / 2)) if 'camera_angle_y' in meta else None
+        if fl_x is None: fl_x = fl_y
+        if fl_y is None: fl_y = fl_x
+    else:
+        fl_x = fl_y = 0.
+
+    return np.array([[fl_x, 0., cx], [0., fl_y, cy], [0., 0., 1.]], dtype=np.float32)
+
+
+def load_distortion(meta, default=None):
+    # return: float [4], k1, k2, p1, p2 of the OpenCV camera model, as written by colmap2nerf.py
+    if default is None:
+        default = np.zeros(4, dtype=np.float32)
+    return np.array([float(meta.get(k, d)) for k, d in zip(['k1', 'k2', 'p1', 'p2'], default)], dtype=np.float32)
+
+
+def load_transform(path, type='train', mode='colmap'):
+    # load nerf-compatible format data.
+    if mode == 'colmap':
+        transform_path = os.path.join(path, 'transforms.json')
+    elif mode == 'blender':
+        transform_path = os.path.join(path, f'transforms_{type}.json')
+    else:
+        raise NotImplementedError(f'unknown dataset mode: {mode}')
+
+    with open(transform_path, 'r') as f:
+        transform = json.load(f)
+    return transform
+
+
+def resolve_image_path(root_path, file_path):
+    f_path = os.path.join(root_path, file_path)
+    if f_path[-4:] != '.png' and f_path[-4:] != '.jpg':
+        f_path = f_path + '.png'
+    return f_path
+
+
 class NeRFDataset(Dataset):
-    def __init__(self, path, type='train', mode='colmap', preload=True, downscale=1, bound=0.33, n_test=10):
+    def __init__(self, path, type='train', mode='colmap', preload=True, downscale=1, bound=0.33, n_test=10, cache_dir=None, num_workers=None, compact=False, sample_mode='uniform', error_map_size=128, image_root=None, transform=None):
         super().__init__()
         # path: the json file path.
+        # image_root: directory the frame file_paths are relative to, default to path (see SequenceDataset).
+        # transform: already loaded transforms dict, to share one calibration across datasets.
 
         self.root_path = path
+        self.image_root = image_root if image_root is not None else path
         self.type = type # train, val, test
         self.mode = mode # colmap, blender, llff
         self.downscale = downscale
         self.preload = preload # preload data into GPU
+        self.cache_dir = cache_dir # cache decoded images on disk, None to disable
+        self.num_workers = num_workers # image decoding threads, None to use all cores
+        self.compact = compact # keep images as uint8 [N, H, W, 3/4] instead of float32
+        self.sample_mode = sample_mode # uniform, mask (alpha prior), error (alpha prior + per-pixel error)
+        self.error_map = None
 
         # camera radius bound to make sure camera are inside the bounding box.
         self.bound = bound
 
-        # load nerf-compatible format data.
-        if mode == 'colmap':
-            transform_path = os.path.join(path, 'transforms.json')
-        elif mode == 'blender':
-            transform_path = os.path.join(path, f'transforms_{type}.json')
-        else:
-            raise NotImplementedError(f'unknown dataset mode: {mode}')
-
-        with open(transform_path, 'r') as f:
-            transform = json.load(f)
+        if transform is None:
+            transform = load_transform(path, type, mode)
         
         frames = transform["frames"]
         frames = sorted(frames, key=lambda d: d['file_path'])
 
-        # load image size
+        # load image size, frames may carry their own h/w (multi-resolution rigs).
+        # without a global h/w, each image keeps its own size (read from the file header).
+        self.probe_size = 'h' not in transform or 'w' not in transform
         try:
             self.H = int(transform['h']) // downscale
             self.W = int(transform['w']) // downscale
         except:
-            f_path = os.path.join(self.root_path, frames[0]['file_path'])
-            if f_path[-4:] != '.png' and f_path[-4:] != '.jpg':
-                f_path = f_path + '.png'
+            f_path = resolve_image_path(self.image_root, frames[0]['file_path'])
             sample = cv2.imread(f_path, cv2.IMREAD_UNCHANGED)
             self.H, self.W = sample.shape[0] // downscale, sample.shape[1] // downscale
              
 
-        # load intrinsics
-        cx = (transform['cx'] / downscale) if 'cx' in transform else (self.W / 2)
-        cy = (transform['cy'] / downscale) if 'cy' in transform else (self.H / 2)
-
-        if 'fl_x' in transform or 'fl_y' in transform:
-            fl_x = (transform['fl_x'] if 'fl_x' in transform else transform['fl_y']) / downscale
-            fl_y = (transform['fl_y'] if 'fl_y' in transform else transform['fl_x']) / downscale
-            self.intrinsic = np.array([[fl_x, 0., cx], [0., fl_y, cy], [0., 0., 1.]])
-        elif 'camera_angle_x' in transform or 'camera_angle_y' in transform:
-            # blender, assert in radians. already downscaled since we use H/W
-            fl_x = self.W / (2 * np.tan(transform['camera_angle_x'] / 2)) if 'camera_angle_x' in transform else None
-            fl_y = self.H / (2 * np.tan(transform['camera_angle_y'] / 2)) if 'camera_angle_y' in transform else None
-            if fl_x is None: fl_x = fl_y
-            if fl_y is None: fl_y = fl_x
-            self.intrinsic = np.array([[fl_x, 0., cx], [0., fl_y, cy], [0., 0., 1.]])
-        else:
-            self.intrinsic = np.array([[0., 0., cx], [0., 0., cy], [0., 0., 1.]])
+        # load intrinsics, per-frame values override the global ones.
+        self.intrinsic = load_intrinsic(transform, self.H, self.W, downscale)
+        if self.intrinsic is None:
+            self.intrinsic = np.array([[0., 0., self.W / 2], [0., 0., self.H / 2], [0., 0., 1.]], dtype=np.float32)
+
+        # load lens distortion, per-frame values override the global ones.
+        self.distortion = load_distortion(transform)
 
         # load bounding bbox
         try:
@@ -137,11 +276,11 @@ class NeRFDataset(Dataset):
 
             self.poses = []
             self.intrinsics = []
-            try:
-                intrinsic = np.array(f0['K'], dtype=np.float32) # [4, 4]
-                intrinsic[:2, :] = intrinsic[:2, :] / downscale
-            except:
-                intrinsic = self.intrinsic
+            self.distortions = []
+            self.sizes = []
+            size = self.frame_size(f0)
+            intrinsic = self.frame_intrinsic(f0, *size)
+            distortion = load_distortion(f0, self.distortion)
 
             for i in range(n_test + 1):
                 ratio = np.sin(((i / n_test) - 0.5) * np.pi) * 0.5 + 0.5
@@ -150,6 +289,8 @@ class NeRFDataset(Dataset):
                 pose[:3, 3] = (1 - ratio) * pose0[:3, 3] + ratio * pose1[:3, 3]
                 self.poses.append(pose)
                 self.intrinsics.append(intrinsic)
+                self.distortions.append(distortion)
+                self.sizes.append(size)
 
             self.poses = np.stack(self.poses, axis=0).astype(np.float32)
             self.intrinsics = np.stack(self.intrinsics, axis=0).astype(np.float32)
@@ -158,17 +299,18 @@ class NeRFDataset(Dataset):
             self.poses = []
             self.images = []
             self.intrinsics = []
+            self.distortions = []
+            self.sizes = []
             
             for f in tqdm(frames, unit=" views", desc=f"Loading Render Path"):
                 pose = nerf_matrix_to_ngp(np.array(f['transform_matrix'], dtype=np.float32), aabb=self.aabb, bound=bound) # [4, 4]
-                try:
-                    intrinsic = np.array(f['K'], dtype=np.float32) # [4, 4]
-                    intrinsic[:2, :] = intrinsic[:2, :] / downscale
-                except:
-                    intrinsic = self.intrinsic
+                size = self.frame_size(f)
+                intrinsic = self.frame_intrinsic(f, *size)
 
                 self.poses.append(pose)
                 self.intrinsics.append(intrinsic)
+                self.distortions.append(load_distortion(f, self.distortion))
+                self.sizes.append(size)
 
             self.poses = np.stack(self.poses, axis=0).astype(np.float32)
             self.intrinsics = np.stack(self.intrinsics, axis=0).astype(np.float32)
@@ -182,58 +324,123 @@ class NeRFDataset(Dataset):
             self.poses = []
             self.images = []
             self.intrinsics = []
-            
-            for f in tqdm(frame, unit=" images", desc=f"Loading Images"):
-                f_path = os.path.join(self.root_path, f['file_path'])
-                if f_path[-4:] != '.png' and f_path[-4:] != '.jpg':
-                    f_path = f_path + '.png'
+            self.distortions = []
+            self.sizes = []
+            f_paths = []
+
+            for f in frame:
+                f_path = resolve_image_path(self.image_root, f['file_path'])
 
                 # there are non-exist paths in fox...
                 if not os.path.exists(f_path):
                     continue
-                
-                pose = nerf_matrix_to_ngp(np.array(f['transform_matrix'], dtype=np.float32), aabb=self.aabb, bound=bound) # [4, 4]
-
-                try:
-                    intrinsic = np.array(f['K'], dtype=np.float32) # [4, 4]
-                    intrinsic[:2, :] = intrinsic[:2, :] / downscale
-                except:
-                    intrinsic = self.intrinsic
-
-                image = cv2.imread(f_path, cv2.IMREAD_UNCHANGED) # [H, W, 3] o [H, W, 4]
 
-                # add support for the alpha channel as a mask.
-                if image.shape[-1] == 3: 
-                    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-                else:
-                    image = cv2.cvtColor(image, cv2.COLOR_BGRA2RGBA)
-                image = cv2.resize(image, (self.W, self.H), interpolation=cv2.INTER_AREA)
-                image = image.astype(np.float32) / 255 # [H, W, 3/4]
+                pose = nerf_matrix_to_ngp(np.array(f['transform_matrix'], dtype=np.float32), aabb=self.aabb, bound=bound) # [4, 4]
+                size = self.frame_size(f, f_path)
+                intrinsic = self.frame_intrinsic(f, *size)
 
                 self.poses.append(pose)
-                self.images.append(image)
                 self.intrinsics.append(intrinsic)
-            
+                self.distortions.append(load_distortion(f, self.distortion))
+                self.sizes.append(size)
+                f_paths.append(f_path)
+
             self.poses = np.stack(self.poses, axis=0).astype(np.float32)
-            self.images = np.stack(self.images, axis=0)
             self.intrinsics = np.stack(self.intrinsics, axis=0).astype(np.float32)
+            self.set_layout()
+
+            # ragged layout: images of different sizes are packed into one [sum(H_i * W_i), 3/4] pixel array.
+            Hs, Ws = (self.sizes[:, 0], self.sizes[:, 1]) if self.ragged else (self.H, self.W)
+            offsets = self.offsets if self.ragged else None
+            if self.cache_dir is not None:
+                cache_file = image_cache_path(self.cache_dir, self.image_root, type, downscale, np.asarray(Hs).tolist(), np.asarray(Ws).tolist(), f_paths)
+                self.images = load_images_cached(cache_file, f_paths, Ws, Hs, self.num_workers, offsets) # [N, H, W, 3/4], uint8 memmap
+            else:
+                # write straight into the output array, so there is no extra copy from np.stack.
+                self.images = None
+                for i, image in enumerate(tqdm(load_images(f_paths, Ws, Hs, self.num_workers), total=len(f_paths), unit=" images", desc=f"Loading Images")):
+                    if self.images is None:
+                        shape = (len(f_paths), *image.shape) if offsets is None else (int(offsets[-1]), image.shape[-1])
+                        self.images = np.empty(shape, dtype=np.uint8) # [N, H, W, 3/4] or [P, 3/4]
+                    if offsets is None:
+                        self.images[i] = image
+                    else:
+                        self.images[offsets[i]:offsets[i + 1]] = image.reshape(-1, image.shape[-1])
         
-        # load image size
-        if 'h' in transform and 'w' in transform:
-            self.H = int(transform['h']) // downscale
-            self.W = int(transform['w']) // downscale
-        else:
-            # we have to actually read an image to get H and W later.
-            self.H = self.W = None
+            if sample_mode in ['mask', 'error'] and type == 'train':
+                self.error_map = torch.from_numpy(build_error_map([self.get_image(i) for i in range(len(self.poses))], error_map_size)) # [N, R * R]
+
+        # skip undistortion entirely for pinhole cameras.
+        self.distortions = np.stack(self.distortions, axis=0).astype(np.float32) # [N, 4]
+        if not np.any(self.distortions):
+            self.distortions = None
+
+        if type in ['test', 'fvv']:
+            self.set_layout()
+
+        # host-side direction cache key of each view, and room in the cache for every distinct camera.
+        self.cameras = [camera_key(self.intrinsics[i], int(self.sizes[i, 0]), int(self.sizes[i, 1]), None if self.distortions is None else self.distortions[i]) for i in range(len(self.sizes))]
+        direction_cache.reserve(len(set(self.cameras)))
         
         if preload:
+            device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+            if self.distortions is not None:
+                self.distortions = torch.from_numpy(self.distortions).to(device)
             if type == 'train':
-                self.poses = torch.from_numpy(self.poses).cuda()
-                self.intrinsics = torch.from_numpy(self.intrinsics).cuda()
-                self.images = torch.from_numpy(self.images).cuda()
+                self.poses = torch.from_numpy(self.poses).to(device)
+                self.intrinsics = torch.from_numpy(self.intrinsics).to(device)
+                # convert one image at a time, so the host never holds a full extra copy of the dataset.
+                images = torch.empty(self.images.shape, dtype=torch.uint8 if compact else torch.float32, device=device)
+                for i in range(len(self.poses)):
+                    image = torch.from_numpy(np.array(self.get_image(i))).to(device)
+                    image = image if compact else image.float() / 255
+                    if self.ragged:
+                        images[self.offsets[i]:self.offsets[i + 1]] = image.reshape(-1, image.shape[-1])
+                    else:
+                        images[i] = image
+                self.images = images
+                if self.error_map is not None:
+                    self.error_map = self.error_map.to(device)
             else:
-                self.poses = torch.from_numpy(self.poses).cuda()
-                self.intrinsics = torch.from_numpy(self.intrinsics).cuda()
+                self.poses = torch.from_numpy(self.poses).to(device)
+                self.intrinsics = torch.from_numpy(self.intrinsics).to(device)
+
+    def frame_size(self, f, f_path=None):
+        # return: (H, W) of a frame, downscaled.
+        if 'h' in f and 'w' in f:
+            return int(f['h']) // self.downscale, int(f['w']) // self.downscale
+        if self.probe_size and f_path is not None:
+            # only reads the header, not the pixels.
+            with Image.open(f_path) as image:
+                w, h = image.size
+            return h // self.downscale, w // self.downscale
+        return self.H, self.W
+
+    def frame_intrinsic(self, f, H, W):
+        # return: [3, 3], the frame's own intrinsics, or the global ones rescaled to the frame size.
+        intrinsic = load_intrinsic(f, H, W, self.downscale)
+        if intrinsic is None:
+            intrinsic = self.intrinsic.copy()
+            intrinsic[0] = intrinsic[0] * W / self.W
+            intrinsic[1] = intrinsic[1] * H / self.H
+        return intrinsic
+
+    def set_layout(self):
+        # sizes: [N, 2], per-frame H, W
+        # offsets: [N + 1], first pixel of each frame in the packed (ragged) layout
+        self.sizes = np.array(self.sizes, dtype=np.int64).reshape(-1, 2)
+        self.offsets = np.concatenate([[0], np.cumsum(self.sizes[:, 0] * self.sizes[:, 1])]).astype(np.int64)
+        self.ragged = len(np.unique(self.sizes, axis=0)) > 1
+        if not self.ragged:
+            # all frames share one size, which may differ from the global h/w.
+            self.H, self.W = int(self.sizes[0, 0]), int(self.sizes[0, 1])
+
+    def get_image(self, index):
+        # return: [H_i, W_i, 3/4], a view into the (possibly packed) image storage
+        if not self.ragged:
+            return self.images[index]
+        H, W = int(self.sizes[index, 0]), int(self.sizes[index, 1])
+        return self.images[self.offsets[index]:self.offsets[index + 1]].reshape(H, W, -1)
 
     def __len__(self):
         return len(self.poses)
@@ -244,70 +451,243 @@ class NeRFDataset(Dataset):
             'pose': self.poses[index],
             'intrinsic': self.intrinsics[index],
             'index': index,
+            'camera': self.cameras[index],
         }
 
+        if self.distortions is not None:
+            results['distortion'] = self.distortions[index] # [4]
+
+        # only string can bypass the default collate, so we don't need to call item: https://github.com/pytorch/pytorch/blob/67a275c29338a6c6cc405bf143e63d53abe600bf/torch/utils/data/_utils/collate.py#L84
+        results['H'] = str(self.sizes[index, 0])
+        results['W'] = str(self.sizes[index, 1])
+
         if self.type == 'test':
-            # only string can bypass the default collate, so we don't need to call item: https://github.com/pytorch/pytorch/blob/67a275c29338a6c6cc405bf143e63d53abe600bf/torch/utils/data/_utils/collate.py#L84
-            results['H'] = str(self.H)
-            results['W'] = str(self.W)
             return results
         else:
-            results['H'] = str(self.H)
-            results['W'] = str(self.W)
-            results['image'] = self.images[index]
+            if torch.is_tensor(self.images) or self.compact:
+                # compact images stay uint8, the trainer dequantizes the sampled pixels.
+                results['image'] = self.get_image(index)
+            else:
+                # lazily convert uint8 (possibly memory-mapped) images to float.
+                results['image'] = self.get_image(index).astype(np.float32) / 255 # [H, W, 3/4]
+            if self.error_map is not None:
+                results['error_map'] = self.error_map[index] # [R * R]
             return results
 
+class SequenceDataset:
+    # a 4D sequence (human performance capture): one shared transforms.json under the root, and one image
+    # directory per timestep holding the same camera file_paths, e.g. root/frame_0001/images/cam00.png.
+    # timesteps are listed in transforms.json ("timesteps": [...]) or found as the sub-directories that contain the frames.
+    # per-timestep NeRFDatasets are built on demand and kept in an LRU of max_frames timesteps (with all the datasets,
+    # e.g. train and valid, of each), so memory doesn't grow with sequence length.
+    def __init__(self, path, mode='colmap', max_frames=2, timesteps=None, **kwargs):
+        self.root_path = path
+        self.mode = mode
+        self.max_frames = max_frames
+        self.kwargs = kwargs # passed to every NeRFDataset
+        self.transforms = {} # type --> transforms dict, the calibration is parsed once and shared by all timesteps
+        self.datasets = OrderedDict() # timestep index --> {(type, kwargs): NeRFDataset}
+
+        transform = self.get_transform('train')
+        if timesteps is None:
+            timesteps = transform.get('timesteps', None)
+        if timesteps is None:
+            file_path = sorted(transform['frames'], key=lambda d: d['file_path'])[0]['file_path']
+            timesteps = [d for d in sorted(os.listdir(path)) if os.path.exists(resolve_image_path(os.path.join(path, d), file_path))]
+        if len(timesteps) == 0:
+            raise ValueError(f'no timesteps found under {path}')
+        self.timesteps = list(timesteps)
+
+    def get_transform(self, type):
+        key = type if self.mode == 'blender' else 'train'
+        if key not in self.transforms:
+            self.transforms[key] = load_transform(self.root_path, key, self.mode)
+        return self.transforms[key]
+
+    def __len__(self):
+        return len(self.timesteps)
+
+    def __getitem__(self, index):
+        return self.get(index)
+
+    def get(self, index, type='train', **kwargs):
+        # return: NeRFDataset of timestep index, with the shared calibration.
+        kwargs = {**self.kwargs, **kwargs}
+        key = (type, tuple(sorted(kwargs.items())))
+        if index in self.datasets:
+            self.datasets.move_to_end(index)
+        else:
+            while len(self.datasets) >= self.max_frames:
+                self.datasets.popitem(last=False)
+            self.datasets[index] = {}
+
+        datasets = self.datasets[index]
+        if key not in datasets:
+            image_root = os.path.join(self.root_path, self.timesteps[index])
+            datasets[key] = NeRFDataset(self.root_path, type=type, mode=self.mode, image_root=image_root, transform=self.get_transform(type), **kwargs)
+        return datasets[key]
+
+    def clear(self):
+        self.datasets.clear()
+
+
 class RayDataset(Dataset):
-    def __init__(self, path, type='train', downscale=1, radius=1, n_test=10):
+    # streaming ray store: rays are generated per fixed-size chunk on demand, never for the whole dataset.
+    # each item is one chunk of rays, so use it with DataLoader(batch_size=1, shuffle=True) to iterate chunks in random order.
+    def __init__(self, path, type='train', mode='colmap', downscale=1, bound=0.33, chunk_size=4096, scatter=True, cache_dir=None, num_workers=None, seed=0):
         super().__init__()
         # path: the json file path.
+        # seed: with scatter, the ray --> pixel map of epoch e is drawn from seed + e (see set_epoch).
 
         self.path = path
         self.type = type
         self.downscale = downscale
-        self.radius = radius # TODO: generate custom views for test?
-        self.NeRFDataset =  NeRFDataset(self.path, self.type, downscale=self.downscale, radius=self.radius)
+        self.chunk_size = chunk_size
+        # images stay uint8 on the host (memory-mapped if cache_dir is set), pixels are read per chunk.
+        self.NeRFDataset = NeRFDataset(self.path, self.type, mode=mode, preload=False, downscale=self.downscale, bound=bound, cache_dir=cache_dir, num_workers=num_workers, compact=True)
+
+        self.poses = torch.from_numpy(self.NeRFDataset.poses) # [V, 4, 4]
+        self.intrinsics = torch.from_numpy(self.NeRFDataset.intrinsics) # [V, 3, 3]
+        self.sizes = torch.from_numpy(self.NeRFDataset.sizes) # [V, 2]
+        self.offsets = torch.from_numpy(self.NeRFDataset.offsets) # [V + 1]
+        self.images = self.NeRFDataset.images # [V, H, W, 3/4] or ragged [P, 3/4], uint8
+
+        self.V = len(self.sizes)
+        self.C = self.images.shape[-1]
+        self.num_rays = int(self.offsets[-1])
+
+        # undistortion maps, one per unique camera
+        self.view_offsets, self.tables = None, None
+        if self.NeRFDataset.distortions is not None:
+            self.view_offsets, self.tables = build_direction_tables(self.intrinsics, self.sizes, torch.from_numpy(self.NeRFDataset.distortions))
+
+        # scatter: map ray index i to pixel (offset + i * stride) % num_rays with stride coprime to num_rays,
+        # a bijection that spreads every chunk over all views without storing a permutation.
+        # stride and offset are drawn again every epoch, so the chunks hold other rays each epoch.
+        assert self.num_rays * self.chunk_size < 2 ** 63, 'too many rays for the int64 chunk offsets'
+        self.scatter = scatter
+        self.seed = seed
+        self.stride = 1
+        self.offset = 0
+        self.set_epoch(0)
+
+    def set_epoch(self, epoch):
+        # called by the trainer before each epoch (DataLoader workers copy the dataset when the epoch starts).
+        if not self.scatter:
+            return
+        rng = np.random.default_rng(self.seed + epoch)
+        self.offset = int(rng.integers(0, self.num_rays))
+        # strides near 0 or num_rays would keep the neighbouring pixels of a view in one chunk.
+        self.stride = int(rng.integers(self.num_rays // 4, self.num_rays - self.num_rays // 4)) | 1
+        while math.gcd(self.stride, self.num_rays) != 1:
+            self.stride += 2
 
+    def __len__(self):
+        return (self.num_rays + self.chunk_size - 1) // self.chunk_size
 
-        self.all_rays_o = []
-        self.all_rays_d = []
-        self.all_inds = []
-        self.all_rgbs = []
+    def chunk_pixels(self, index):
+        # return: [n], int64 pixel ids of the rays in chunk index
+        head = index * self.chunk_size
+        tail = min(head + self.chunk_size, self.num_rays)
+        # (offset + i * stride) % num_rays without overflowing int64: the chunk head in python ints,
+        # then k * (stride % num_rays) with k < chunk_size, bounded by chunk_size * num_rays.
+        base = (self.offset + head * self.stride) % self.num_rays
+        return (base + torch.arange(tail - head, dtype=torch.int64) * (self.stride % self.num_rays)) % self.num_rays
 
-        for i in range(len(self.NeRFDataset)):
-            meta = self.NeRFDataset.__getitem__(i)
+    def __getitem__(self, index):
+        pixel_ids = self.chunk_pixels(index) # [n]
+        view_ids = torch.searchsorted(self.offsets, pixel_ids, right=True) - 1
+        local_ids = pixel_ids - self.offsets[view_ids]
+        select_ws = local_ids % self.sizes[view_ids, 1]
+        select_hs = local_ids // self.sizes[view_ids, 1]
 
-            images = torch.from_numpy(meta["image"]) # [H, W, 3/4]
-            poses = torch.from_numpy(meta["pose"]) # [4, 4]
-            intrinsics = torch.from_numpy(meta["intrinsic"])  # [3, 3]
+        directions = None
+        if self.tables is not None:
+            directions = self.tables[self.view_offsets[view_ids] + local_ids] # [n, 3]
 
-            # sample rays 
-            H, W, C = images.shape
-            rays_o, rays_d, inds = get_rays(poses.unsqueeze(0), intrinsics.unsqueeze(0), H, W, -1) #[1, H*W, 3]
-            rgbs = images.reshape(1, -1, C) #[1, H*W, 3/4]
+        rays_o, rays_d = get_rays_from_pixels(self.poses[view_ids], self.intrinsics[view_ids], select_ws.float(), select_hs.float(), directions) # [n, 3]
+        rgbs = np.asarray(self.images).reshape(-1, self.C)[pixel_ids.numpy()] # [n, 3/4], uint8
+
+        results = {
+            'rays_o': rays_o,
+            'rays_d': rays_d,
+            'image': torch.from_numpy(rgbs),
+            'index': index,
+        }
+        return results
 
-            self.all_rays_o.append(rays_o[0])
-            self.all_rays_d.append(rays_d[0])
-            self.all_inds.append(inds[0])
-            self.all_rgbs.append(rgbs[0])
-        
-        self.all_rays_o = torch.cat(self.all_rays_o, dim=0)
-        self.all_rays_d = torch.cat(self.all_rays_d, dim=0)
-        self.all_inds = torch.cat(self.all_inds, dim=0)
-        self.all_rgbs = torch.cat(self.all_rgbs, dim=0)
 
+class GlobalRaySampler:
+    # instant-ngp style sampler: every batch draws num_rays random pixels across all training views at once,
+    # instead of num_rays pixels from a single image per step. It replaces the DataLoader in Trainer.train().
+    # with torch.distributed, every rank draws its own rays (as DistributedSampler shards the images): the draws of
+    # epoch e on rank r come from a generator seeded by seed, e and r, see set_epoch.
+    def __init__(self, dataset, num_rays=4096, steps_per_epoch=None, seed=0, rank=None, world_size=None):
+        self.num_rays = num_rays
+        self.seed = seed
+        self.rank = rank if rank is not None else (dist.get_rank() if dist.is_initialized() else 0)
+        self.world_size = world_size if world_size is not None else (dist.get_world_size() if dist.is_initialized() else 1)
+        # keep the old epoch length (one step per image, split over the ranks), so schedules and eval intervals are unchanged.
+        self.steps_per_epoch = steps_per_epoch if steps_per_epoch is not None else (len(dataset) + self.world_size - 1) // self.world_size
+
+        self.poses = dataset.poses if torch.is_tensor(dataset.poses) else torch.from_numpy(dataset.poses) # [V, 4, 4]
+        self.intrinsics = dataset.intrinsics if torch.is_tensor(dataset.intrinsics) else torch.from_numpy(dataset.intrinsics) # [V, 3, 3]
+        self.images = dataset.images if torch.is_tensor(dataset.images) else torch.from_numpy(np.array(dataset.images)) # [V, H, W, 3/4]
+        if not torch.is_tensor(dataset.images) and not dataset.compact:
+            self.images = self.images.float() / 255
+
+        self.device = self.images.device
+        self.C = self.images.shape[-1]
+        self.images = self.images.view(-1, self.C) # [sum(H_i * W_i), 3/4]
+
+        # cameras may differ in resolution, so pixels are addressed through per-view offsets.
+        self.sizes = torch.from_numpy(dataset.sizes).to(self.device) # [V, 2]
+        self.offsets = torch.from_numpy(dataset.offsets[:-1]).to(self.device) # [V]
+        self.V = len(self.sizes)
+
+        # undistortion maps, one per unique camera
+        self.view_offsets, self.tables = None, None
+        if dataset.distortions is not None:
+            distortions = dataset.distortions if torch.is_tensor(dataset.distortions) else torch.from_numpy(dataset.distortions)
+            self.view_offsets, self.tables = build_direction_tables(self.intrinsics, self.sizes, distortions)
+            self.view_offsets = self.view_offsets.to(self.device)
+
+        self.generator = torch.Generator(self.device)
+        self.set_epoch(0)
+
+    def set_epoch(self, epoch):
+        # called by the trainer before each epoch.
+        self.generator.manual_seed(self.seed + epoch * self.world_size + self.rank)
 
     def __len__(self):
-        return len(self.all_rays_o)
+        return self.steps_per_epoch
 
-    def __getitem__(self, index):
+    def __iter__(self):
+        for _ in range(self.steps_per_epoch):
+            yield self.sample()
+
+    def sample(self):
+        N = self.num_rays
+
+        # uniform over views, then uniform over the pixels of each view.
+        view_ids = torch.randint(0, self.V, size=[N], device=self.device, generator=self.generator)
+        Hs, Ws = self.sizes[view_ids, 0], self.sizes[view_ids, 1]
+        select_hs = torch.randint(0, 2**31 - 1, size=[N], device=self.device, generator=self.generator) % Hs
+        select_ws = torch.randint(0, 2**31 - 1, size=[N], device=self.device, generator=self.generator) % Ws
+        local_ids = select_hs * Ws + select_ws
+
+        directions = None
+        if self.tables is not None:
+            directions = self.tables[self.view_offsets[view_ids] + local_ids] # [N, 3]
+
+        rays_o, rays_d = get_rays_from_pixels(self.poses[view_ids], self.intrinsics[view_ids], select_ws.float(), select_hs.float(), directions) # [N, 3]
+        images = self.images[self.offsets[view_ids] + local_ids] # [N, 3/4]
 
         results = {
-            'rays_o': self.all_rays_o[index],
-            'rays_d': self.all_rays_d[index],
-            'rgbs': self.all_rgbs[index],
-            'shape' : (self.NeRFDataset.H, self.NeRFDataset.W),
-            'index': index,
+            'rays_o': rays_o[None, ...], # [1, N, 3]
+            'rays_d': rays_d[None, ...],
+            'image': images[None, ...], # [1, N, 3/4]
+            'index': view_ids,
         }
+
         return results
-     
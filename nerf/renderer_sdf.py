@@ -1,4 +1,5 @@
 import time
+import functools
 import mcubes
 import trimesh
 
@@ -7,6 +8,9 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 import raymarching
+import raymarching.raymarching_torch as raymarching_torch
+from raymarching.bitfield import cascade_extents, build_bitfield, lookup_bitfield, march_bitfield
+from .buffer_pool import BufferPool
 
 def sample_pdf(bins, weights, n_samples, det=False):
     # This implementation is from NeRF
@@ -78,26 +82,50 @@ def plot_pointcloud(pc, color=None):
     trimesh.Scene([pc, axes, sphere]).show()
 
 class NeRFRenderer(nn.Module):
+    # whether gradient() differentiates the network (autograd) instead of using finite differences.
+    analytic_gradient = False
+
     def __init__(self,
                  cuda_ray=False,
-                 curvature_loss = False
+                 curvature_loss = False,
+                 fd_stencil = 'central',
+                 skip_empty = False,
+                 grid_resolution = 128,
+                 grid_cascades = 1,
+                 grid_mips = 4,
                  ):
         super().__init__()
 
         # extra state for cuda raymarching
         self.cuda_ray = cuda_ray
         self.curvature_loss = curvature_loss
-        if cuda_ray:
+        self.fd_stencil = fd_stencil # finite difference normals, central (6 points) or tetrahedron (4 points)
+        self.skip_empty = skip_empty # skip empty density grid cells in the pytorch run (no effect with cuda_ray)
+        if cuda_ray or skip_empty:
             # density grid
-            density_grid = torch.zeros([128 + 1] * 3) # +1 because we save values at grid
+            # cascade c covers [-bound, bound] / 2^(C - 1 - c), the cuda kernels only read one grid (the whole cube).
+            assert not (cuda_ray and grid_cascades > 1), 'cuda_ray only supports a single density grid cascade'
+            density_grid = torch.zeros([grid_cascades] + [grid_resolution + 1] * 3) # +1 because we save values at grid
             self.register_buffer('density_grid', density_grid)
+            if skip_empty and not cuda_ray:
+                # packed occupancy bits with mips for the pytorch run, derived from density_grid.
+                density_bitfield = torch.zeros(grid_mips, grid_cascades, grid_resolution ** 3 // 8, dtype=torch.uint8)
+                self.register_buffer('density_bitfield', density_bitfield, persistent=False)
+            self.bitfield_ready = False
             self.mean_density = 0
             self.iter_density = 0
+        if cuda_ray:
             # step counter
             step_counter = torch.zeros(64, 2, dtype=torch.int32) # 64 is hardcoded for averaging...
             self.register_buffer('step_counter', step_counter)
             self.mean_count = 0
             self.local_step = 0
+            # rays that did not fit in the mean_count points since the last update_extra_state.
+            self.register_buffer('dropped_counter', torch.zeros(1, dtype=torch.int32), persistent=False)
+            self.dropped_rays = 0
+
+        # preallocated tensors of run_cuda (march_rays_train points, inference outputs and alive rays), reused across calls.
+        self.buffer_pool = BufferPool()
     
     def forward(self, x, d, bound):
         raise NotImplementedError()
@@ -108,8 +136,81 @@ class NeRFRenderer(nn.Module):
     def forward_sdf(self, x, bound):
         raise NotImplementedError()
     
-    def finite_difference_normals_approximator(self, x, bound, epsilon):
-        raise NotImplementedError()
+    def fd_offsets(self, x):
+        # return: [K, 3], unit offsets of the finite difference stencil
+        if self.fd_stencil == 'central':
+            # f(x+h, y, z), f(x, y+h, z), f(x, y, z+h) - f(x-h, y, z), f(x, y-h, z), f(x, y, z-h)
+            return torch.tensor([[1., 0., 0.], [0., 1., 0.], [0., 0., 1.], [-1., 0., 0.], [0., -1., 0.], [0., 0., -1.]], dtype=x.dtype, device=x.device)
+        elif self.fd_stencil == 'tetrahedron':
+            # f(x + h * v) at the 4 vertices v of a tetrahedron, sum_v v * f(x + h * v) = 4 * h * grad f
+            return torch.tensor([[1., -1., -1.], [-1., -1., 1.], [-1., 1., -1.], [1., 1., 1.]], dtype=x.dtype, device=x.device)
+        else:
+            raise NotImplementedError(f'unknown finite difference stencil: {self.fd_stencil}')
+
+    def fd_gradient(self, sdf, offsets, epsilon):
+        # sdf: [K, N, 1], sdf at the stencil points
+        # return: [N, 3]
+        if self.fd_stencil == 'central':
+            return torch.cat([0.5 * (sdf[i] - sdf[i + 3]) / epsilon for i in range(3)], dim=-1)
+        else:
+            return (offsets.unsqueeze(1) * sdf).sum(0) / (4 * epsilon)
+
+    def finite_difference_normals_approximator(self, x, bound, epsilon = 0.0005):
+        # x: [N, 3]
+        # return: [N, 3], sdf gradient. All stencil points are evaluated by a single forward_sdf call.
+        offsets = self.fd_offsets(x)
+        K, N = offsets.shape[0], x.shape[0]
+        pts = (x.unsqueeze(0) + epsilon * offsets.unsqueeze(1)).reshape(-1, 3) # [K * N, 3]
+        sdf = self.forward_sdf(pts.clamp(-bound, bound), bound)[:, :1].reshape(K, N, 1)
+        return self.fd_gradient(sdf, offsets, epsilon)
+
+    def sdf_and_gradient(self, x, bound, epsilon = 0.0005, finite_difference = True):
+        # x: [N, 3]
+        # return: sdf_output [N, 1 + F] at x, gradient [N, 3]
+        if finite_difference:
+            # the center point rides along with the stencil points in the same forward_sdf call.
+            offsets = self.fd_offsets(x)
+            K, N = offsets.shape[0], x.shape[0]
+            pts = (x.unsqueeze(0) + epsilon * offsets.unsqueeze(1)).reshape(-1, 3).clamp(-bound, bound) # [K * N, 3]
+            sdf_output = self.forward_sdf(torch.cat([x, pts], dim=0), bound)
+            gradient = self.fd_gradient(sdf_output[N:, :1].reshape(K, N, 1), offsets, epsilon)
+            return sdf_output[:N], gradient
+        else:
+            # autograd through the center evaluation, no extra forward at all.
+            with torch.enable_grad():
+                x = x.requires_grad_(True)
+                sdf_output = self.forward_sdf(x, bound)
+                gradient = torch.autograd.grad(outputs=sdf_output[:, :1], inputs=x, grad_outputs=torch.ones_like(sdf_output[:, :1]),
+                                               create_graph=True, retain_graph=True, only_inputs=True)[0]
+            return sdf_output, gradient
+
+    def query_sdf(self, x, bound, epsilon = 0.0005, curvature_epsilon = None, finite_difference = True):
+        # everything the renderer needs at the sample points, sharing the network evaluations.
+        # x: [N, 3]
+        # curvature_epsilon: if set, also return the normals at points moved by this distance along a random tangent (curvature loss).
+        # return: dict of sdf [N, 1], feature [N, F], gradient [N, 3], normal [N, 3] (, perturbed_normal [N, 3])
+        sdf_output, gradient = self.sdf_and_gradient(x, bound, epsilon, finite_difference)
+        normal = gradient / (1e-5 + torch.linalg.norm(gradient, ord=2, dim=-1,  keepdim = True))
+
+        results = {
+            'sdf': sdf_output[:, :1],
+            'feature': sdf_output[:, 1:],
+            'gradient': gradient,
+            'normal': normal,
+        }
+
+        if curvature_epsilon is not None:
+            random_vec = 2.0 * torch.randn_like(normal) - 1.0
+            random_vec_norm = random_vec / (1e-5 + torch.linalg.norm(random_vec, ord=2, dim=-1,  keepdim = True))
+
+            perturbed_pts = x + torch.cross(normal, random_vec_norm) * curvature_epsilon # naively set perturbed points, 
+            if finite_difference:
+                perturbed_gradient = self.finite_difference_normals_approximator(perturbed_pts, bound, epsilon)
+            else:
+                perturbed_gradient = self.sdf_and_gradient(perturbed_pts, bound, epsilon, finite_difference)[1]
+            results['perturbed_normal'] = perturbed_gradient / (1e-5 + torch.linalg.norm(perturbed_gradient, ord=2, dim=-1,  keepdim = True))
+
+        return results
     
     def forward_variance(self):
         raise NotImplementedError()
@@ -120,9 +221,131 @@ class NeRFRenderer(nn.Module):
     def density(self, x, bound):
         raise NotImplementedError()
     
-    def run(self, rays_o, rays_d, num_steps, bound, upsample_steps, bg_color, cos_anneal_ratio = 1.0, normal_epsilon_ratio = 1.0):
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints from before the cascades store a single [H, H, H] density grid.
+        key = prefix + 'density_grid'
+        if key in state_dict and state_dict[key].dim() == 3:
+            state_dict[key] = state_dict[key].unsqueeze(0)
+        self.bitfield_ready = False
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def update_bitfield(self):
+        # pack density_grid > min(10, mean_density) (the threshold of march_rays) into the occupancy bits and their mips.
+        density_thresh = min(10, self.mean_density)
+        self.density_bitfield = build_bitfield(self.density_grid, density_thresh, self.density_bitfield.shape[0])
+        self.bitfield_ready = True
+
+    def occupancy(self, pts, bound):
+        # pts: [..., 3], in [-bound, bound]
+        # return: [...], bool, whether the cell of each point (in the finest cascade containing it) is occupied.
+        if not self.bitfield_ready:
+            self.update_bitfield()
+        return lookup_bitfield(self.density_bitfield, pts, bound)
+
+    def march_occupancy(self, rays_o, rays_d, near, far, bound):
+        # rays_o, rays_d: [N, 3], near, far: [N, 1]
+        # return: bins [N, S + 1] in [near, far], occupied [N, S], with S = 2 steps per grid cell.
+        # hierarchical: only the rays that cross an occupied cell of the coarsest mip are marched at full resolution.
+        if not self.bitfield_ready:
+            self.update_bitfield()
+        coarse = self.density_bitfield.shape[0] - 1
+        _, occupied_coarse = march_bitfield(self.density_bitfield, rays_o, rays_d, near, far, bound, level=coarse)
+        rays_hit = occupied_coarse.any(dim=-1).nonzero(as_tuple=True)[0]
+
+        bins = near + (far - near) * torch.linspace(0.0, 1.0, 2 * (self.density_grid.shape[1] - 1) + 1, device=rays_o.device).unsqueeze(0) # [N, S + 1]
+        occupied = torch.zeros(bins.shape[0], bins.shape[1] - 1, dtype=torch.bool, device=rays_o.device)
+        if rays_hit.shape[0] > 0:
+            occupied[rays_hit] = march_bitfield(self.density_bitfield, rays_o[rays_hit], rays_d[rays_hit], near[rays_hit], far[rays_hit], bound)[1]
+        return bins, occupied
+
+    def shade_samples(self, pts, dirs, deltas, bound, cos_anneal_ratio, normal_epsilon_ratio):
+        # pts, dirs: [M, 3], deltas: [M, 1]
+        # return: query of query_sdf (sdf, feature, gradient, normal, ...), color [M, 3], alpha [M, 1]
+
+        # sdf, features, normals (and curvature normals) from one fused query
+        query = self.query_sdf(pts, bound, 0.005 * (1.0 - normal_epsilon_ratio),
+                               curvature_epsilon = 0.01 * (1.0 - normal_epsilon_ratio) if self.curvature_loss else None,
+                               finite_difference = not self.analytic_gradient)
+        sdf = query['sdf']
+        feature_vector = query['feature']
+        normal = query['normal']
+
+        color = self.forward_color(pts, dirs, normal.reshape(-1, 3), feature_vector, bound)
+
+        inv_s = self.forward_variance()     # Single parameter
+        inv_s = inv_s.expand(pts.shape[0], 1)
+
+        true_cos = (dirs * normal).sum(-1, keepdim=True)
+    
+        # "cos_anneal_ratio" grows from 0 to 1 in the beginning training iterations. The anneal strategy below makes
+        # the cos value "not dead" at the beginning training iterations, for better convergence.
+        # version relu
+        # iter_cos = -(F.relu(-true_cos * 0.5 + 0.5) * (1.0 - cos_anneal_ratio) +
+        #             F.relu(-true_cos) * cos_anneal_ratio)  # always non-positive
+        
+        # version Softplus
+        activation = nn.Softplus(beta=100)
+        iter_cos = -(activation(-true_cos * 0.5 + 0.5) * (1.0 - cos_anneal_ratio) +
+                    activation(-true_cos) * cos_anneal_ratio)  # always non-positive
+
+        # Estimate signed distances at section points
+        estimated_next_sdf = sdf + iter_cos * deltas * 0.5
+        estimated_prev_sdf = sdf - iter_cos * deltas * 0.5
+
+        prev_cdf = torch.sigmoid(estimated_prev_sdf * inv_s)
+        next_cdf = torch.sigmoid(estimated_next_sdf * inv_s)
+
+        # Equation 13 in NeuS
+        alpha = ((prev_cdf - next_cdf + 1e-5) / (prev_cdf + 1e-5)).clip(0.0, 1.0)
+
+        return query, color, alpha
+
+    def composite_segments(self, pts, dirs, deltas, z_vals, bound, cos_anneal_ratio, normal_epsilon_ratio, min_transmittance, segment_steps):
+        # inference early ray termination: the samples are shaded segment_steps at a time along the rays, and a ray
+        # stops once its transmittance falls below min_transmittance (the alive rays are compacted between segments).
+        # pts, dirs: [N, T, 3], deltas, z_vals: [N, T], z_vals normalized to [0, 1] for the depth
+        # return: weights_sum [N, 1], image [N, 3], normal_map [N, 3], depth [N]
+        N, T = deltas.shape
+        device = pts.device
+
+        weights_sum = torch.zeros(N, 1, device=device)
+        image = torch.zeros(N, 3, device=device)
+        normal_map = torch.zeros(N, 3, device=device)
+        depth = torch.zeros(N, device=device)
+
+        transmittance = torch.ones(N, 1, device=device)
+        rays_alive = torch.arange(N, device=device)
+
+        for head in range(0, T, segment_steps):
+            tail = min(head + segment_steps, T)
+            n, S = rays_alive.shape[0], tail - head
+
+            query, color, alpha = self.shade_samples(pts[rays_alive, head:tail].reshape(-1, 3), dirs[rays_alive, head:tail].reshape(-1, 3),
+                                                     deltas[rays_alive, head:tail].reshape(-1, 1), bound, cos_anneal_ratio, normal_epsilon_ratio)
+            alpha = alpha.reshape(n, S).float()
+
+            # transmittance carried over from the previous segments
+            T_seg = transmittance[rays_alive] * torch.cumprod(torch.cat([torch.ones([n, 1], device=device), 1. - alpha + 1e-7], -1), -1) # [n, S + 1]
+            weights = alpha * T_seg[:, :-1]
+
+            weights_sum.index_add_(0, rays_alive, weights.sum(dim=-1, keepdim=True))
+            image.index_add_(0, rays_alive, (color.reshape(n, S, 3).float() * weights[:, :, None]).sum(dim=1))
+            normal_map.index_add_(0, rays_alive, (query['normal'].reshape(n, S, 3).float() * weights[:, :, None]).sum(dim=1))
+            depth.index_add_(0, rays_alive, (weights * z_vals[rays_alive, head:tail]).sum(dim=-1))
+
+            # compact, as compact_rays
+            transmittance[rays_alive] = T_seg[:, -1:]
+            rays_alive = rays_alive[T_seg[:, -1] >= min_transmittance]
+            if rays_alive.shape[0] == 0:
+                break
+
+        return weights_sum, image, normal_map, depth
+
+    def run(self, rays_o, rays_d, num_steps, bound, upsample_steps, bg_color, cos_anneal_ratio = 1.0, normal_epsilon_ratio = 1.0, min_transmittance = 0.0, segment_steps = 16):
         # rays_o, rays_d: [B, N, 3], assumes B == 1
         # bg_color: [3] in range [0, 1]
+        # min_transmittance: inference only, shade in segments of segment_steps samples and stop the rays whose
+        #   transmittance falls below it (0 = shade all samples).
         # return: image: [B, N, 3], depth: [B, N]
 
         B, N = rays_o.shape[:2]
@@ -133,15 +356,44 @@ class NeRFRenderer(nn.Module):
 
         # sample steps
         near, far = near_far_from_bound(rays_o, rays_d, bound, type='cube')
-     
-        z_vals = torch.linspace(0.0, 1.0, num_steps, device=device).unsqueeze(0)# [1, T]
-        z_vals = z_vals.expand((N, num_steps)) # [N, T]
-        z_vals = near + (far - near) * z_vals # [N, T], in [near, far]
 
-        # perturb z_vals
-        sample_dist = (far - near) / num_steps
-        if self.training:
-            z_vals = z_vals + (torch.rand(z_vals.shape, device=device) - 0.5) * sample_dist
+        # the grid is empty until the first update_extra_state.
+        skip_empty = self.skip_empty and not self.cuda_ray and self.mean_density > 0
+        if skip_empty:
+            # skip empty space: rays that only cross empty cells are background and never reach the network,
+            # the samples of the other rays are only placed in occupied cells.
+            bins, occupied = self.march_occupancy(rays_o, rays_d, near, far, bound) # [N, S + 1], [N, S]
+            rays_hit = occupied.any(dim=-1).nonzero(as_tuple=True)[0] # [N']
+            if rays_hit.shape[0] == 0 and self.training:
+                # no ray crosses an occupied cell (e.g. a sparse early grid): sample the batch densely,
+                # so the training step still reaches the network.
+                skip_empty = False
+
+        if skip_empty:
+            N_all = N
+            N = rays_hit.shape[0]
+            rays_o, rays_d, near, far, bins, occupied = rays_o[rays_hit], rays_d[rays_hit], near[rays_hit], far[rays_hit], bins[rays_hit], occupied[rays_hit]
+
+            if N == 0:
+                if bg_color is None:
+                    bg_color = 1
+                image = torch.ones(B, N_all, 3, device=device) * bg_color
+                return torch.zeros(B, N_all, device=device), image, torch.zeros(B, N_all, 3, device=device), 0.0, 0.0
+
+            z_vals = sample_pdf(bins, occupied.float(), num_steps, det=not self.training) # [N, T]
+            z_vals, _ = torch.sort(z_vals, dim=-1)
+
+            # a sample stands for at most one occupancy step, so deltas never span an empty gap.
+            sample_dist = bins[:, 1:2] - bins[:, :1]
+        else:
+            z_vals = torch.linspace(0.0, 1.0, num_steps, device=device).unsqueeze(0)# [1, T]
+            z_vals = z_vals.expand((N, num_steps)) # [N, T]
+            z_vals = near + (far - near) * z_vals # [N, T], in [near, far]
+
+            # perturb z_vals
+            sample_dist = (far - near) / num_steps
+            if self.training:
+                z_vals = z_vals + (torch.rand(z_vals.shape, device=device) - 0.5) * sample_dist
 
         # generate pts
         pts = rays_o.unsqueeze(-2) + rays_d.unsqueeze(-2) * z_vals.unsqueeze(-1) # [N, 1, 3] * [N, T, 3] -> [N, T, 3]
@@ -163,6 +415,8 @@ class NeRFRenderer(nn.Module):
 
         ### render core
         deltas = z_vals[:, 1:] - z_vals[:, :-1] # [N, T-1]
+        if skip_empty:
+            deltas = torch.minimum(deltas, sample_dist)
         deltas = torch.cat([deltas, sample_dist * torch.ones_like(deltas[:, :1])], dim=-1)
 
         # sample pts on new z_vals
@@ -175,99 +429,83 @@ class NeRFRenderer(nn.Module):
         # only forward new points to save computation
         new_dirs = rays_d.unsqueeze(-2).expand_as(new_pts)
 
-        sdf_nn_output = self.forward_sdf(new_pts.reshape(-1, 3), bound)
-        sdf = sdf_nn_output[:, :1]
-        feature_vector = sdf_nn_output[:, 1:]
-
-        gradient = self.gradient(new_pts.reshape(-1, 3), bound, 0.005 * (1.0 - normal_epsilon_ratio)).squeeze()
-        normal =  gradient / (1e-5 + torch.linalg.norm(gradient, ord=2, dim=-1,  keepdim = True))
-
-        color = self.forward_color(new_pts.reshape(-1, 3), new_dirs.reshape(-1, 3), normal.reshape(-1, 3), feature_vector, bound)
-
-        inv_s = self.forward_variance()     # Single parameter
-        inv_s = inv_s.expand(N * num_steps, 1)
-
-        true_cos = (new_dirs.reshape(-1, 3) * normal).sum(-1, keepdim=True)
-    
-        # "cos_anneal_ratio" grows from 0 to 1 in the beginning training iterations. The anneal strategy below makes
-        # the cos value "not dead" at the beginning training iterations, for better convergence.
-        # version relu
-        # iter_cos = -(F.relu(-true_cos * 0.5 + 0.5) * (1.0 - cos_anneal_ratio) +
-        #             F.relu(-true_cos) * cos_anneal_ratio)  # always non-positive
-        
-        # version Softplus
-        activation = nn.Softplus(beta=100)
-        iter_cos = -(activation(-true_cos * 0.5 + 0.5) * (1.0 - cos_anneal_ratio) +
-                    activation(-true_cos) * cos_anneal_ratio)  # always non-positive
-
-        # Estimate signed distances at section points
-        estimated_next_sdf = sdf + iter_cos * deltas.reshape(-1, 1) * 0.5
-        estimated_prev_sdf = sdf - iter_cos * deltas.reshape(-1, 1) * 0.5
-
-        prev_cdf = torch.sigmoid(estimated_prev_sdf * inv_s)
-        next_cdf = torch.sigmoid(estimated_next_sdf * inv_s)
-
-        # Equation 13 in NeuS
-        alpha = ((prev_cdf - next_cdf + 1e-5) / (prev_cdf + 1e-5)).reshape(N, num_steps).clip(0.0, 1.0)
+        if min_transmittance > 0 and not self.training:
+            ori_z_vals = ((z_vals - near) / (far - near)).clamp(0, 1)
+            weights_sum, image, normal_map, depth = self.composite_segments(new_pts, new_dirs, deltas, ori_z_vals, bound, cos_anneal_ratio, normal_epsilon_ratio,
+                                                                            min_transmittance, segment_steps)
+            gradient_error = 0.0
+            curvature_error = 0.0
+        else:
+            query, color, alpha = self.shade_samples(new_pts.reshape(-1, 3), new_dirs.reshape(-1, 3), deltas.reshape(-1, 1), bound, cos_anneal_ratio, normal_epsilon_ratio)
+            gradient = query['gradient']
+            normal = query['normal']
+            alpha = alpha.reshape(N, num_steps)
 
-        weights = alpha * torch.cumprod(torch.cat([torch.ones([N, 1],device=alpha.device), 1. - alpha + 1e-7], -1), -1)[:, :-1]
+            weights = alpha * torch.cumprod(torch.cat([torch.ones([N, 1],device=alpha.device), 1. - alpha + 1e-7], -1), -1)[:, :-1]
 
-        weights_sum = weights.sum(dim=-1, keepdim=True)
-        # calculate color 
-        color = color.reshape(N, num_steps, 3) # [N, T, 3]
-        image = (color * weights[:, :, None]).sum(dim=1)
+            weights_sum = weights.sum(dim=-1, keepdim=True)
+            # calculate color 
+            color = color.reshape(N, num_steps, 3) # [N, T, 3]
+            image = (color * weights[:, :, None]).sum(dim=1)
 
-        # calculate normal 
-        normal_map = normal.reshape(N, num_steps, 3) # [N, T, 3]
-        normal_map = torch.sum(normal_map * weights[:, :, None], dim=1)
+            # calculate normal 
+            normal_map = normal.reshape(N, num_steps, 3) # [N, T, 3]
+            normal_map = torch.sum(normal_map * weights[:, :, None], dim=1)
         
-        # calculate depth 
-        ori_z_vals = ((z_vals - near) / (far - near)).clamp(0, 1)
-        depth = torch.sum(weights * ori_z_vals, dim=-1)
+            # calculate depth 
+            ori_z_vals = ((z_vals - near) / (far - near)).clamp(0, 1)
+            depth = torch.sum(weights * ori_z_vals, dim=-1)
 
-        # TODO:Eikonal loss 
-        pts_norm = torch.linalg.norm(new_pts.reshape(-1, 3), ord=2, dim=-1, keepdim=True).reshape(N, num_steps)
-        inside_sphere = (pts_norm < 1.0).float().detach()
-        relax_inside_sphere = (pts_norm < 1.2).float().detach()
+            # TODO:Eikonal loss 
+            pts_norm = torch.linalg.norm(new_pts.reshape(-1, 3), ord=2, dim=-1, keepdim=True).reshape(N, num_steps)
+            inside_sphere = (pts_norm < 1.0).float().detach()
+            relax_inside_sphere = (pts_norm < 1.2).float().detach()
 
-        gradient_error = (torch.linalg.norm(gradient.reshape(N, num_steps, 3), ord=2,
-                                            dim=-1) - 1.0) ** 2
-        gradient_error = (relax_inside_sphere * gradient_error).sum() / (relax_inside_sphere.sum() + 1e-5)
+            gradient_error = (torch.linalg.norm(gradient.reshape(N, num_steps, 3), ord=2,
+                                                dim=-1) - 1.0) ** 2
+            gradient_error = (relax_inside_sphere * gradient_error).sum() / (relax_inside_sphere.sum() + 1e-5)
 
-        assert (gradient == gradient).all(), 'Nan or Inf found!'
+            assert (gradient == gradient).all(), 'Nan or Inf found!'
 
-        if self.curvature_loss:
-            # TODO:curvature loss 
-            random_vec = 2.0 * torch.randn_like(normal) - 1.0
-            random_vec_norm = random_vec / (1e-5 + torch.linalg.norm(random_vec, ord=2, dim=-1,  keepdim = True))
+            if self.curvature_loss:
+                # TODO:curvature loss 
+                perturbed_normal = query['perturbed_normal']
 
-            perturbed_pts = new_pts.reshape(-1, 3) + torch.cross(normal, random_vec_norm) * 0.01 * (1.0 - normal_epsilon_ratio) # naively set perturbed points, 
-            perturbed_gradient = self.gradient(perturbed_pts.reshape(-1, 3), bound, 0.005 * (1.0 - normal_epsilon_ratio)).squeeze()
-            perturbed_normal =  perturbed_gradient / (1e-5 + torch.linalg.norm(perturbed_gradient, ord=2, dim=-1,  keepdim = True))
-
-            curvature_error = (torch.sum(normal * perturbed_normal, dim = -1) - 1.0) ** 2
-            curvature_error = (relax_inside_sphere * curvature_error.reshape(N, num_steps)).sum() / (relax_inside_sphere.sum() + 1e-5)
-        else:
-            curvature_error = 0.0
+                curvature_error = (torch.sum(normal * perturbed_normal, dim = -1) - 1.0) ** 2
+                curvature_error = (relax_inside_sphere * curvature_error.reshape(N, num_steps)).sum() / (relax_inside_sphere.sum() + 1e-5)
+            else:
+                curvature_error = 0.0
 
         # mix background color
         if bg_color is None:
             bg_color = 1
     
         image = image + (1 - weights_sum) * bg_color
+
+        if skip_empty:
+            # scatter back, the skipped rays are pure background.
+            depth = torch.zeros(N_all, device=device, dtype=depth.dtype).index_copy(0, rays_hit, depth)
+            image = (torch.ones(N_all, 3, device=device, dtype=image.dtype) * bg_color).index_copy(0, rays_hit, image)
+            normal_map = torch.zeros(N_all, 3, device=device, dtype=normal_map.dtype).index_copy(0, rays_hit, normal_map)
+            N = N_all
         
         depth = depth.reshape(B, N)
         image = image.reshape(B, N, 3)
 
         return depth, image, normal_map, gradient_error, curvature_error
 
-    def run_cuda(self, rays_o, rays_d, num_steps, bound, upsample_steps, bg_color, cos_anneal_ratio, normal_epsilon_ratio):
+    def run_cuda(self, rays_o, rays_d, num_steps, bound, upsample_steps, bg_color, cos_anneal_ratio, normal_epsilon_ratio, sync_every=1, exact_march=False):
         # rays_o, rays_d: [B, N, 3], assumes B == 1
+        # sync_every: inference only, read the alive ray count back to the host every this many compactions (1 = every step).
+        # exact_march: training only, count the points before marching instead of using mean_count (no dropped rays).
         # return: image: [B, N, 3], depth: [B, N]
 
         B, N = rays_o.shape[:2]
         device = rays_o.device
 
+        # the pytorch reference ops (raymarching_torch.py) run the same loop on CPU.
+        ops = raymarching if rays_o.is_cuda else raymarching_torch
+
         if bg_color is None:
             bg_color = 1
 
@@ -277,18 +515,15 @@ class NeRFRenderer(nn.Module):
             counter.zero_() # set to 0
             self.local_step += 1
 
-            xyzs, dirs, deltas, rays = raymarching.march_rays_train(rays_o, rays_d, bound, self.density_grid, self.mean_density, self.iter_density, counter, self.mean_count, self.training, 128, False)
-
-            sdf_nn_output = self.forward_sdf(xyzs, bound).float()
-            sdf = sdf_nn_output[:, :1]
-            feature_vector = sdf_nn_output[:, 1:]
-            
+            # before mean_count is measured, count the points rather than allocating 1024 per ray.
+            exact = exact_march or self.mean_count <= 0
+            xyzs, dirs, deltas, rays = ops.march_rays_train(rays_o, rays_d, bound, self.density_grid[-1], self.mean_density, self.iter_density, counter, self.mean_count, self.training, 128, False, exact, self.buffer_pool, self.dropped_counter)
 
-            # gradient_ = self.gradient(xyzs, bound).squeeze()
-            # normal_ =  gradient_ / (1e-5 + torch.linalg.norm(gradient_, ord=2, dim=-1,  keepdim = True))
-
-            gradient = self.finite_difference_normals_approximator(xyzs, bound, 0.005 * (1.0 - normal_epsilon_ratio)).float() #  
-            normal =  gradient / (1e-5 + torch.linalg.norm(gradient, ord=2, dim=-1,  keepdim = True))
+            query = self.query_sdf(xyzs, bound, 0.005 * (1.0 - normal_epsilon_ratio))
+            sdf = query['sdf'].float()
+            feature_vector = query['feature'].float()
+            gradient = query['gradient'].float()
+            normal = query['normal'].float()
 
             rgbs = self.forward_color(xyzs, dirs, normal, feature_vector, bound).float()
             inv_s = self.forward_variance()     # Single parameter
@@ -309,7 +544,7 @@ class NeRFRenderer(nn.Module):
             # Equation 13 in NeuS
             alpha = ((prev_cdf - next_cdf + 1e-5) / (prev_cdf + 1e-5)).clip(0.0, 1.0)
 
-            weights_sum, image = raymarching.composite_rays_train(alpha, rgbs, deltas, rays, bound)
+            weights_sum, image = ops.composite_rays_train(alpha, rgbs, deltas, rays, bound)
 
             # composite bg (shade_kernel_nerf)
             image = image + (1 - weights_sum).unsqueeze(-1) * bg_color
@@ -331,23 +566,28 @@ class NeRFRenderer(nn.Module):
             # if use autocast, must init as half so it won't be autocasted and lose reference.
             dtype = torch.half if torch.is_autocast_enabled() else torch.float32
             
-            weights_sum = torch.zeros(B * N, dtype=dtype, device=device)
-            depth = torch.zeros(B * N, dtype=dtype, device=device)
-            image = torch.zeros(B * N, 3, dtype=dtype, device=device)
-            normal_map = torch.zeros(B * N, 3, dtype=dtype, device=device)
+            # one extra dummy ray (id B * N) that never marches: between two syncs n_alive is only an upper bound,
+            # and the stale slots behind the compacted rays point to it.
+            dummy = B * N
+            weights_sum = self.buffer_pool.take('weights_sum', [B * N + 1], dtype, device, fill=0)
+            depth = self.buffer_pool.take('depth', [B * N + 1], dtype, device, fill=0)
+            image = self.buffer_pool.take('image', [B * N + 1, 3], dtype, device, fill=0)
+            normal_map = self.buffer_pool.take('normal_map', [B * N + 1, 3], dtype, device, fill=0)
 
             gradient_error = 0.0
             
             n_alive = B * N
             alive_counter = torch.zeros([1], dtype=torch.int32, device=device)
 
-            rays_alive = torch.zeros(2, n_alive, dtype=torch.int32, device=device) # 2 is used to loop old/new
-            rays_t = torch.zeros(2, n_alive, dtype=dtype, device=device)
+            rays_alive = [self.buffer_pool.take(f'rays_alive_{k}', [n_alive], torch.int32, device, fill=dummy) for k in range(2)] # 2 is used to loop old/new
+            rays_t = [self.buffer_pool.take(f'rays_t_{k}', [n_alive], dtype, device, fill=-1) for k in range(2)]
 
             # pre-calculate near far
             near, far = near_far_from_bound(rays_o, rays_d, bound, type='cube')
-            near = near.view(B * N)
-            far = far.view(B * N)
+            near = torch.cat([near.view(B * N), near.new_zeros(1)])
+            far = torch.cat([far.view(B * N), near.new_full((1,), -float('inf'))])
+            rays_o = torch.cat([rays_o.view(B * N, 3), rays_o.new_zeros(1, 3)])
+            rays_d = torch.cat([rays_d.view(B * N, 3), rays_d.new_zeros(1, 3)])
 
             step = 0
             i = 0
@@ -357,11 +597,16 @@ class NeRFRenderer(nn.Module):
                 if step == 0:
                     # init rays at first step.
                     torch.arange(n_alive, out=rays_alive[0])
-                    rays_t[0] = near
+                    rays_t[0].copy_(near[:B * N])
                 else:
+                    if sync_every > 1:
+                        # n_alive may be stale, reset the slots behind the compacted rays to the dummy ray.
+                        rays_alive[i % 2].fill_(dummy)
+                        rays_t[i % 2].fill_(-1)
                     alive_counter.zero_()
-                    raymarching.compact_rays(n_alive, rays_alive[i % 2], rays_alive[(i + 1) % 2], rays_t[i % 2], rays_t[(i + 1) % 2], alive_counter)
-                    n_alive = alive_counter.item() # must invoke D2H copy here
+                    ops.compact_rays(n_alive, rays_alive[i % 2], rays_alive[(i + 1) % 2], rays_t[i % 2], rays_t[(i + 1) % 2], alive_counter)
+                    if i % sync_every == 0:
+                        n_alive = alive_counter.item() # must invoke D2H copy here
                 
                 # exit loop
                 if n_alive <= 0:
@@ -370,17 +615,13 @@ class NeRFRenderer(nn.Module):
                 # decide compact_steps
                 n_step = max(min(B * N // n_alive, 8), 1)
 
-                xyzs, dirs, deltas = raymarching.march_rays(n_alive, n_step, rays_alive[i % 2], rays_t[i % 2], rays_o, rays_d, bound, self.density_grid, self.mean_density, near, far, 128)
+                xyzs, dirs, deltas = ops.march_rays(n_alive, n_step, rays_alive[i % 2], rays_t[i % 2], rays_o, rays_d, bound, self.density_grid[-1], self.mean_density, near, far, 128)
                 #sigmas, rgbs = self(xyzs, dirs, bound=bound)
-                sdf_nn_output = self.forward_sdf(xyzs, bound).float()
-                sdf = sdf_nn_output[:, :1]
-                feature_vector = sdf_nn_output[:, 1:]
-
-                # gradient_ = self.gradient(xyzs, bound).squeeze()
-                # normal_ =  gradient_ / (1e-5 + torch.linalg.norm(gradient_, ord=2, dim=-1,  keepdim = True))
-
-                gradient = self.finite_difference_normals_approximator(xyzs, bound, 0.005 * (1.0 - normal_epsilon_ratio)).float() #  
-                normal =  gradient / (1e-5 + torch.linalg.norm(gradient, ord=2, dim=-1,  keepdim = True))
+                query = self.query_sdf(xyzs, bound, 0.005 * (1.0 - normal_epsilon_ratio))
+                sdf = query['sdf'].float()
+                feature_vector = query['feature'].float()
+                gradient = query['gradient'].float()
+                normal = query['normal'].float()
 
                 rgbs = self.forward_color(xyzs, dirs, normal, feature_vector, bound).float()
 
@@ -403,11 +644,15 @@ class NeRFRenderer(nn.Module):
                 # Equation 13 in NeuS
                 alpha = ((prev_cdf - next_cdf + 1e-5) / (prev_cdf + 1e-5)).clip(0.0, 1.0)
 
-                raymarching.composite_rays(n_alive, n_step, rays_alive[i % 2], rays_t[i % 2], alpha, rgbs, normal, deltas, weights_sum, depth, image, normal_map)
+                ops.composite_rays(n_alive, n_step, rays_alive[i % 2], rays_t[i % 2], alpha, rgbs, normal, deltas, weights_sum, depth, image, normal_map)
                 #print(f'step = {step}, n_step = {n_step}, n_alive = {n_alive}')
                 step += n_step
                 i += 1
 
+            # the pooled outputs are reused by the next call, image and depth are new tensors below.
+            weights_sum, depth, image, normal_map = weights_sum[:B * N], depth[:B * N], image[:B * N], normal_map[:B * N].clone()
+            near, far = near[:B * N], far[:B * N]
+
             # composite bg & rectify depth (shade_kernel_nerf)
             image = image + (1 - weights_sum).unsqueeze(-1) * bg_color
             depth = torch.clamp(depth - near, min=0) / (far - near)
@@ -421,97 +666,169 @@ class NeRFRenderer(nn.Module):
 
         return depth, image, normal_map, gradient_error, 0
 
-    def update_extra_state(self, bound, decay=0.95):
-        # call before each epoch to update extra states.
+    def update_extra_state(self, bound, decay=0.95, update_fraction=1/16, S=128, verbose=True):
+        # call every 16 training steps to update extra states (the Trainer's update_extra_interval).
+        # the density grid is updated incrementally (as instant-ngp): the first call queries every cell, later calls
+        # only a random update_fraction of the cells plus all the occupied ones, so the cost follows the occupied volume.
+        # update_fraction = 1/16 with an update every 16 steps visits every cell about once per 256 steps.
+        # verbose: print the grid stats.
 
-        if not self.cuda_ray:
+        if not (self.cuda_ray or self.skip_empty):
             return 
         
         ### update density grid
-        resolution = self.density_grid.shape[0]
-        
-        X = torch.linspace(-bound, bound, resolution).split(128)
-        Y = torch.linspace(-bound, bound, resolution).split(128)
-        Z = torch.linspace(-bound, bound, resolution).split(128)
+        C, resolution = self.density_grid.shape[:2]
+        n_cells = C * resolution ** 3
+        device = self.density_grid.device
+        extents = torch.tensor(cascade_extents(bound, C), device=device) # [C]
+
+        if self.iter_density == 0:
+            indices = torch.arange(n_cells, device=device)
+        else:
+            density_thresh = min(10, self.mean_density)
+            occupied = (self.density_grid.view(-1) > density_thresh).nonzero(as_tuple=True)[0]
+            random = torch.randint(0, n_cells, (int(n_cells * update_fraction),), device=device)
+            indices = torch.cat([random, occupied])
 
-        tmp_grid = torch.zeros_like(self.density_grid)
+        # cells not updated this time stay at -1.
+        tmp_grid = -torch.ones_like(self.density_grid)
+        inv_s = 512.0#self.forward_variance().detach() / 10    # Single parameter
 
         with torch.no_grad():
-            for xi, xs in enumerate(X):
-                for yi, ys in enumerate(Y):
-                    for zi, zs in enumerate(Z):
-                        lx, ly, lz = len(xs), len(ys), len(zs)
-                        xx, yy, zz = torch.meshgrid(xs, ys, zs)
-                        pts = torch.cat([xx.reshape(-1, 1), yy.reshape(-1, 1), zz.reshape(-1, 1)], dim=-1) # [N, 3]
-                        # manual padding for ffmlp
-                        n = pts.shape[0]
-                        pad_n = 128 - (n % 128)
-                        if pad_n != 0:
-                            pts = torch.cat([pts, torch.zeros(pad_n, 3)], dim=0)
-
-                        sdf = self.density(pts.to(tmp_grid.device), bound)[:n].detach().float()
-                        inv_s = 512.0#self.forward_variance().detach() / 10    # Single parameter
-
-                        #density = -1.0 * sdf
-                        mask = sdf > 0
-                        density = torch.zeros_like(sdf)
-                        density[mask] = inv_s * torch.exp(-inv_s * sdf[mask]) / (1 + torch.exp( - inv_s * sdf[mask]))
-                        density[~mask] = inv_s * torch.exp(inv_s * sdf[~mask]) / (1 + torch.exp(inv_s * sdf[~mask]))
-                        tmp_grid[xi * 128: xi * 128 + lx, yi * 128: yi * 128 + ly, zi * 128: zi * 128 + lz] = density.reshape(lx, ly, lz)
+            for head in range(0, indices.shape[0], S ** 3):
+                inds = indices[head: head + S ** 3]
+                # cell index to grid vertex of its cascade, built on device
+                cascade, cell = inds // resolution ** 3, inds % resolution ** 3
+                coords = torch.stack([cell // (resolution * resolution), (cell // resolution) % resolution, cell % resolution], dim=-1) # [N, 3]
+                pts = (coords.float() / (resolution - 1) * 2 - 1) * extents[cascade].unsqueeze(-1)
+                # manual padding for ffmlp
+                n = pts.shape[0]
+                pts = F.pad(pts, (0, 0, 0, (-n) % 128))
+
+                sdf = self.density(pts, bound)[:n].detach().float().reshape(-1) # [N] or [N, 1] depending on the network
+
+                # inv_s * exp(-inv_s * |sdf|) / (1 + exp(-inv_s * |sdf|))
+                density = inv_s * torch.sigmoid(-inv_s * sdf.abs())
+                tmp_grid.view(-1)[inds] = density
         
         # smooth by maxpooling
-        tmp_grid = F.pad(tmp_grid, (0, 1, 0, 1, 0, 1))
-        tmp_grid = F.max_pool3d(tmp_grid.unsqueeze(0).unsqueeze(0), kernel_size=2, stride=1).squeeze(0).squeeze(0)
+        tmp_grid = F.pad(tmp_grid, (0, 1, 0, 1, 0, 1), value=-1)
+        tmp_grid = F.max_pool3d(tmp_grid.unsqueeze(1), kernel_size=2, stride=1).squeeze(1)
 
-        # ema update
-        self.density_grid = torch.maximum(self.density_grid * decay, tmp_grid)
-        self.mean_density = torch.mean(self.density_grid).item()
+        # ema update, only on the cells (and their smoothed neighbours) queried this time
+        valid_mask = tmp_grid >= 0
+        self.density_grid[valid_mask] = torch.maximum(self.density_grid[valid_mask] * decay, tmp_grid[valid_mask])
+        self.mean_density = torch.mean(self.density_grid[-1]).item()
         self.iter_density += 1
 
+        if self.skip_empty and not self.cuda_ray:
+            self.update_bitfield()
+
+        if not self.cuda_ray:
+            if verbose:
+                print(f'[density grid] min={self.density_grid.min().item():.4f}, max={self.density_grid.max().item():.4f}, mean={self.mean_density:.4f} | [SDF] inv_s={inv_s:.4f}')
+            return
+
         ### update step counter
         total_step = min(64, self.local_step)
         if total_step > 0:
             self.mean_count = int(self.step_counter[:total_step, 0].sum().item() / total_step)
         self.local_step = 0
 
-        print(f'[density grid] min={self.density_grid.min().item():.4f}, max={self.density_grid.max().item():.4f}, mean={self.mean_density:.4f} | [step counter] mean={self.mean_count} | [SDF] inv_s={inv_s:.4f}')
+        self.dropped_rays = self.dropped_counter.item()
+        self.dropped_counter.zero_()
+
+        if verbose:
+            print(f'[density grid] min={self.density_grid.min().item():.4f}, max={self.density_grid.max().item():.4f}, mean={self.mean_density:.4f} | [step counter] mean={self.mean_count} | [dropped rays] {self.dropped_rays} | [SDF] inv_s={inv_s:.4f}')
 
-    def render(self, rays_o, rays_d, num_steps, bound, upsample_steps, staged=False, max_ray_batch=4096, bg_color=None, cos_anneal_ratio = 1.0, normal_epsilon_ratio = 1.0, **kwargs):
+    def trim_buffer_pool(self, max_bytes=0):
+        # release the pooled run_cuda tensors down to max_bytes (0 = all), e.g. between training and serving.
+        self.buffer_pool.trim(max_bytes)
+
+    def staged_batch_size(self, bytes_per_ray, device, batch_size, memory_fraction):
+        # number of rays per chunk that fits in memory_fraction of the free device memory, at most twice the previous chunk.
+        # bytes_per_ray is measured on the previous chunk, so it accounts for num_steps, upsampling and the normals.
+        if hasattr(torch.cuda, 'mem_get_info'):
+            free, _ = torch.cuda.mem_get_info(device)
+        else:
+            free = torch.cuda.get_device_properties(device).total_memory - torch.cuda.memory_reserved(device)
+        # memory cached by the allocator can be reused as well.
+        free += torch.cuda.memory_reserved(device) - torch.cuda.memory_allocated(device)
+        return max(min(int(free * memory_fraction / max(bytes_per_ray, 1)), 2 * batch_size), 1)
+
+    def render(self, rays_o, rays_d, num_steps, bound, upsample_steps, staged=False, max_ray_batch=4096, bg_color=None, cos_anneal_ratio = 1.0, normal_epsilon_ratio = 1.0, memory_fraction=0.8, sync_every=1, exact_march=False, min_transmittance=0.0, segment_steps=16, **kwargs):
         # rays_o, rays_d: [B, N, 3], assumes B == 1
+        # memory_fraction: staged chunks are sized to this fraction of the free GPU memory, 0 to use max_ray_batch chunks.
+        # sync_every: cuda_ray inference, host syncs of the alive ray count, every this many compactions.
+        # exact_march: cuda_ray training, size the points buffer exactly (see run_cuda).
+        # min_transmittance, segment_steps: pytorch inference, early ray termination (see run).
         # return: pred_rgb: [B, N, 3]
 
         if self.cuda_ray:
-            _run = self.run_cuda
+            _run = functools.partial(self.run_cuda, sync_every=sync_every, exact_march=exact_march)
         else:
-            _run = self.run
+            _run = functools.partial(self.run, min_transmittance=min_transmittance, segment_steps=segment_steps)
 
         B, N = rays_o.shape[:2]
         device = rays_o.device
 
         # never stage when cuda_ray
         if staged and not self.cuda_ray:
-            depth = torch.empty((B, N), device=device)
-            image = torch.empty((B, N, 3), device=device)
-            normal = torch.empty((B, N, 3), device=device)
+            # all B * N rays are chunked together, outputs are allocated once and filled in place.
+            rays_o = rays_o.reshape(1, B * N, 3)
+            rays_d = rays_d.reshape(1, B * N, 3)
+
+            depth = torch.empty((B * N), device=device)
+            image = torch.empty((B * N, 3), device=device)
+            normal = torch.empty((B * N, 3), device=device)
 
             gradient_error = 0.0
             curvature_error = 0.0 
 
-            for b in range(B):
-                head = 0
-                while head < N:
-                    tail = min(head + max_ray_batch, N)
-
-                    depth_, image_, normal_, gradient_error_, curvature_error_ = _run(rays_o[b:b+1, head:tail], rays_d[b:b+1, head:tail], num_steps, bound, upsample_steps, bg_color, 
-                                                                cos_anneal_ratio = cos_anneal_ratio, normal_epsilon_ratio = normal_epsilon_ratio)
-      
-                    depth[b:b+1, head:tail] = depth_.detach()
-                    image[b:b+1, head:tail] = image_.detach()
-                    normal[b:b+1, head:tail] = normal_.detach()
-                    gradient_error_ = gradient_error_.detach()
-                    head += max_ray_batch
-
-                    del depth_, image_, normal_, gradient_error_, curvature_error_
+            adaptive = memory_fraction > 0 and device.type == 'cuda'
+
+            # the first chunk uses max_ray_batch, later chunks are sized from the measured memory of the previous one.
+            # a chunk that runs out of memory is retried at half its size, and later chunks stay below it.
+            batch_size = max_ray_batch
+            max_batch_size = B * N
+            head = 0
+            while head < B * N:
+                tail = min(head + batch_size, B * N)
+
+                if adaptive:
+                    base_memory = torch.cuda.memory_allocated(device)
+                    peak_memory = torch.cuda.max_memory_allocated(device)
+
+                try:
+                    depth_, image_, normal_, _, _ = _run(rays_o[:, head:tail], rays_d[:, head:tail], num_steps, bound, upsample_steps, bg_color, 
+                                                         cos_anneal_ratio = cos_anneal_ratio, normal_epsilon_ratio = normal_epsilon_ratio)
+                except torch.cuda.OutOfMemoryError:
+                    if tail - head == 1:
+                        raise
+                    max_batch_size = batch_size = (tail - head) // 2
+                    torch.cuda.empty_cache()
+                    continue
+
+                depth[head:tail] = depth_.detach().reshape(-1)
+                image[head:tail] = image_.detach().reshape(-1, 3)
+                normal[head:tail] = normal_.detach().reshape(-1, 3)
+                del depth_, image_, normal_
+
+                if adaptive:
+                    # the peak is not reset per chunk: if it rose, the chunk set the new peak and is measured from it,
+                    # otherwise the chunk stayed below an earlier peak and the next one just grows 2x.
+                    if torch.cuda.max_memory_allocated(device) > peak_memory:
+                        bytes_per_ray = (torch.cuda.max_memory_allocated(device) - base_memory) / (tail - head)
+                        batch_size = self.staged_batch_size(bytes_per_ray, device, tail - head, memory_fraction)
+                    else:
+                        batch_size = 2 * (tail - head)
+                    batch_size = min(batch_size, max_batch_size)
+
+                head = tail
+
+            depth = depth.reshape(B, N)
+            image = image.reshape(B, N, 3)
+            normal = normal.reshape(B, N, 3)
         else:
             depth, image, normal, gradient_error, curvature_error = _run(rays_o, rays_d, num_steps, bound, upsample_steps, bg_color, cos_anneal_ratio, normal_epsilon_ratio)
 
@@ -9,7 +9,10 @@ import numpy as np
 import pandas as pd
 
 import time
+import queue
+import threading
 from datetime import datetime
+from collections import OrderedDict
 
 import cv2
 import matplotlib.pyplot as plt
@@ -52,9 +55,125 @@ def lift(x, y, z, intrinsics):
     # homogeneous
     return torch.stack((x_lift, y_lift, z, torch.ones_like(z)), dim=-1)
 
-def get_rays(c2w, intrinsics, H, W, N_rays=-1):
+def dequantize_image(images):
+    # uint8 images (compact dataset storage) --> float in [0, 1], exactly as the float32 storage path.
+    if images.dtype == torch.uint8:
+        return images.float() / 255
+    return images
+
+def undistort(x, y, distortion, iters=20):
+    # x, y: [...], distorted normalized image coordinates (z = 1)
+    # distortion: [4], k1, k2, p1, p2 of the OpenCV camera model
+    # return: undistorted x, y, by fixed-point iteration (same scheme as cv2.undistortPoints)
+    k1, k2, p1, p2 = distortion[0], distortion[1], distortion[2], distortion[3]
+    xu, yu = x, y
+    for _ in range(iters):
+        r2 = xu * xu + yu * yu
+        radial = 1 + k1 * r2 + k2 * r2 * r2
+        dx = 2 * p1 * xu * yu + p2 * (r2 + 2 * xu * xu)
+        dy = p1 * (r2 + 2 * yu * yu) + 2 * p2 * xu * yu
+        xu = (x - dx) / radial
+        yu = (y - dy) / radial
+    return xu, yu
+
+def camera_key(intrinsic, H, W, distortion=None):
+    # intrinsic: [3, 3], distortion: [4] or None, on the host (numpy or cpu tensor)
+    # return: str, the key of the camera in the direction cache. datasets build it once per view, so the lookup
+    # never reads back device tensors (a str also passes through the default collate unchanged).
+    params = [np.asarray(intrinsic, dtype=np.float32).reshape(-1)]
+    if distortion is not None:
+        params.append(np.asarray(distortion, dtype=np.float32).reshape(-1))
+    return f'{H}x{W}:' + np.concatenate(params).tobytes().hex()
+
+def direction_table(intrinsic, H, W, distortion=None):
+    # intrinsic: [3, 3]
+    # distortion: [4] or None
+    # return: [H * W, 3], camera-space pixel directions
+    j, i = torch.meshgrid(torch.arange(H, dtype=torch.float32, device=intrinsic.device), torch.arange(W, dtype=torch.float32, device=intrinsic.device)) # for torch < 1.10, should remove indexing='ij'
+    i = i.reshape(1, H*W)
+    j = j.reshape(1, H*W)
+    table = lift(i, j, torch.ones_like(i), intrinsics=intrinsic[None].float())[0, :, :3] # [H * W, 3]
+    if distortion is not None:
+        x, y = undistort(table[:, 0], table[:, 1], distortion.float())
+        table = torch.stack([x, y, table[:, 2]], dim=-1)
+    return table
+
+class DirectionCache(object):
+    # LRU cache of camera-space pixel directions [H * W, 3], keyed by camera_key (and device).
+    # with lens distortion, the table doubles as the undistortion map, so the iterative solve runs once per camera.
+    # datasets reserve() one entry per distinct camera, so the tables are not recomputed while iterating the views.
+    # a 4K table is ~100MB.
+    def __init__(self, max_size=8):
+        self.max_size = max_size
+        self.tables = OrderedDict()
+
+    def reserve(self, n):
+        # make room for n distinct cameras.
+        self.max_size = max(self.max_size, n)
+
+    def get(self, key, intrinsic, H, W, distortion=None):
+        # key: camera_key of the camera, None to compute the table without caching it
+        # intrinsic: [3, 3]
+        # distortion: [4] or None
+        if key is None:
+            return direction_table(intrinsic, H, W, distortion)
+        key = (key, str(intrinsic.device))
+        table = self.tables.get(key)
+        if table is None:
+            table = direction_table(intrinsic, H, W, distortion)
+            self.tables[key] = table
+            while len(self.tables) > self.max_size:
+                self.tables.popitem(last=False)
+        else:
+            self.tables.move_to_end(key)
+        return table
+
+    def clear(self):
+        self.tables.clear()
+
+direction_cache = DirectionCache()
+
+
+def get_directions(intrinsics, H, W, distortion=None, cameras=None):
+    # intrinsics: [B, 3, 3]
+    # distortion: [B, 4] or None
+    # cameras: [B] list of camera_key, or None to skip the cache
+    # return: [B, H * W, 3], cached camera-space directions
+    prefix = intrinsics.shape[:-2]
+    intrinsics = intrinsics.reshape(-1, 3, 3)
+    if distortion is not None:
+        distortion = distortion.reshape(-1, 4)
+    directions = torch.stack([direction_cache.get(None if cameras is None else cameras[b], intrinsics[b], H, W, None if distortion is None else distortion[b]) for b in range(intrinsics.shape[0])], dim=0)
+    return directions.reshape(*prefix, H*W, 3)
+
+def build_direction_tables(intrinsics, sizes, distortion=None):
+    # per-view cameras --> unique cameras, for samplers that draw rays from many views at once.
+    # intrinsics: [V, 3, 3]
+    # sizes: [V, 2], per-view H, W (cameras may differ in resolution)
+    # distortion: [V, 4] or None
+    # return: view_offsets: [V], tables: [sum_U(H * W), 3], view v's pixel k is tables[view_offsets[v] + k]
+    params = torch.cat([intrinsics.reshape(-1, 9), sizes.reshape(-1, 2).to(intrinsics.device, intrinsics.dtype)], dim=-1)
+    if distortion is not None:
+        params = torch.cat([params, distortion.reshape(-1, 4).to(params.device, params.dtype)], dim=-1)
+    unique_params, camera_ids = torch.unique(params, dim=0, return_inverse=True)
+    unique_params_cpu = unique_params.cpu() # once per sampler, for the cache keys
+    tables = []
+    camera_offsets = [0]
+    for u in range(unique_params.shape[0]):
+        H, W = int(unique_params_cpu[u, 9]), int(unique_params_cpu[u, 10])
+        key = camera_key(unique_params_cpu[u, :9], H, W, None if distortion is None else unique_params_cpu[u, 11:])
+        tables.append(direction_cache.get(key, unique_params[u, :9].reshape(3, 3), H, W, None if distortion is None else unique_params[u, 11:]))
+        camera_offsets.append(camera_offsets[-1] + H * W)
+    camera_offsets = torch.tensor(camera_offsets[:-1], dtype=torch.int64, device=camera_ids.device)
+    return camera_offsets[camera_ids], torch.cat(tables, dim=0)
+
+def get_rays(c2w, intrinsics, H, W, N_rays=-1, error_map=None, distortion=None, generator=None, cameras=None):
     # c2w: [B, 4, 4]
     # intrinsics: [B, 3, 3]
+    # error_map: [B, R * R], optional sampling weights on a coarse R x R grid (alpha mask prior / per-pixel error)
+    # distortion: [B, 4], optional k1, k2, p1, p2 lens distortion
+    # generator: optional torch.Generator of the pixel draws (None = the global one)
+    # cameras: optional [B] list of camera_key, the direction tables of these cameras are cached
     # return: rays_o, rays_d: [B, N_rays, 3]
     # return: select_inds: [B, N_rays]
 
@@ -62,33 +181,59 @@ def get_rays(c2w, intrinsics, H, W, N_rays=-1):
     rays_o = c2w[..., :3, 3] # [B, 3]
     prefix = c2w.shape[:-2]
 
-    i, j = torch.meshgrid(torch.linspace(0, W-1, W, device=device), torch.linspace(0, H-1, H, device=device)) # for torch < 1.10, should remove indexing='ij'
-    i = i.t().reshape([*[1]*len(prefix), H*W]).expand([*prefix, H*W])
-    j = j.t().reshape([*[1]*len(prefix), H*W]).expand([*prefix, H*W])
-
     if N_rays > 0:
         N_rays = min(N_rays, H*W)
-        select_hs = torch.randint(0, H, size=[N_rays], device=device)
-        select_ws = torch.randint(0, W, size=[N_rays], device=device)
-        select_inds = select_hs * W + select_ws
-        select_inds = select_inds.expand([*prefix, N_rays])
-        i = torch.gather(i, -1, select_inds)
-        j = torch.gather(j, -1, select_inds)
+        if error_map is None:
+            select_hs = torch.randint(0, H, size=[N_rays], device=device, generator=generator)
+            select_ws = torch.randint(0, W, size=[N_rays], device=device, generator=generator)
+            select_inds = select_hs * W + select_ws
+            select_inds = select_inds.expand([*prefix, N_rays])
+        else:
+            # importance sample the coarse cells (like instant-ngp's error map), then uniformly inside each cell.
+            R = int(np.sqrt(error_map.shape[-1]))
+            inds_coarse = torch.multinomial(error_map.to(device), N_rays, replacement=True, generator=generator) # [B, N_rays]
+            sh, sw = H / R, W / R
+            select_hs = ((inds_coarse // R) * sh + torch.rand(inds_coarse.shape, device=device, generator=generator) * sh).long().clamp(max=H - 1)
+            select_ws = ((inds_coarse % R) * sw + torch.rand(inds_coarse.shape, device=device, generator=generator) * sw).long().clamp(max=W - 1)
+            select_inds = select_hs * W + select_ws
+
+        if distortion is None:
+            # only lift the selected pixels, no full H x W grid is built for a training batch.
+            i = (select_inds % W).float()
+            j = (select_inds // W).float()
+            directions = lift(i, j, torch.ones_like(i), intrinsics=intrinsics)[..., :3] # [B, N_rays, 3]
+        else:
+            # gather from the cached undistortion map.
+            directions = get_directions(intrinsics, H, W, distortion, cameras) # [B, H * W, 3]
+            directions = torch.gather(directions, -2, select_inds[..., None].expand(*select_inds.shape, 3)) # [B, N_rays, 3]
     else:
         select_inds = torch.arange(H*W, device=device).expand([*prefix, H*W])
+        # full frame: reuse the cached camera-space direction table.
+        directions = get_directions(intrinsics, H, W, distortion, cameras) # [B, H * W, 3]
 
-    pixel_points_cam = lift(i, j, torch.ones_like(i), intrinsics=intrinsics)
-    pixel_points_cam = pixel_points_cam.transpose(-1, -2)
-
-    world_coords = torch.bmm(c2w, pixel_points_cam).transpose(-1, -2)[..., :3]
-    
-    rays_d = world_coords - rays_o[..., None, :]
+    # rotate into world space: R @ d, equals (c2w @ [d, 1]) - rays_o.
+    rays_d = torch.matmul(directions, c2w[..., :3, :3].transpose(-1, -2))
     rays_d = F.normalize(rays_d, dim=-1)
 
     rays_o = rays_o[..., None, :].expand_as(rays_d)
 
     return rays_o, rays_d, select_inds
 
+def get_rays_from_pixels(c2w, intrinsics, i, j, directions=None):
+    # c2w: [N, 4, 4], one camera per ray
+    # intrinsics: [N, 3, 3]
+    # i, j: [N], pixel coordinates along W and H
+    # directions: [N, 3], optional camera-space directions (e.g. gathered from undistortion tables), replaces lifting i, j
+    # return: rays_o, rays_d: [N, 3]
+
+    if directions is None:
+        directions = lift(i[:, None], j[:, None], torch.ones_like(i[:, None]), intrinsics=intrinsics)[:, 0, :3] # [N, 3]
+
+    rays_o = c2w[:, :3, 3] # [N, 3]
+    rays_d = F.normalize(torch.bmm(c2w[:, :3, :3], directions[:, :, None])[:, :, 0], dim=-1)
+
+    return rays_o, rays_d
+
 
 def extract_fields(bound_min, bound_max, resolution, query_func):
     N = 256
@@ -127,6 +272,84 @@ def extract_geometry(bound_min, bound_max, resolution, threshold, query_func, us
 
 
 
+class BatchPrefetcher(object):
+    # prepares the next num_prefetch batches (host-to-device copy + ray sampling) on a background thread.
+    # on CUDA the work is issued on a side stream, so it overlaps with the model step on the default stream.
+    # without CUDA the thread still overlaps the data loading with the step (torch ops release the GIL).
+    # the random draws of prepare use a generator of the thread seeded by seed, so they don't depend on the
+    # interleaving with the draws of the main thread.
+    def __init__(self, loader, prepare, device, num_prefetch=2, seed=0):
+        self.loader = loader
+        self.prepare = prepare # (data, generator) --> prepared data, called on the background thread
+        self.device = torch.device(device)
+        self.num_prefetch = num_prefetch
+        self.seed = seed
+
+    def __len__(self):
+        return len(self.loader)
+
+    def worker(self, queue_, stop, stream, main_stream):
+        try:
+            generator = torch.Generator(self.device)
+            generator.manual_seed(self.seed)
+            with torch.no_grad():
+                for data in self.loader:
+                    if stop.is_set():
+                        break
+                    event = None
+                    if stream is not None:
+                        # the batch may hold tensors written on the main stream (e.g. error_map rows gathered from the
+                        # dataset while update_error_map rewrites it), wait for them before reading on the side stream.
+                        stream.wait_stream(main_stream)
+                        with torch.cuda.stream(stream):
+                            data = self.prepare(data, generator)
+                            event = torch.cuda.Event()
+                            event.record(stream)
+                    else:
+                        data = self.prepare(data, generator)
+                    queue_.put((data, event))
+            queue_.put(None)
+        except Exception as e:
+            queue_.put(e)
+
+    def record_stream(self, data, stream):
+        # tensors allocated on the side stream are now used on the main stream, tell the caching allocator.
+        values = data.values() if isinstance(data, dict) else (data if isinstance(data, (list, tuple)) else [data])
+        for v in values:
+            if torch.is_tensor(v) and v.is_cuda:
+                v.record_stream(stream)
+
+    def __iter__(self):
+        stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+        main_stream = torch.cuda.current_stream(self.device) if stream is not None else None
+        queue_ = queue.Queue(maxsize=max(self.num_prefetch, 1))
+        stop = threading.Event()
+        thread = threading.Thread(target=self.worker, args=(queue_, stop, stream, main_stream), daemon=True)
+        thread.start()
+
+        try:
+            while True:
+                item = queue_.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                data, event = item
+                if event is not None:
+                    main_stream.wait_event(event)
+                    self.record_stream(data, main_stream)
+                yield data
+        finally:
+            # unblock the worker if the consumer stops early.
+            stop.set()
+            while thread.is_alive():
+                try:
+                    queue_.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            thread.join()
+
+
 class Trainer(object):
     def __init__(self, 
                  name, # name of this experiment
@@ -173,6 +396,7 @@ class Trainer(object):
         self.white_background = white_background
         self.device = device if device is not None else torch.device(f'cuda:{local_rank}' if torch.cuda.is_available() else 'cpu')
         self.console = Console()
+        self.error_map = None
 
         model.to(self.device)
 
@@ -265,17 +489,41 @@ class Trainer(object):
 
     ### ------------------------------	
 
-    def train_step(self, data):
+    def sample_rays(self, data, generator=None):
+        # per-image batch --> rays_o, rays_d, image: [B, N, 3/4] of num_rays sampled pixels.
+        # batches that already hold rays (GlobalRaySampler, RayDataset, or sampled before) are only dequantized.
+        # generator: optional torch.Generator of the pixel draws (the BatchPrefetcher thread has its own)
+        if 'rays_o' in data:
+            data['image'] = dequantize_image(data['image']) # [B, N, 3/4]
+            return data
 
         images = data["image"] # [B, H, W, 3/4]
         poses = data["pose"] # [B, 4, 4]
         intrinsics = data["intrinsic"] # [B, 3, 3]
+        error_map = data.get("error_map", None) # [B, R * R]
+        distortion = data.get("distortion", None) # [B, 4]
 
         # sample rays 
         B, H, W, C = images.shape
-        rays_o, rays_d, inds = get_rays(poses, intrinsics, H, W, self.conf['num_rays'])
+        rays_o, rays_d, inds = get_rays(poses, intrinsics, H, W, self.conf['num_rays'], error_map, distortion, generator, data.get("camera", None))
         images = torch.gather(images.reshape(B, -1, C), 1, torch.stack(C*[inds], -1)) # [B, N, 3/4]
 
+        data['rays_o'] = rays_o # [B, N, 3]
+        data['rays_d'] = rays_d # [B, N, 3]
+        data['image'] = dequantize_image(images) # only the gathered rays are converted if stored as uint8
+        data['inds'] = inds # [B, N]
+        data['shape'] = (H, W)
+        return data
+
+    def train_step(self, data):
+
+        data = self.sample_rays(data) # no-op if already sampled by the BatchPrefetcher
+
+        rays_o = data['rays_o'] # [B, N, 3]
+        rays_d = data['rays_d'] # [B, N, 3]
+        images = data['image'] # [B, N, 3/4]
+        C = images.shape[-1]
+
         # train with random background color if using alpha mixing
         if self.white_background:
             bg_color = torch.ones(3, device=images.device) # [3], fixed white background
@@ -306,16 +554,34 @@ class Trainer(object):
         #loss = self.criterion(pred_rgb, gt_rgb) + 0.1 * eikonal_loss
         loss = self.criterion(pred_rgb, gt_rgb) + 0.1 * eikonal_loss + 0.1 * curvature_loss
 
+        # error-driven sampling: feed the per-ray error back into the sampling map (per-image batches only,
+        # the rays of GlobalRaySampler and RayDataset are not drawn from it).
+        if 'error_map' in data and 'inds' in data and self.conf.get('sample_mode', 'uniform') == 'error':
+            self.update_error_map(data['index'], data['error_map'], data['inds'], pred_rgb, gt_rgb, *data['shape'])
+
         return pred_rgb, gt_rgb, loss
 
+    def update_error_map(self, index, error_map, inds, pred_rgb, gt_rgb, H, W):
+        # error_map: [B, R * R], inds: [B, N], pred_rgb/gt_rgb: [B, N, 3]
+        R = int(np.sqrt(error_map.shape[-1]))
+        error = ((pred_rgb.detach().float() - gt_rgb.float()) ** 2).mean(-1) # [B, N]
+
+        inds_coarse = ((inds // W) * R // H) * R + (inds % W) * R // W # [B, N]
+        ema_error = 0.1 * error_map.gather(1, inds_coarse) + 0.9 * error
+        error_map.scatter_(1, inds_coarse, ema_error)
+
+        # the loader collates a copy, write it back to the dataset.
+        if self.error_map is not None:
+            self.error_map[index.to(self.error_map.device)] = error_map.to(self.error_map.device)
+
     def eval_step(self, data):
-        images = data["image"] # [B, H, W, 3/4]
+        images = dequantize_image(data["image"]) # [B, H, W, 3/4]
         poses = data["pose"] # [B, 4, 4]
         intrinsics = data["intrinsic"] # [B, 3, 3]
 
         # sample rays 
         B, H, W, C = images.shape
-        rays_o, rays_d, _ = get_rays(poses, intrinsics, H, W, -1)
+        rays_o, rays_d, _ = get_rays(poses, intrinsics, H, W, -1, distortion=data.get("distortion", None), cameras=data.get("camera", None))
 
         bg_color = torch.ones(3, device=images.device) # [3]
         # eval with fixed background color
@@ -351,7 +617,7 @@ class Trainer(object):
 
         B = poses.shape[0]
 
-        rays_o, rays_d, _ = get_rays(poses, intrinsics, H, W, -1)
+        rays_o, rays_d, _ = get_rays(poses, intrinsics, H, W, -1, distortion=data.get("distortion", None), cameras=data.get("camera", None))
 
         if bg_color is not None:
             bg_color = bg_color.to(rays_o.device)
@@ -430,6 +696,9 @@ class Trainer(object):
     ### ------------------------------
 
     def train(self, train_loader, valid_loader, max_epochs):
+        # error map of the training set, updated in train_step if sample_mode == 'error'
+        self.error_map = getattr(getattr(train_loader, 'dataset', None), 'error_map', None)
+
         if self.use_tensorboardX and self.local_rank == 0:
             self.writer = tensorboardX.SummaryWriter(os.path.join(self.workspace, "run", self.name))
         
@@ -491,9 +760,10 @@ class Trainer(object):
     def train_gui(self, train_loader, step=16):
 
         self.model.train()
+        self.error_map = getattr(getattr(train_loader, 'dataset', None), 'error_map', None)
 
-        # update grid
-        if self.model.cuda_ray:
+        # update grid (cuda_ray, or skip_empty in the pytorch run)
+        if hasattr(self.model, 'density_grid'):
             with torch.cuda.amp.autocast(enabled=self.fp16):
                 self.model.update_extra_state(self.conf['bound'])
 
@@ -555,6 +825,7 @@ class Trainer(object):
             'intrinsic': intrinsics[None, :],
             'H': [str(H)],
             'W': [str(W)],
+            'camera': [camera_key(intrinsics, H, W)], # intrinsics of the gui camera are on the host
         }
 
         data = self.prepare_data(data)
@@ -610,22 +881,35 @@ class Trainer(object):
 
         self.model.train()
 
-        # update grid
-        if self.model.cuda_ray:
-            with torch.cuda.amp.autocast(enabled=self.fp16):
-                self.model.update_extra_state(self.conf['bound'])
-
         # distributedSampler: must call set_epoch() to shuffle indices across multiple epochs
         # ref: https://pytorch.org/docs/stable/data.html
-        if self.world_size > 1:
+        if self.world_size > 1 and hasattr(getattr(loader, 'sampler', None), 'set_epoch'):
             loader.sampler.set_epoch(self.epoch)
+
+        # samplers and datasets that draw their samples per epoch (GlobalRaySampler, RayDataset)
+        for sampler in [loader, getattr(loader, 'dataset', None)]:
+            if hasattr(sampler, 'set_epoch'):
+                sampler.set_epoch(self.epoch)
         
         if self.local_rank == 0:
             pbar = tqdm.tqdm(total=len(loader), bar_format='{desc}: {percentage:3.0f}% {n_fmt}/{total_fmt} [{elapsed}<{remaining}, {rate_fmt}]')
 
         self.local_step = 0
 
+        # prepare the next batches in the background, while this step runs.
+        if self.conf.get('prefetch', 0) > 0:
+            # seeded per epoch, so a resumed run draws the same rays.
+            loader = BatchPrefetcher(loader, lambda data, generator: self.sample_rays(self.prepare_data(data), generator), self.device, self.conf['prefetch'], seed=torch.initial_seed() + self.epoch)
+
         for data in loader:
+
+            # update grid (cuda_ray, or skip_empty in the pytorch run) every update_extra_interval steps, as instant-ngp.
+            if hasattr(self.model, 'density_grid') and self.local_step % self.conf.get('update_extra_interval', 16) == 0:
+                with torch.cuda.amp.autocast(enabled=self.fp16):
+                    self.model.update_extra_state(self.conf['bound'], verbose=(self.local_step == 0))
+
+                if self.model.cuda_ray and self.local_rank == 0 and self.use_tensorboardX:
+                    self.writer.add_scalar("train/dropped_rays", self.model.dropped_rays, self.global_step)
             
             self.local_step += 1
             self.global_step += 1
@@ -795,6 +1079,7 @@ class Trainer(object):
 
         if self.model.cuda_ray:
             state['mean_count'] = self.model.mean_count
+        if hasattr(self.model, 'density_grid'):
             state['mean_density'] = self.model.mean_density
 
         if full:
@@ -839,7 +1124,14 @@ class Trainer(object):
             else:
                 self.log(f"[WARN] no evaluated results found, skip saving best checkpoint.")
             
-    def load_checkpoint(self, checkpoint=None):
+    def latest_checkpoint(self, ckpt_path=None):
+        # return: path of the latest epoch checkpoint in ckpt_path (default to ours), None if there is none.
+        ckpt_path = ckpt_path if ckpt_path is not None else self.ckpt_path
+        checkpoint_list = sorted(glob.glob(f'{ckpt_path}/{self.name}_ep*.pth.tar'))
+        return checkpoint_list[-1] if checkpoint_list else None
+
+    def load_checkpoint(self, checkpoint=None, model_only=False):
+        # model_only: only load the weights (and density grid stats), e.g. to warm-start the next timestep of a sequence.
         if checkpoint is None:
             checkpoint_list = sorted(glob.glob(f'{self.ckpt_path}/{self.name}_ep*.pth.tar'))
             if checkpoint_list:
@@ -863,17 +1155,21 @@ class Trainer(object):
         if len(unexpected_keys) > 0:
             self.log(f"[WARN] unexpected keys: {unexpected_keys}")   
 
-        if self.ema is not None and 'ema' in checkpoint_dict:
-            self.ema.load_state_dict(checkpoint_dict['ema'])
-
-        self.stats = checkpoint_dict['stats']
-        self.epoch = checkpoint_dict['epoch']
-
         if self.model.cuda_ray:
             if 'mean_count' in checkpoint_dict:
                 self.model.mean_count = checkpoint_dict['mean_count']
+        if hasattr(self.model, 'density_grid'):
             if 'mean_density' in checkpoint_dict:
                 self.model.mean_density = checkpoint_dict['mean_density']
+
+        if model_only:
+            return
+
+        if self.ema is not None and 'ema' in checkpoint_dict:
+            self.ema.load_state_dict(checkpoint_dict['ema'])
+
+        self.stats = checkpoint_dict['stats']
+        self.epoch = checkpoint_dict['epoch']
         
         if self.optimizer and  'optimizer' in checkpoint_dict:
             try:
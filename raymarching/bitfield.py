@@ -0,0 +1,158 @@
+import numpy as np
+
+import torch
+import torch.nn.functional as F
+
+# packed-bit occupancy grid with cascades and mips, pure PyTorch (works on CPU).
+#
+# cascade c covers [-extent_c, extent_c]^3 with extent_c = bound / 2^(C - 1 - c), so the last cascade is the whole
+# [-bound, bound] cube and each inner cascade has twice the resolution of the next one.
+# every cascade has R^3 cells, stored in x-major linear order (x * R * R + y * R + z), one bit per cell.
+# mip m is the OR of 2^m x 2^m x 2^m blocks of level 0, it has (R >> m)^3 cells and is stored in the first bits.
+#
+# bitfield: uint8 [M, C, R^3 // 8]
+
+
+def pack_bits(mask):
+    # mask: [..., n], bool, n % 8 == 0
+    # return: [..., n // 8], uint8, bit k of byte j is mask[8 * j + k]
+    weights = torch.tensor([1 << k for k in range(8)], dtype=torch.uint8, device=mask.device)
+    mask = mask.reshape(*mask.shape[:-1], -1, 8).to(torch.uint8)
+    return (mask * weights).sum(dim=-1, dtype=torch.uint8)
+
+
+def get_bits(bitfield, index):
+    # bitfield: [n // 8], uint8
+    # index: [...], int64 cell index
+    # return: [...], bool
+    return ((bitfield[index >> 3] >> (index & 7).to(torch.uint8)) & 1).bool()
+
+
+def cascade_extents(bound, num_cascades):
+    # return: list of C float, half edge length of each cascade
+    return [bound / 2 ** (num_cascades - 1 - c) for c in range(num_cascades)]
+
+
+def build_bitfield(density_grid, density_thresh, num_mips=1):
+    # density_grid: [C, R + 1, R + 1, R + 1], float, values at the grid vertices
+    # return: [M, C, R^3 // 8], uint8
+    C, R = density_grid.shape[0], density_grid.shape[1] - 1
+    assert R % (1 << (num_mips - 1)) == 0 and (R >> (num_mips - 1)) ** 3 % 8 == 0, f'grid resolution {R} does not support {num_mips} mips'
+
+    # a cell is occupied if any of its 8 vertices is.
+    occupied = (density_grid > density_thresh).float().unsqueeze(1) # [C, 1, R + 1, R + 1, R + 1]
+    occupied = F.max_pool3d(occupied, kernel_size=2, stride=1) # [C, 1, R, R, R]
+
+    bitfield = torch.zeros(num_mips, C, R ** 3 // 8, dtype=torch.uint8, device=density_grid.device)
+    for m in range(num_mips):
+        if m > 0:
+            occupied = F.max_pool3d(occupied, kernel_size=2, stride=2)
+        bits = pack_bits(occupied.reshape(C, -1) > 0) # [C, (R >> m)^3 // 8]
+        bitfield[m, :, :bits.shape[1]] = bits
+
+    return bitfield
+
+
+def locate_cells(pts, bound, num_cascades, resolution, level=0):
+    # pts: [..., 3]
+    # return: cascade [...], coords [..., 3] (int64, cell coords at this mip), extent [...] of the cascade,
+    #         the finest cascade that contains each point is used.
+    extents = torch.tensor(cascade_extents(bound, num_cascades), dtype=pts.dtype, device=pts.device) # [C]
+    radius = pts.abs().amax(dim=-1) # [...]
+    cascade = (radius.unsqueeze(-1) > extents).sum(dim=-1).clamp(max=num_cascades - 1) # [...]
+    extent = extents[cascade]
+
+    R = resolution >> level
+    coords = (0.5 * (pts / extent.unsqueeze(-1) + 1) * R).floor().long().clamp(0, R - 1)
+    return cascade, coords, extent
+
+
+def lookup_bitfield(bitfield, pts, bound, level=0):
+    # bitfield: [M, C, R^3 // 8]
+    # pts: [..., 3], in [-bound, bound]
+    # return: [...], bool, occupancy of the cell at this mip level
+    M, C, n_bytes = bitfield.shape
+    resolution = int(round((n_bytes * 8) ** (1 / 3)))
+    cascade, coords, _ = locate_cells(pts, bound, C, resolution, level)
+
+    R = resolution >> level
+    index = (coords[..., 0] * R + coords[..., 1]) * R + coords[..., 2]
+    return get_bits(bitfield[level].reshape(-1), cascade * (n_bytes * 8) + index)
+
+
+def march_bitfield(bitfield, rays_o, rays_d, near, far, bound, level=0, steps_per_cell=2):
+    # rays_o, rays_d: [N, 3], near, far: [N, 1]
+    # return: bins [N, S + 1] in [near, far], occupied [N, S], with steps_per_cell steps per cell of the outer cascade at this level.
+    resolution = int(round((bitfield.shape[2] * 8) ** (1 / 3)))
+    S = steps_per_cell * (resolution >> level)
+    bins = near + (far - near) * torch.linspace(0.0, 1.0, S + 1, device=rays_o.device).unsqueeze(0) # [N, S + 1]
+    z_mids = 0.5 * (bins[:, 1:] + bins[:, :-1]) # [N, S]
+    pts = rays_o.unsqueeze(-2) + rays_d.unsqueeze(-2) * z_mids.unsqueeze(-1) # [N, S, 3]
+    return bins, lookup_bitfield(bitfield, pts.clamp(-bound, bound), bound, level)
+
+
+def traverse_bitfield_reference(bitfield, rays_o, rays_d, near, far, bound, eps=1e-5):
+    # reference hierarchical traversal, one ray at a time on CPU (for tests).
+    # empty cells are skipped at the coarsest mip that is empty, occupied level 0 cells are reported.
+    # rays_o, rays_d: [N, 3], near, far: [N]
+    # return: list of N lists of (t_enter, t_exit) of the occupied level 0 cells crossed by each ray.
+    bitfield = bitfield.cpu()
+    M, C, n_bytes = bitfield.shape
+    resolution = int(round((n_bytes * 8) ** (1 / 3)))
+    extents = cascade_extents(bound, C)
+
+    def cell_exit(o, d, t, lo, hi):
+        # distance along the ray to the exit of the box [lo, hi]
+        t_exit = np.inf
+        for k in range(3):
+            if d[k] > 0:
+                t_exit = min(t_exit, (hi[k] - o[k]) / d[k])
+            elif d[k] < 0:
+                t_exit = min(t_exit, (lo[k] - o[k]) / d[k])
+        return max(t_exit, t)
+
+    def box_entry(o, d, extent):
+        # distance along the ray to the entry of [-extent, extent]^3, inf if it is missed
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t0 = (-extent - o) / d
+            t1 = (extent - o) / d
+        t_in, t_out = np.nanmax(np.minimum(t0, t1)), np.nanmin(np.maximum(t0, t1))
+        return t_in if t_in <= t_out else np.inf
+
+    results = []
+    for o, d, t, t_far in zip(rays_o.double().cpu().numpy(), rays_d.double().cpu().numpy(), near.double().cpu().tolist(), far.double().cpu().tolist()):
+        intervals = []
+        while t < t_far:
+            p = np.clip(o + t * d, -bound, bound)
+            pts = torch.from_numpy(p).unsqueeze(0)
+            cascade, _, _ = locate_cells(pts, bound, C, resolution)
+            extent = extents[cascade.item()]
+
+            # coarsest mip first, descend while occupied.
+            for m in reversed(range(M)):
+                if lookup_bitfield(bitfield, pts, bound, m).item():
+                    continue
+                break
+            else:
+                m = 0
+
+            size = 2 * extent / (resolution >> m)
+            cell = np.clip(np.floor((p + extent) / size), 0, (resolution >> m) - 1)
+            lo = cell * size - extent
+            t_exit = min(cell_exit(o, d, t, lo, lo + size), t_far)
+            if cascade.item() > 0:
+                # a cell of an outer cascade never skips over the finer cascade inside it.
+                t_inner = box_entry(o, d, extents[cascade.item() - 1])
+                if t < t_inner < t_exit:
+                    t_exit = t_inner
+
+            if m == 0 and lookup_bitfield(bitfield, pts, bound, 0).item():
+                if intervals and abs(intervals[-1][1] - t) < 2 * eps:
+                    intervals[-1] = (intervals[-1][0], t_exit)
+                else:
+                    intervals.append((t, t_exit))
+
+            t = t_exit + eps
+        results.append(intervals)
+
+    return results
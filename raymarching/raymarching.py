@@ -12,16 +12,26 @@ from .backend import _backend
 ### training functions
 #########################################
 
+def take_buffer(buffer_pool, name, size, dims, dtype, device):
+    # a [size, *dims] zeroed tensor, from the buffer pool if given (reused across calls, see nerf/buffer_pool.py).
+    if buffer_pool is None:
+        return torch.zeros(size, *dims, dtype=dtype, device=device)
+    return buffer_pool.take(name, [size] + list(dims), dtype, device, fill=0)
+
+
 ### generate points (forward only)
 # inputs: 
 #   rays_o/d: float[N, 3], bound: float
+#   exact: count the points first (a second march with no output), and allocate exactly what is needed.
+#   buffer_pool: BufferPool, reuse the points allocation across calls.
+#   dropped_counter: int [1], incremented by the number of rays that did not fit in the points.
 # outputs: 
 #   points: float [M, 7], xyzs, dirs, dt
 #   rays: int [N, 3], id, offset, num_steps
 class _march_rays_train(Function):
     @staticmethod
     @custom_fwd(cast_inputs=torch.float32)
-    def forward(ctx, rays_o, rays_d, bound, density_grid, mean_density, iter_density, step_counter=None, mean_count=-1, perturb=False, align=-1, force_all_rays=False):
+    def forward(ctx, rays_o, rays_d, bound, density_grid, mean_density, iter_density, step_counter=None, mean_count=-1, perturb=False, align=-1, force_all_rays=False, exact=False, buffer_pool=None, dropped_counter=None):
         
         rays_o = rays_o.contiguous().view(-1, 3)
         rays_d = rays_d.contiguous().view(-1, 3)
@@ -31,27 +41,36 @@ class _march_rays_train(Function):
 
         M = N * 1024 # init max points number in total, hardcoded
 
+        if step_counter is None:
+            step_counter = torch.zeros(2, dtype=torch.int32, device=rays_o.device) # point counter, ray counter
+
+        rays = torch.empty(N, 3, dtype=torch.int32, device=rays_o.device) # id, offset, num_steps
+
+        if exact:
+            # count pass: with M = 0 every ray returns before writing points.
+            counter = step_counter.clone()
+            empty = torch.empty(0, 3, dtype=rays_o.dtype, device=rays_o.device)
+            _backend.march_rays_train(rays_o, rays_d, density_grid, mean_density, iter_density, bound, N, H, 0, empty, empty, empty.view(0), rays, counter, perturb)
+            M = counter[0].item() # D2H copy
+            M += align - M % align if align > 0 else 1 # a ray ending at M is skipped by the kernels
+
         # running average based on previous epoch (mimic `measured_batch_size_before_compaction` in instant-ngp)
         # It estimate the max points number to enable faster training, but will lead to random ignored rays if underestimated.
-        if not force_all_rays and mean_count > 0:
+        elif not force_all_rays and mean_count > 0:
             if align > 0:
                 mean_count += align - mean_count % align
             M = mean_count
         
-        xyzs = torch.zeros(M, 3, dtype=rays_o.dtype, device=rays_o.device)
-        dirs = torch.zeros(M, 3, dtype=rays_o.dtype, device=rays_o.device)
-        deltas = torch.zeros(M, dtype=rays_o.dtype, device=rays_o.device)
-        rays = torch.empty(N, 3, dtype=torch.int32, device=rays_o.device) # id, offset, num_steps
-
-        if step_counter is None:
-            step_counter = torch.zeros(2, dtype=torch.int32, device=rays_o.device) # point counter, ray counter
+        xyzs = take_buffer(buffer_pool, 'march_xyzs', M, [3], rays_o.dtype, rays_o.device)
+        dirs = take_buffer(buffer_pool, 'march_dirs', M, [3], rays_o.dtype, rays_o.device)
+        deltas = take_buffer(buffer_pool, 'march_deltas', M, [], rays_o.dtype, rays_o.device)
 
         _backend.march_rays_train(rays_o, rays_d, density_grid, mean_density, iter_density, bound, N, H, M, xyzs, dirs, deltas, rays, step_counter, perturb) # m is the actually used points number
 
         #print(step_counter, M)
 
         # only used at the first (few) epochs.
-        if force_all_rays or mean_count <= 0:
+        if not exact and (force_all_rays or mean_count <= 0):
             m = step_counter[0].item() # D2H copy
             if align > 0:
                 m += align - m % align
@@ -59,6 +78,9 @@ class _march_rays_train(Function):
             dirs = dirs[:m]
             deltas = deltas[:m]
 
+        if dropped_counter is not None:
+            dropped_counter += ((rays[:, 2] > 0) & (rays[:, 1] + rays[:, 2] >= xyzs.shape[0])).sum()
+
         return xyzs, dirs, deltas, rays
 
 march_rays_train = _march_rays_train.apply
@@ -0,0 +1,357 @@
+import torch
+from torch.autograd import Function
+
+from .raymarching import take_buffer
+
+# pure-PyTorch reference of the raymarching ops in src/raymarching.cu (works on CPU),
+# same signatures and tensor contracts as raymarching.py, vectorized over rays.
+# the results match the kernels up to float rounding, except:
+#   - perturb uses torch.rand instead of pcg32.
+#   - march_rays_train writes the rays in id order and their points contiguously in that order,
+#     compact_rays keeps the alive rays in order (the kernel orders depend on atomicAdd).
+
+# some const, as in raymarching.cu
+DENSITY_THRESH = 10.0
+SQRT3 = 1.73205080757
+MAX_STEPS = 1024
+MIN_STEPSIZE = 2 * SQRT3 / MAX_STEPS # still need to mul bound to get dt_min
+MIN_NEAR = 0.05
+DT_GAMMA = 1 / 256
+
+
+def step_params(bound, H):
+    # return: dt_min, dt_max, dt_gamma
+    return MIN_STEPSIZE * bound, 2 * bound / (H - 1), DT_GAMMA if bound > 1 else 0.0
+
+
+def step_size(t, dt_min, dt_max, dt_gamma):
+    return (t * dt_gamma).clamp(dt_min, dt_max)
+
+
+def query_grid(grid, pts, bound):
+    # pts: [n, 3], clamped to [-bound, bound]
+    # return: density [n], nearest grid position [n, 3]
+    H = grid.shape[0]
+    coords = (0.5 * (pts / bound + 1) * H).clamp(0, H - 1).long() # truncation, as the int cast
+    index = (coords[:, 0] * H + coords[:, 1]) * H + coords[:, 2]
+    return grid.reshape(-1)[index].float(), coords
+
+
+def skip_voxel(t, pts, coords, rays_d, bound, H, dt_min, dt_max, dt_gamma):
+    # advance t past the current (empty) voxel with the same small steps as the kernel.
+    # t: [n], pts, coords, rays_d: [n, 3]
+    with torch.no_grad():
+        tv = ((coords.float() + 0.5 + 0.5 * torch.copysign(torch.ones_like(rays_d), rays_d)) / (H - 1) * 2 - 1) * bound # [n, 3]
+        ts = (tv - pts) / rays_d # 0 * inf = nan is ignored below, as fminf does
+        tt = t + torch.fmax(torch.zeros_like(t), torch.fmin(ts[:, 0], torch.fmin(ts[:, 1], ts[:, 2])))
+
+        # do { t += dt } while (t < tt)
+        t = t + step_size(t, dt_min, dt_max, dt_gamma)
+        mask = t < tt
+        while mask.any():
+            t = torch.where(mask, t + step_size(t, dt_min, dt_max, dt_gamma), t)
+            mask = t < tt
+    return t
+
+
+def march(rays_o, rays_d, t, far, max_steps, bound, density_grid, density_thresh):
+    # the marching loop shared by march_rays_train and march_rays, all rays advance together.
+    # rays_o, rays_d: [n, 3], t, far: [n], max_steps: int or [n]
+    # yields once per iteration with occupied samples: occupied [n] bool, step [n] (sample index along the ray),
+    #   pts [n, 3], t [n] before and dt [n] of the step (only valid where occupied).
+    H = density_grid.shape[0] # grid resolution
+    dt_min, dt_max, dt_gamma = step_params(bound, H)
+
+    step = torch.zeros_like(t, dtype=torch.long)
+    active = (t < far) & (step < max_steps)
+    while active.any():
+        pts = (rays_o + t.unsqueeze(-1) * rays_d).clamp(-bound, bound)
+        density, coords = query_grid(density_grid, pts, bound)
+
+        # if occpuied, advance a small step, and write to output
+        occupied = active & (density > density_thresh)
+        dt = step_size(t, dt_min, dt_max, dt_gamma)
+        if occupied.any():
+            yield occupied, step, pts, t, dt
+        t = torch.where(occupied, t + dt, t)
+        step = step + occupied.long()
+
+        # else, skip a large step (basically skip a voxel grid)
+        empty = active & ~occupied
+        if empty.any():
+            t[empty] = skip_voxel(t[empty], pts[empty], coords[empty], rays_d[empty], bound, H, dt_min, dt_max, dt_gamma)
+
+        active = (t < far) & (step < max_steps)
+
+
+def near_far_cube(rays_o, rays_d, bound):
+    # the same near / far as the training kernel (assume cube scene)
+    # rays_o, rays_d: [N, 3]
+    # return: near, far [N]
+    with torch.no_grad():
+        tmin = (-bound - rays_o) / rays_d
+        tmax = (bound - rays_o) / rays_d
+        near = torch.minimum(tmin, tmax)
+        far = torch.maximum(tmin, tmax)
+        near = torch.fmax(torch.fmax(near[:, 0], torch.fmax(near[:, 1], near[:, 2])), torch.full_like(near[:, 0], MIN_NEAR))
+        far = torch.fmin(far[:, 0], torch.fmin(far[:, 1], far[:, 2]))
+    return near, far
+
+
+#########################################
+### training functions
+#########################################
+
+def march_rays_train(rays_o, rays_d, bound, density_grid, mean_density, iter_density, step_counter=None, mean_count=-1, perturb=False, align=-1, force_all_rays=False, exact=False, buffer_pool=None, dropped_counter=None):
+    # see _march_rays_train in raymarching.py
+    # return: xyzs, dirs [M, 3], deltas [M], rays [N, 3] (int32, id, offset, num_steps)
+    rays_o = rays_o.contiguous().view(-1, 3).float()
+    rays_d = rays_d.contiguous().view(-1, 3).float()
+    device = rays_o.device
+
+    N = rays_o.shape[0] # num rays
+
+    if step_counter is None:
+        step_counter = torch.zeros(2, dtype=torch.int32, device=device) # point counter, ray counter
+
+    density_thresh = min(DENSITY_THRESH, mean_density)
+    dt_min = MIN_STEPSIZE * bound
+
+    near, far = near_far_cube(rays_o, rays_d, bound)
+    t = near.clone()
+    if perturb:
+        t = t + dt_min * torch.rand_like(t)
+
+    # one pass, the kernel's second pass repeats the same march.
+    samples = list(march(rays_o, rays_d, t, far, MAX_STEPS, bound, density_grid, density_thresh))
+
+    if samples:
+        num_steps = torch.stack([occupied for occupied, _, _, _, _ in samples]).sum(0) # [N]
+    else:
+        num_steps = torch.zeros(N, dtype=torch.long, device=device)
+
+    # points of the previous calls (step_counter is shared across a few steps) come first.
+    offsets = step_counter[0].long() + torch.cumsum(num_steps, 0) - num_steps # [N]
+    rays = torch.stack([torch.arange(N, device=device), offsets, num_steps], dim=-1).int()
+
+    M = N * 1024 # init max points number in total, hardcoded
+
+    if exact:
+        M = int(offsets[-1] + num_steps[-1])
+        M += align - M % align if align > 0 else 1 # a ray ending at M is skipped by the kernels
+
+    # running average based on previous epoch, may drop rays if underestimated.
+    elif not force_all_rays and mean_count > 0:
+        if align > 0:
+            mean_count += align - mean_count % align
+        M = mean_count
+
+    xyzs = take_buffer(buffer_pool, 'march_xyzs', M, [3], rays_o.dtype, device)
+    dirs = take_buffer(buffer_pool, 'march_dirs', M, [3], rays_o.dtype, device)
+    deltas = take_buffer(buffer_pool, 'march_deltas', M, [], rays_o.dtype, device)
+
+    # rays that do not fit in the M points are not written, as the kernel.
+    fits = offsets + num_steps < M
+    for occupied, step, pts, _, dt in samples:
+        occupied = occupied & fits
+        inds = (offsets + step)[occupied]
+        xyzs[inds] = pts[occupied]
+        dirs[inds] = rays_d[occupied]
+        deltas[inds] = dt[occupied]
+
+    step_counter[0] += num_steps.sum().to(step_counter.dtype)
+    step_counter[1] += N
+
+    # only used at the first (few) epochs.
+    if not exact and (force_all_rays or mean_count <= 0):
+        m = step_counter[0].item()
+        if align > 0:
+            m += align - m % align
+        xyzs = xyzs[:m]
+        dirs = dirs[:m]
+        deltas = deltas[:m]
+
+    if dropped_counter is not None:
+        dropped_counter += ((rays[:, 2] > 0) & (rays[:, 1] + rays[:, 2] >= xyzs.shape[0])).sum()
+
+    return xyzs, dirs, deltas, rays
+
+
+def gather_rays(values, rays):
+    # values: [M, ...], rays: [N, 3]
+    # return: [N, S, ...] the points of each ray padded to S = max num_steps, mask [N, S], valid rays [N]
+    M = values.shape[0]
+    offsets, num_steps = rays[:, 1].long(), rays[:, 2].long()
+    valid = (num_steps > 0) & (offsets + num_steps < M) # empty ray, or ray that exceed max step count.
+    S = max(int(num_steps[valid].max()) if valid.any() else 0, 1)
+    steps = torch.arange(S, device=values.device)
+    mask = valid.unsqueeze(-1) & (steps < num_steps.unsqueeze(-1)) # [N, S]
+    inds = torch.where(mask, offsets.unsqueeze(-1) + steps, torch.zeros_like(mask, dtype=torch.long))
+    return values[inds], mask, valid
+
+
+class _composite_rays_train(Function):
+    @staticmethod
+    def forward(ctx, sigmas, rgbs, deltas, rays, bound):
+        # see _composite_rays_train in raymarching.py, sigmas are the alphas of the sdf renderer.
+        ctx.shapes = [sigmas.shape, rgbs.shape]
+        sigmas = sigmas.contiguous().float().view(-1)
+        rgbs = rgbs.contiguous().float().view(-1, 3)
+        deltas = deltas.contiguous().float().view(-1)
+
+        M = sigmas.shape[0]
+        N = rays.shape[0]
+        index = rays[:, 0].long()
+
+        alpha, mask, _ = gather_rays(sigmas, rays) # [N, S]
+        rgb, _, _ = gather_rays(rgbs, rays) # [N, S, 3]
+
+        # minimal remained transmittence, T < 1e-4 stops the ray.
+        alpha = torch.where(mask, alpha, torch.zeros_like(alpha))
+        T = torch.cumprod(torch.cat([torch.ones_like(alpha[:, :1]), 1 - alpha[:, :-1]], dim=-1), dim=-1) # [N, S]
+        run = mask & (T >= 1e-4)
+        weights = torch.where(run, alpha * T, torch.zeros_like(T))
+        T_final = torch.cumprod(torch.where(run, 1 - alpha, torch.ones_like(alpha)), dim=-1)[:, -1]
+
+        weights_sum = torch.zeros(N, dtype=sigmas.dtype, device=sigmas.device)
+        image = torch.zeros(N, 3, dtype=sigmas.dtype, device=sigmas.device)
+        weights_sum[index] = torch.where(mask.any(-1), 1 - T_final, torch.zeros_like(T_final))
+        image[index] = (weights.unsqueeze(-1) * rgb).sum(1)
+
+        ctx.save_for_backward(sigmas, rgbs, deltas, rays, weights_sum, image)
+        ctx.dims = [M, N, bound]
+
+        return weights_sum, image
+
+    @staticmethod
+    def backward(ctx, grad_weights_sum, grad_image):
+        # the same gradient as kernel_composite_rays_train_backward (no early stop).
+        sigmas, rgbs, deltas, rays, weights_sum, image = ctx.saved_tensors
+        M, N, bound = ctx.dims
+        index = rays[:, 0].long()
+
+        alpha, mask, _ = gather_rays(sigmas, rays) # [N, S]
+        rgb, _, _ = gather_rays(rgbs, rays) # [N, S, 3]
+        delta, _, _ = gather_rays(deltas, rays) # [N, S]
+        offsets = rays[:, 1].long().unsqueeze(-1) + torch.arange(mask.shape[1], device=mask.device) # [N, S]
+
+        alpha = torch.where(mask, alpha, torch.zeros_like(alpha))
+        T_next = torch.cumprod(1 - alpha, dim=-1) # T(t + 1)
+        T = torch.cat([torch.ones_like(T_next[:, :1]), T_next[:, :-1]], dim=-1)
+        weights = alpha * T
+        partial = torch.cumsum(weights.unsqueeze(-1) * rgb, dim=1) # [N, S, 3]
+
+        grad = grad_image.float()[index].unsqueeze(1) # [N, 1, 3]
+        grad_ws = grad_weights_sum.float()[index].unsqueeze(1) # [N, 1]
+        final = image[index].unsqueeze(1) # [N, 1, 3]
+        T_final = 1 - weights_sum[index].unsqueeze(1) # [N, 1]
+
+        g_rgbs = grad * weights.unsqueeze(-1)
+        g_sigmas = delta * ((grad * (T_next.unsqueeze(-1) * rgb - (final - partial))).sum(-1) + grad_ws * T_final)
+
+        grad_sigmas = torch.zeros_like(sigmas)
+        grad_rgbs = torch.zeros_like(rgbs)
+        grad_sigmas[offsets[mask]] = g_sigmas[mask]
+        grad_rgbs[offsets[mask]] = g_rgbs[mask]
+
+        return grad_sigmas.view(ctx.shapes[0]), grad_rgbs.view(ctx.shapes[1]), None, None, None
+
+
+composite_rays_train = _composite_rays_train.apply
+
+
+#########################################
+### inference functions
+#########################################
+
+def march_rays(n_alive, n_step, rays_alive, rays_t, rays_o, rays_d, bound, density_grid, mean_density, near, far, align=-1, perturb=False):
+    # see _march_rays in raymarching.py
+    # return: xyzs, dirs [M, 3], deltas [M, 2], M = n_alive * n_step (aligned)
+    rays_o = rays_o.contiguous().view(-1, 3).float()
+    rays_d = rays_d.contiguous().view(-1, 3).float()
+    device = rays_o.device
+
+    M = n_alive * n_step
+
+    if align > 0:
+        M += align - (M % align)
+
+    xyzs = torch.zeros(M, 3, dtype=rays_o.dtype, device=device)
+    dirs = torch.zeros(M, 3, dtype=rays_o.dtype, device=device)
+    deltas = torch.zeros(M, 2, dtype=rays_o.dtype, device=device) # 2 vals, one for rgb, one for depth
+
+    density_thresh = min(DENSITY_THRESH, mean_density)
+    dt_min = MIN_STEPSIZE * bound
+
+    index = rays_alive[:n_alive].long()
+    t = rays_t[:n_alive].float().clone()
+    if perturb:
+        t = t + dt_min * torch.rand_like(t)
+
+    last_t = t.clone()
+    slots = torch.arange(n_alive, device=device) * n_step
+
+    d = rays_d[index]
+    for occupied, step, pts, t, dt in march(rays_o[index], d, t, far.reshape(-1)[index].float(), n_step, bound, density_grid, density_thresh):
+        inds = (slots + step)[occupied]
+        xyzs[inds] = pts[occupied]
+        dirs[inds] = d[occupied]
+        deltas[inds, 0] = dt[occupied]
+        deltas[inds, 1] = (t + dt - last_t)[occupied] # used to calc depth
+        last_t = torch.where(occupied, t + dt, last_t)
+
+    return xyzs, dirs, deltas
+
+
+def composite_rays(n_alive, n_step, rays_alive, rays_t, sigmas, rgbs, normals, deltas, weights_sum, depth, image, normal_map):
+    # see _composite_rays in raymarching.py, updates rays_t, weights_sum, depth, image and normal_map in place.
+    # rays_t is set to -1 for the rays that terminated in this call.
+    index = rays_alive[:n_alive].long()
+    M = n_alive * n_step
+    sigmas = sigmas.reshape(-1)[:M].view(n_alive, n_step)
+    rgbs = rgbs.reshape(-1, 3)[:M].view(n_alive, n_step, 3)
+    normals = normals.reshape(-1, 3)[:M].view(n_alive, n_step, 3)
+    deltas = deltas.reshape(-1, 2)[:M].view(n_alive, n_step, 2)
+
+    t = rays_t[:n_alive].clone()
+    weight_sum = weights_sum[index].clone()
+    d = depth[index].clone()
+    rgb = image[index].clone()
+    nrm = normal_map[index].clone()
+
+    terminated = torch.zeros(n_alive, dtype=torch.bool, device=sigmas.device)
+    for step in range(n_step):
+        # ray is terminated if delta == 0
+        terminated = terminated | (deltas[:, step, 0] == 0)
+        running = ~terminated
+
+        T = 1 - weight_sum
+        weight = torch.where(running, sigmas[:, step] * T, torch.zeros_like(T))
+        weight_sum = weight_sum + weight
+
+        t = torch.where(running, t + deltas[:, step, 1], t) # real delta
+        d = d + weight * t
+        rgb = rgb + weight.unsqueeze(-1) * rgbs[:, step]
+        nrm = nrm + weight.unsqueeze(-1) * normals[:, step]
+
+        # ray is terminated if T is too small
+        terminated = terminated | (running & (T < 1e-2))
+
+    # rays_t = -1 means ray is terminated early.
+    rays_t[:n_alive] = torch.where(terminated, -torch.ones_like(t), t)
+
+    weights_sum[index] = weight_sum.to(weights_sum.dtype)
+    depth[index] = d.to(depth.dtype)
+    image[index] = rgb.to(image.dtype)
+    normal_map[index] = nrm.to(normal_map.dtype)
+
+
+def compact_rays(n_alive, rays_alive, rays_alive_old, rays_t, rays_t_old, alive_counter):
+    # see _compact_rays in raymarching.py, copies the alive rays (rays_t_old >= 0) to the front of rays_alive / rays_t,
+    # and adds their number to alive_counter.
+    alive = rays_t_old[:n_alive] >= 0
+    inds = alive.nonzero(as_tuple=True)[0]
+    n = inds.shape[0]
+    rays_alive[:n] = rays_alive_old[inds]
+    rays_t[:n] = rays_t_old[inds]
+    alive_counter += n
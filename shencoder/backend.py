@@ -1,15 +1,17 @@
 import os
-from torch.utils.cpp_extension import load
+from extensions import CUDAExtension
 
 _src_path = os.path.dirname(os.path.abspath(__file__))
 
-_backend = load(name='_sh_encoder',
-                extra_cflags=['-O3', '-std=c++14'],
-                extra_cuda_cflags=['-O3', '-std=c++14'],
-                sources=[os.path.join(_src_path, 'src', f) for f in [
-                    'shencoder.cu',
-                    'bindings.cpp',
-                ]],
-                )
+# built lazily on first use, SHEncoder falls back to sh_encode_torch when it is not available.
+_backend = CUDAExtension(name='_sh_encoder',
+                         src_path=_src_path,
+                         extra_cflags=['-O3', '-std=c++14'],
+                         extra_cuda_cflags=['-O3', '-std=c++14'],
+                         sources=[
+                             'shencoder.cu',
+                             'bindings.cpp',
+                         ],
+                         )
 
-__all__ = ['_backend']
\ No newline at end of file
+__all__ = ['_backend']
@@ -55,6 +55,44 @@ class _sh_encoder(Function):
 sh_encode = _sh_encoder.apply
 
 
+def sh_encode_torch(inputs, degree):
+    # inputs: [B, 3], float in [-1, 1]
+    # RETURN: [B, degree^2], same basis and order as sh_encode_forward in src/shencoder.cu, gradients from autograd.
+    if degree > 4:
+        raise NotImplementedError(f'the PyTorch SH encoder only supports degree <= 4, got {degree}')
+
+    x, y, z = inputs.unbind(-1)
+    xy, xz, yz, x2, y2, z2 = x * y, x * z, y * z, x * x, y * y, z * z
+
+    outputs = [torch.full_like(x, 0.28209479177387814)]                  # 1/(2*sqrt(pi))
+    if degree > 1:
+        outputs += [
+            -0.48860251190291987 * y,                                     # -sqrt(3)*y/(2*sqrt(pi))
+            0.48860251190291987 * z,                                      # sqrt(3)*z/(2*sqrt(pi))
+            -0.48860251190291987 * x,                                     # -sqrt(3)*x/(2*sqrt(pi))
+        ]
+    if degree > 2:
+        outputs += [
+            1.0925484305920792 * xy,                                      # sqrt(15)*xy/(2*sqrt(pi))
+            -1.0925484305920792 * yz,                                     # -sqrt(15)*yz/(2*sqrt(pi))
+            0.94617469575755997 * z2 - 0.31539156525251999,               # sqrt(5)*(3*z2 - 1)/(4*sqrt(pi))
+            -1.0925484305920792 * xz,                                     # -sqrt(15)*xz/(2*sqrt(pi))
+            0.54627421529603959 * x2 - 0.54627421529603959 * y2,          # sqrt(15)*(x2 - y2)/(4*sqrt(pi))
+        ]
+    if degree > 3:
+        outputs += [
+            0.59004358992664352 * y * (-3.0 * x2 + y2),                   # sqrt(70)*y*(-3*x2 + y2)/(8*sqrt(pi))
+            2.8906114426405538 * xy * z,                                  # sqrt(105)*xy*z/(2*sqrt(pi))
+            0.45704579946446572 * y * (1.0 - 5.0 * z2),                   # sqrt(42)*y*(1 - 5*z2)/(8*sqrt(pi))
+            0.3731763325901154 * z * (5.0 * z2 - 3.0),                    # sqrt(7)*z*(5*z2 - 3)/(4*sqrt(pi))
+            0.45704579946446572 * x * (1.0 - 5.0 * z2),                   # sqrt(42)*x*(1 - 5*z2)/(8*sqrt(pi))
+            1.4453057213202769 * z * (x2 - y2),                           # sqrt(105)*z*(x2 - y2)/(4*sqrt(pi))
+            0.59004358992664352 * x * (-x2 + 3.0 * y2),                   # sqrt(70)*x*(-x2 + 3*y2)/(8*sqrt(pi))
+        ]
+
+    return torch.stack(outputs, dim=-1)
+
+
 class SHEncoder(nn.Module):
     def __init__(self, input_dim=3, degree=4):
         super().__init__()
@@ -78,7 +116,10 @@ class SHEncoder(nn.Module):
         prefix_shape = list(inputs.shape[:-1])
         inputs = inputs.reshape(-1, self.input_dim)
 
-        outputs = sh_encode(inputs, self.degree, inputs.requires_grad)
+        if not inputs.is_cuda or not _backend.available():
+            outputs = sh_encode_torch(inputs, self.degree)
+        else:
+            outputs = sh_encode(inputs, self.degree, inputs.requires_grad)
         outputs = outputs.reshape(prefix_shape + [self.output_dim])
 
         return outputs
\ No newline at end of file
@@ -0,0 +1,62 @@
+# check the packed occupancy bitfield (cascades, mips) and the reference traversal, runs on CPU.
+import torch
+import torch.nn.functional as F
+
+from raymarching.bitfield import build_bitfield, lookup_bitfield, march_bitfield, traverse_bitfield_reference, cascade_extents
+
+C = 2 # cascades
+R = 32 # cells per cascade
+M = 3 # mips
+bound = 2
+
+# a sphere shell of radius 0.6, sampled at the vertices of each cascade
+torch.manual_seed(0)
+density_grid = torch.zeros(C, R + 1, R + 1, R + 1)
+for c, extent in enumerate(cascade_extents(bound, C)):
+    xs = torch.linspace(-extent, extent, R + 1)
+    pts = torch.stack(torch.meshgrid(xs, xs, xs), dim=-1)
+    density_grid[c] = 100 * ((pts.norm(dim=-1) - 0.6).abs() < 2 * extent / R).float()
+
+bitfield = build_bitfield(density_grid, 10, M)
+print(f"=== bitfield ===", bitfield.shape, bitfield.dtype)
+assert bitfield.shape == (M, C, R ** 3 // 8)
+
+# 1. level 0 bits == dense occupancy of the cells (any of the 8 vertices occupied)
+cells = F.max_pool3d((density_grid > 10).float().unsqueeze(1), kernel_size=2, stride=1).squeeze(1) > 0 # [C, R, R, R]
+for c, extent in enumerate(cascade_extents(bound, C)):
+    centers = (torch.arange(R) + 0.5) / R * 2 * extent - extent
+    pts = torch.stack(torch.meshgrid(centers, centers, centers), dim=-1)
+    inner = extent / 2 if c > 0 else 0
+    mask = pts.abs().amax(dim=-1) > inner # points owned by this cascade
+    assert (lookup_bitfield(bitfield, pts, bound)[mask] == cells[c][mask]).all()
+
+# 2. mips are conservative: a coarse cell is occupied whenever a fine cell inside it is
+pts = (torch.rand(100000, 3) * 2 - 1) * bound
+fine = lookup_bitfield(bitfield, pts, bound, 0)
+for m in range(1, M):
+    coarse = lookup_bitfield(bitfield, pts, bound, m)
+    assert (coarse | ~fine).all()
+    print(f"mip {m}: occupied {coarse.float().mean().item():.4f} >= {fine.float().mean().item():.4f}")
+
+# 3. the hierarchical traversal reports exactly the occupied parts of the rays
+N = 64
+rays_o = torch.randn(N, 3)
+rays_o = rays_o / rays_o.norm(dim=-1, keepdim=True) * 3 * bound
+rays_d = -rays_o + torch.randn(N, 3) * 0.5
+rays_d = rays_d / rays_d.norm(dim=-1, keepdim=True)
+tmin = (-bound - rays_o) / rays_d
+tmax = (bound - rays_o) / rays_d
+near = torch.minimum(tmin, tmax).amax(dim=-1).clamp(min=0.05)
+far = torch.maximum(tmin, tmax).amin(dim=-1)
+
+intervals = traverse_bitfield_reference(bitfield, rays_o, rays_d, near, far, bound)
+
+bins, occupied = march_bitfield(bitfield, rays_o, rays_d, near.unsqueeze(-1), far.unsqueeze(-1), bound, steps_per_cell=8) # [N, S + 1], [N, S]
+z_mids = 0.5 * (bins[:, 1:] + bins[:, :-1])
+errors = 0
+for n in range(N):
+    for t, o in zip(z_mids[n].tolist(), occupied[n].tolist()):
+        inside = any(t0 - 1e-4 <= t <= t1 + 1e-4 for t0, t1 in intervals[n])
+        errors += int(inside != o)
+print("mismatched samples", errors, "of", occupied.numel())
+assert errors <= 0.001 * occupied.numel() # only samples within eps of a cell face
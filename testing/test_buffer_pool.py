@@ -0,0 +1,41 @@
+# check the size-classed buffer pool of the renderer (nerf/buffer_pool.py), runs on CPU.
+import torch
+
+from nerf.buffer_pool import BufferPool, size_class
+
+# 1. size classes: at most 25% unused, monotonic
+for n in range(1, 5000):
+    assert n <= size_class(n) <= max(n * 1.25, 4), n
+    assert size_class(n) <= size_class(n + 1)
+
+# 2. the same name and size class reuses the memory, other names do not
+pool = BufferPool()
+a = pool.take('a', [1000, 3], torch.float32, 'cpu', fill=0)
+b = pool.take('a', [990, 3], torch.float32, 'cpu', fill=1)
+assert b.shape == (990, 3) and a.data_ptr() == b.data_ptr() and (a[:990] == 1).all()
+c = pool.take('b', [1000, 3], torch.float32, 'cpu')
+assert c.data_ptr() != a.data_ptr()
+print("pooled", len(pool.buffers), "buffers", pool.nbytes(), "bytes")
+
+# 3. one buffer per name: another size class or dtype replaces it, so the pool does not grow
+for n in [10, 100, 1000, 10000, 100000, 1000]:
+    pool.take('a', [n, 3], torch.float32, 'cpu')
+    assert len(pool.buffers) == 2 and pool.buffers['a'].shape == (size_class(n), 3)
+d = pool.take('a', [1000, 3], torch.int32, 'cpu')
+assert len(pool.buffers) == 2 and pool.buffers['a'].dtype == torch.int32 and a.shape == (1000, 3) # handed out tensors stay valid
+
+# 4. trim releases the least recently used buffers
+pool.take('a', [1000, 3], torch.int32, 'cpu')
+pool.trim(pool.nbytes() - 1)
+assert 'b' not in pool.buffers and 'a' in pool.buffers
+assert c.shape == (1000, 3)
+pool.trim()
+assert pool.nbytes() == 0
+
+# 5. max_bytes bounds the pool
+pool = BufferPool(max_bytes=64 * 1024)
+for k in range(16):
+    pool.take(f'x{k}', [1024], torch.float32, 'cpu')
+assert pool.nbytes() <= 64 * 1024 and len(pool.buffers) == 16
+pool.take('y', [1024], torch.float32, 'cpu')
+assert pool.nbytes() <= 64 * 1024 and 'x0' not in pool.buffers
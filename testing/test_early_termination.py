@@ -0,0 +1,47 @@
+# check the early ray termination of the pytorch sdf renderer (--min_transmittance) on an opaque sphere, runs on CPU.
+import torch
+
+from nerf.renderer_sdf import NeRFRenderer
+
+
+class Sphere(NeRFRenderer):
+    # analytic sdf of a sphere of radius 0.5, colored by position, counts the shaded samples.
+    def __init__(self):
+        super().__init__()
+        self.num_shaded = 0
+
+    def forward_sdf(self, x, bound):
+        return torch.cat([x.norm(dim=-1, keepdim=True) - 0.5, x], dim=-1) # sdf, feature [N, 3]
+
+    def forward_color(self, x, d, n, geo_feat, bound):
+        self.num_shaded += x.shape[0]
+        return (geo_feat + 1) / 2
+
+    def forward_variance(self):
+        return torch.full([1, 1], 512.0) # opaque
+
+
+torch.manual_seed(0)
+model = Sphere()
+model.eval()
+
+N = 256
+rays_o = torch.tensor([0., 0., 3.]).repeat(1, N, 1) + torch.randn(1, N, 3) * 0.1
+rays_d = torch.nn.functional.normalize(-rays_o + torch.randn(1, N, 3) * 0.2, dim=-1)
+
+results = {}
+with torch.no_grad():
+    for min_transmittance in [0, 1e-4]:
+        model.num_shaded = 0
+        outputs = model.render(rays_o, rays_d, 64, 1.0, 64, staged=True, normal_epsilon_ratio=0.5, min_transmittance=min_transmittance, segment_steps=16)
+        results[min_transmittance] = outputs
+        print(f"min_transmittance = {min_transmittance}: shaded samples {model.num_shaded}")
+        if min_transmittance == 0:
+            num_shaded = model.num_shaded
+        else:
+            assert model.num_shaded < num_shaded
+
+for key in ['rgb', 'depth', 'normal']:
+    error = (results[1e-4][key] - results[0][key]).abs().max().item()
+    print(f"max {key} error {error}")
+    assert error < 1e-3
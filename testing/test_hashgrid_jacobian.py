@@ -0,0 +1,59 @@
+# check the analytic hash grid jacobian (a validation utility for the dy_dx of the CUDA kernel) against autograd, runs on CPU.
+import numpy as np
+import torch
+from torch.autograd import gradcheck
+
+from hashencoder.hashgrid_torch import hash_encode_torch, hash_encode_jacobian_torch
+
+input_dim = 3
+num_levels = 4
+level_dim = 2
+per_level_scale = 2
+base_resolution = 4
+log2_hashmap_size = 8 # small, so the finer levels are hashed
+
+# allocate parameters
+offsets = []
+offset = 0
+max_params = 2 ** log2_hashmap_size
+for i in range(num_levels):
+    resolution = int(np.ceil(base_resolution * per_level_scale ** i))
+    params_in_level = min(max_params, (resolution + 1) ** input_dim) # limit max number
+    offsets.append(offset)
+    offset += params_in_level
+offsets.append(offset)
+offsets = torch.from_numpy(np.array(offsets, dtype=np.int32))
+
+torch.manual_seed(0)
+inputs = torch.rand(16, input_dim, dtype=torch.float64)
+embeddings = (torch.randn(offset, level_dim, dtype=torch.float64) * 0.1).requires_grad_(True)
+
+# 1. jacobian == autograd of the encoding w.r.t. the inputs
+jacobian = hash_encode_jacobian_torch(inputs, embeddings, offsets, per_level_scale, base_resolution) # [B, L * C, D]
+
+x = inputs.clone().requires_grad_(True)
+outputs = hash_encode_torch(x, embeddings, offsets, per_level_scale, base_resolution) # [B, L * C]
+reference = torch.stack([torch.autograd.grad(outputs[:, k].sum(), x, retain_graph=True)[0] for k in range(outputs.shape[1])], dim=1) # [B, L * C, D]
+
+print("max jacobian error", (jacobian - reference).abs().max().item())
+assert torch.allclose(jacobian, reference, atol=1e-8)
+
+# 2. double backward: the jacobian is differentiable w.r.t. the embeddings (eikonal loss on the hash grid)
+func = lambda embeddings: hash_encode_jacobian_torch(inputs, embeddings, offsets, per_level_scale, base_resolution)
+check_results = gradcheck(func, (embeddings,), eps=1e-6, atol=1e-5)
+print("check_results", check_results)
+
+# 3. the CUDA dy_dx matches, if a GPU is available
+if torch.cuda.is_available():
+    from hashencoder.hashgrid import _hash_encode
+
+    inputs_cuda = inputs.float().cuda()
+    embeddings_cuda = embeddings.detach().float().cuda().requires_grad_(True)
+    dy_dx = hash_encode_jacobian_torch(inputs_cuda, embeddings_cuda, offsets.cuda(), per_level_scale, base_resolution)
+
+    x = inputs_cuda.clone().requires_grad_(True)
+    outputs_cuda = _hash_encode.apply(x, embeddings_cuda, offsets.cuda(), per_level_scale, base_resolution, True)
+    grad_cuda = torch.autograd.grad(outputs_cuda.sum(), x)[0] # [B, D]
+
+    print("max cuda error", (dy_dx.sum(1) - grad_cuda).abs().max().item())
+    assert torch.allclose(dy_dx.sum(1), grad_cuda, atol=1e-4)
@@ -0,0 +1,43 @@
+# check the PyTorch hash encoder (used on CPU-only machines) against the CUDA kernels.
+import torch
+from hashencoder import HashEncoder
+from hashencoder.hashgrid import hash_encode
+from hashencoder.hashgrid_torch import hash_encode_torch
+
+B = 4096
+D = 3
+
+torch.manual_seed(0)
+enc = HashEncoder(input_dim=D, num_levels=16, level_dim=2, base_resolution=16, log2_hashmap_size=15, desired_resolution=2048)
+enc.embeddings.data.uniform_(-1, 1)
+
+# 1. runs on CPU, with gradients w.r.t. inputs and embeddings
+x = (torch.rand(B, D) * 2 - 1).requires_grad_(True) # in [-1, 1]
+y = enc(x)
+y.sum().backward()
+print(f"=== cpu ===", y.shape, enc.embeddings.grad.abs().sum().item(), x.grad.abs().sum().item())
+
+# 2. same forward and backward as the CUDA kernels
+if torch.cuda.is_available():
+    inputs = ((x.detach() + 1) / 2).cuda()
+    embeddings = enc.embeddings.detach().cuda()
+    offsets = enc.offsets.cuda()
+
+    x1 = inputs.clone().requires_grad_(True)
+    e1 = embeddings.clone().requires_grad_(True)
+    y1 = hash_encode_torch(x1, e1, offsets, enc.per_level_scale, enc.base_resolution)
+
+    x2 = inputs.clone().requires_grad_(True)
+    e2 = embeddings.clone().requires_grad_(True)
+    y2 = hash_encode(x2, e2, offsets, enc.per_level_scale, enc.base_resolution, True)
+
+    grad = torch.randn_like(y1)
+    (y1 * grad).sum().backward()
+    (y2 * grad).sum().backward()
+
+    print("max output error", (y1 - y2).abs().max().item())
+    print("max grad embeddings error", (e1.grad - e2.grad).abs().max().item())
+    print("max grad inputs error", (x1.grad - x2.grad).abs().max().item())
+    assert torch.allclose(y1, y2, atol=1e-5)
+    assert torch.allclose(e1.grad, e2.grad, atol=1e-4)
+    assert torch.allclose(x1.grad, x2.grad, atol=1e-2)
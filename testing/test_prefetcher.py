@@ -0,0 +1,55 @@
+# check the BatchPrefetcher of the trainer (nerf/utils.py): order, termination and seeded draws, runs on CPU.
+import threading
+
+import torch
+
+from nerf.utils import BatchPrefetcher
+
+loader = [{'index': torch.tensor([k]), 'image': torch.full((2, 3), float(k))} for k in range(10)]
+
+def prepare(data, generator):
+    data = dict(data)
+    data['inds'] = torch.randint(0, 1000, size=[4], generator=generator)
+    return data
+
+def run(prefetcher, stop_after=None):
+    indices, inds = [], []
+    for data in prefetcher:
+        indices.append(data['index'].item())
+        inds.append(data['inds'])
+        torch.rand(3) # draws of the main thread (bg_color, perturb) must not change the prefetched ones
+        if stop_after is not None and len(indices) == stop_after:
+            break
+    return indices, inds
+
+# 1. every batch once, in the loader order
+prefetcher = BatchPrefetcher(loader, prepare, 'cpu', num_prefetch=2, seed=1)
+assert len(prefetcher) == 10
+indices, inds = run(prefetcher)
+print("order", indices)
+assert indices == list(range(10))
+
+# 2. the same seed draws the same samples, another seed does not
+_, inds_again = run(BatchPrefetcher(loader, prepare, 'cpu', num_prefetch=3, seed=1))
+_, inds_other = run(BatchPrefetcher(loader, prepare, 'cpu', num_prefetch=2, seed=2))
+assert all(torch.equal(a, b) for a, b in zip(inds, inds_again))
+assert not all(torch.equal(a, b) for a, b in zip(inds, inds_other))
+
+# 3. stopping early joins the background thread
+n_threads = threading.active_count()
+indices, _ = run(BatchPrefetcher(loader, prepare, 'cpu', num_prefetch=2, seed=1), stop_after=3)
+assert indices == [0, 1, 2] and threading.active_count() == n_threads
+
+# 4. an error of prepare is raised on the main thread
+def broken(data, generator):
+    if data['index'].item() == 4:
+        raise RuntimeError('broken batch')
+    return prepare(data, generator)
+
+try:
+    run(BatchPrefetcher(loader, broken, 'cpu', num_prefetch=2))
+    assert False, 'the error was not raised'
+except RuntimeError as e:
+    assert str(e) == 'broken batch'
+assert threading.active_count() == n_threads
+print("prefetcher ok")
@@ -0,0 +1,68 @@
+# check that the streaming RayDataset (nerf/provider.py) visits every ray exactly once per epoch, runs on CPU.
+import json
+import os
+import tempfile
+
+import cv2
+import numpy as np
+import torch
+
+from nerf.provider import RayDataset
+
+# a tiny mixed-resolution scene, every pixel stores its own global id in its rgb (24 bits)
+root = tempfile.mkdtemp()
+sizes = [(12, 16), (9, 20), (12, 16), (7, 11)]
+frames = []
+offset = 0
+for v, (H, W) in enumerate(sizes):
+    ids = offset + np.arange(H * W).reshape(H, W)
+    rgb = np.stack([ids & 255, (ids >> 8) & 255, (ids >> 16) & 255], axis=-1).astype(np.uint8)
+    cv2.imwrite(os.path.join(root, f'{v:02d}.png'), cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR))
+    pose = np.eye(4)
+    pose[:3, 3] = [np.cos(v), np.sin(v), 0.5]
+    frames.append({'file_path': f'{v:02d}.png', 'h': H, 'w': W, 'fl_x': 20.0, 'fl_y': 20.0, 'transform_matrix': pose.tolist()})
+    offset += H * W
+with open(os.path.join(root, 'transforms.json'), 'w') as f:
+    json.dump({'frames': frames}, f)
+
+def pixel_ids(rgb):
+    rgb = rgb.long()
+    return rgb[:, 0] | (rgb[:, 1] << 8) | (rgb[:, 2] << 16)
+
+dataset = RayDataset(root, type='train', mode='colmap', chunk_size=64, num_workers=1, seed=3)
+assert dataset.num_rays == offset
+print(f"rays {dataset.num_rays}, chunks {len(dataset)}")
+
+# 1. every ray exactly once per epoch, the chunks hold other rays every epoch
+chunks = {}
+for epoch in range(3):
+    dataset.set_epoch(epoch)
+    loader = torch.utils.data.DataLoader(dataset, batch_size=1, shuffle=True)
+    visited = []
+    for data in loader:
+        ids = pixel_ids(data['image'][0])
+        assert torch.equal(ids, dataset.chunk_pixels(data['index'].item()))
+        assert data['rays_o'].shape == (1, ids.shape[0], 3)
+        visited.append(ids)
+    visited = torch.cat(visited)
+    assert visited.shape[0] == offset and torch.equal(visited.sort()[0], torch.arange(offset)), epoch
+    chunks[epoch] = [dataset.chunk_pixels(k) for k in range(len(dataset))]
+    print(f"epoch {epoch}: stride {dataset.stride}, offset {dataset.offset}")
+assert not torch.equal(chunks[0][0], chunks[1][0])
+
+# the same epoch draws the same map
+dataset.set_epoch(1)
+assert all(torch.equal(a, dataset.chunk_pixels(k)) for k, a in enumerate(chunks[1]))
+
+# 2. no int64 overflow past ~3.4e9 rays: the map equals python int arithmetic
+dataset.num_rays = 6 * 10 ** 9 + 7 # only the index map is used below, no images behind it
+dataset.chunk_size = 4096
+for epoch in range(2):
+    dataset.set_epoch(epoch)
+    for index in [0, 1, dataset.num_rays // dataset.chunk_size]:
+        ids = dataset.chunk_pixels(index)
+        head = index * dataset.chunk_size
+        reference = [(dataset.offset + (head + k) * dataset.stride) % dataset.num_rays for k in range(ids.shape[0])]
+        assert ids.tolist() == reference
+assert ids.shape[0] == dataset.num_rays % dataset.chunk_size
+print("ray dataset ok")
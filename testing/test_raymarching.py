@@ -1 +1,156 @@
-import raymarching
\ No newline at end of file
+# check the pytorch raymarching ops (raymarching_torch.py) on CPU, and the CUDA kernels against them if a GPU is available.
+import torch
+
+import raymarching
+import raymarching.raymarching_torch as raymarching_torch
+from nerf.buffer_pool import BufferPool
+
+bound = 1.0
+H = 32
+N = 64
+
+# a sphere shell of radius 0.5
+torch.manual_seed(0)
+xs = torch.linspace(-bound, bound, H)
+pts = torch.stack(torch.meshgrid(xs, xs, xs, indexing='ij'), dim=-1)
+density_grid = 100 * ((pts.norm(dim=-1) - 0.5).abs() < 0.15).float()
+mean_density = 5
+
+rays_o = torch.tensor([0., 0., 3.]).repeat(N, 1) + torch.randn(N, 3) * 0.3
+rays_d = torch.nn.functional.normalize(-rays_o + torch.randn(N, 3) * 0.5, dim=-1)
+
+# 1. march_rays_train: rays [N, 3] layout and sample positions (aligned as run_cuda, the kernels skip a ray that ends at M)
+xyzs, dirs, deltas, rays = raymarching_torch.march_rays_train(rays_o, rays_d, bound, density_grid, mean_density, 0, align=128, force_all_rays=True)
+print(f"=== march_rays_train === points {xyzs.shape[0]}, hit rays {(rays[:, 2] > 0).sum().item()} / {N}")
+assert rays.dtype == torch.int32 and rays.shape == (N, 3)
+assert (rays[:, 0].sort()[0] == torch.arange(N)).all()
+assert (rays[1:, 1] == rays[:-1, 1] + rays[:-1, 2]).all() # contiguous points
+m = rays[:, 2].sum().item()
+assert m <= xyzs.shape[0] and (deltas[m:] == 0).all()
+density, _ = raymarching_torch.query_grid(density_grid, xyzs[:m], bound)
+assert (density > mean_density).all() and (deltas[:m] > 0).all()
+for index, offset, num_steps in rays.tolist():
+    assert (dirs[offset:offset + num_steps] == rays_d[index]).all()
+
+# exact mode allocates just the points (aligned), an underestimated mean_count drops the rays that do not fit
+buffer_pool = BufferPool()
+dropped = torch.zeros(1, dtype=torch.int32)
+xyzs_exact, _, _, _ = raymarching_torch.march_rays_train(rays_o, rays_d, bound, density_grid, mean_density, 0, align=128, exact=True, buffer_pool=buffer_pool, dropped_counter=dropped)
+assert torch.equal(xyzs_exact, xyzs) and dropped.item() == 0
+xyzs_again, _, _, _ = raymarching_torch.march_rays_train(rays_o, rays_d, bound, density_grid, mean_density, 0, align=128, exact=True, buffer_pool=buffer_pool)
+assert xyzs_again.data_ptr() == xyzs_exact.data_ptr() # reused
+_, _, _, rays_small = raymarching_torch.march_rays_train(rays_o, rays_d, bound, density_grid, mean_density, 0, mean_count=m // 2, align=128, buffer_pool=buffer_pool, dropped_counter=dropped)
+print(f"mean_count {m // 2 + 128 - m // 2 % 128}: dropped rays {dropped.item()}, pooled {buffer_pool.nbytes()} bytes")
+assert dropped.item() == ((rays_small[:, 2] > 0) & (rays_small[:, 1] + rays_small[:, 2] >= m // 2 + 128 - m // 2 % 128)).sum().item() > 0
+
+# 2. march_rays from near visits the same points
+near, far = raymarching_torch.near_far_cube(rays_o, rays_d, bound)
+n_step = rays[:, 2].max().item()
+xyzs_inf, _, deltas_inf = raymarching_torch.march_rays(N, n_step, torch.arange(N, dtype=torch.int32), near.clone(), rays_o, rays_d, bound, density_grid, mean_density, near, far)
+for index, offset, num_steps in rays.tolist():
+    assert torch.allclose(xyzs_inf[index * n_step:index * n_step + num_steps], xyzs[offset:offset + num_steps])
+    assert torch.allclose(deltas_inf[index * n_step:index * n_step + num_steps, 0], deltas[offset:offset + num_steps])
+
+# 3. composite_rays_train == a plain loop, the rgb gradient == autograd
+M = xyzs.shape[0]
+sigmas = torch.rand(M, dtype=torch.float64).requires_grad_(True)
+rgbs = torch.rand(M, 3, dtype=torch.float64).requires_grad_(True)
+weights_sum, image = raymarching_torch.composite_rays_train(sigmas, rgbs, deltas, rays, bound)
+
+image_ref = [torch.zeros(3, dtype=torch.float64) for _ in range(N)]
+weights_sum_ref = [torch.zeros((), dtype=torch.float64) for _ in range(N)]
+for index, offset, num_steps in rays.tolist():
+    T = 1.0
+    for k in range(offset, offset + num_steps):
+        if T < 1e-4:
+            break
+        image_ref[index] = image_ref[index] + sigmas[k] * T * rgbs[k]
+        T = T * (1 - sigmas[k])
+    weights_sum_ref[index] = weights_sum_ref[index] + (1 - T if num_steps > 0 else 0)
+image_ref = torch.stack(image_ref)
+weights_sum_ref = torch.stack(weights_sum_ref)
+
+print("max image error", (image - image_ref).abs().max().item())
+assert torch.allclose(image, image_ref.float(), atol=1e-5)
+assert torch.allclose(weights_sum, weights_sum_ref.float(), atol=1e-5)
+
+grad_image = torch.rand(N, 3)
+grad_rgbs, = torch.autograd.grad(image, rgbs, grad_image, retain_graph=True)
+grad_rgbs_ref, = torch.autograd.grad(image_ref, rgbs, grad_image.double())
+print("max rgb grad error", (grad_rgbs - grad_rgbs_ref).abs().max().item())
+assert torch.allclose(grad_rgbs.double(), grad_rgbs_ref, atol=1e-4) # the backward does not stop at T < 1e-4, as the kernel
+
+# 4. inference ops: march / composite / compact until all rays are done
+def render(ops, device):
+    weights_sum = torch.zeros(N, device=device)
+    depth = torch.zeros(N, device=device)
+    image = torch.zeros(N, 3, device=device)
+    normal_map = torch.zeros(N, 3, device=device)
+    rays_alive = torch.zeros(2, N, dtype=torch.int32, device=device)
+    rays_t = torch.zeros(2, N, device=device)
+    alive_counter = torch.zeros([1], dtype=torch.int32, device=device)
+    o, d, grid = rays_o.to(device), rays_d.to(device), density_grid.to(device)
+    n, f = near.to(device), far.to(device)
+
+    n_alive, step, i = N, 0, 0
+    while step < 1024:
+        if step == 0:
+            torch.arange(N, out=rays_alive[0])
+            rays_t[0] = n
+        else:
+            alive_counter.zero_()
+            ops.compact_rays(n_alive, rays_alive[i % 2], rays_alive[(i + 1) % 2], rays_t[i % 2], rays_t[(i + 1) % 2], alive_counter)
+            n_alive = alive_counter.item()
+        if n_alive <= 0:
+            break
+        n_step = max(min(N // n_alive, 8), 1)
+        xyzs, dirs, deltas = ops.march_rays(n_alive, n_step, rays_alive[i % 2], rays_t[i % 2], o, d, bound, grid, mean_density, n, f, 128)
+        alpha = 0.2 * torch.ones(xyzs.shape[0], 1, device=device)
+        rgbs = (xyzs + 1) / 2
+        ops.composite_rays(n_alive, n_step, rays_alive[i % 2], rays_t[i % 2], alpha, rgbs, dirs, deltas, weights_sum, depth, image, normal_map)
+        step += n_step
+        i += 1
+    return weights_sum, depth, image
+
+weights_sum_inf, depth_inf, image_inf = render(raymarching_torch, 'cpu')
+print(f"=== inference === opaque rays {(weights_sum_inf > 0.99).sum().item()} / {N}")
+hit = torch.zeros(N, dtype=torch.bool)
+hit[rays[:, 0].long()] = rays[:, 2] > 0
+assert ((weights_sum_inf > 0) == hit).all()
+
+# 5. the CUDA kernels match the reference
+if torch.cuda.is_available():
+    grid_cuda = density_grid.cuda()
+    xyzs_cuda, dirs_cuda, deltas_cuda, rays_cuda = raymarching.march_rays_train(rays_o.cuda(), rays_d.cuda(), bound, grid_cuda, mean_density, 0, None, -1, False, 128, True)
+    rays_cuda = rays_cuda.cpu()
+    rays_ref = rays[rays[:, 0].argsort()]
+    rays_cuda = rays_cuda[rays_cuda[:, 0].argsort()]
+    assert (rays_cuda[:, 2] == rays_ref[:, 2]).all()
+    for (_, offset, num_steps), (_, offset_cuda, _) in zip(rays_ref.tolist(), rays_cuda.tolist()):
+        assert torch.allclose(xyzs_cuda[offset_cuda:offset_cuda + num_steps].cpu(), xyzs[offset:offset + num_steps], atol=1e-5)
+        assert torch.allclose(deltas_cuda[offset_cuda:offset_cuda + num_steps].cpu(), deltas[offset:offset + num_steps], atol=1e-6)
+
+    # the same samples in the point order of the kernel
+    to_cuda = torch.zeros(m, dtype=torch.long)
+    for (_, offset, num_steps), (_, offset_cuda, _) in zip(rays_ref.tolist(), rays_cuda.tolist()):
+        to_cuda[offset:offset + num_steps] = torch.arange(offset_cuda, offset_cuda + num_steps)
+    sigmas_cuda = torch.zeros(M).index_copy_(0, to_cuda, sigmas.detach().float()[:m]).cuda().requires_grad_(True)
+    rgbs_cuda = torch.zeros(M, 3).index_copy_(0, to_cuda, rgbs.detach().float()[:m]).cuda().requires_grad_(True)
+    weights_sum_cuda, image_cuda = raymarching.composite_rays_train(sigmas_cuda, rgbs_cuda, deltas_cuda, rays_cuda.cuda(), bound)
+    (image_cuda * grad_image.cuda()).sum().backward()
+
+    sigmas_ref = sigmas.detach().float().requires_grad_(True)
+    rgbs_ref = rgbs.detach().float().requires_grad_(True)
+    weights_sum_ref, image_ref = raymarching_torch.composite_rays_train(sigmas_ref, rgbs_ref, deltas, rays, bound)
+    (image_ref * grad_image).sum().backward()
+
+    print("max cuda composite error", (image_cuda.cpu() - image_ref).abs().max().item())
+    assert torch.allclose(image_cuda.detach().cpu(), image_ref.detach(), atol=1e-5)
+    assert torch.allclose(weights_sum_cuda.detach().cpu(), weights_sum_ref.detach(), atol=1e-5)
+    assert torch.allclose(rgbs_cuda.grad.cpu()[to_cuda], rgbs_ref.grad[:m], atol=1e-5)
+    assert torch.allclose(sigmas_cuda.grad.cpu()[to_cuda], sigmas_ref.grad[:m], atol=1e-4)
+
+    weights_sum_cuda, depth_cuda, image_cuda = render(raymarching, 'cuda')
+    print("max cuda inference error", (image_cuda.cpu() - image_inf).abs().max().item())
+    assert torch.allclose(image_cuda.cpu(), image_inf, atol=1e-4)
+    assert torch.allclose(depth_cuda.cpu(), depth_inf, atol=1e-4)
@@ -0,0 +1,35 @@
+# check that the cuda_ray inference loop gives the same result with fewer host syncs (--sync_every),
+# runs on CPU with the pytorch raymarching ops.
+import torch
+
+from nerf.network_sdf import NeRFNetwork
+
+bound = 1.0
+R = 32
+
+torch.manual_seed(0)
+model = NeRFNetwork(cuda_ray=True, grid_resolution=R)
+model.eval()
+
+# a sphere shell of radius 0.4
+xs = torch.linspace(-bound, bound, R + 1)
+pts = torch.stack(torch.meshgrid(xs, xs, xs, indexing='ij'), dim=-1)
+model.density_grid[0] = 100 * ((pts.norm(dim=-1) - 0.4).abs() < 0.15).float()
+model.mean_density = 5
+
+N = 256
+rays_o = torch.tensor([0., 0., 3.]).repeat(1, N, 1) + torch.randn(1, N, 3) * 0.3
+rays_d = torch.nn.functional.normalize(-rays_o + torch.randn(1, N, 3) * 0.8, dim=-1)
+
+results = {}
+with torch.no_grad():
+    for sync_every in [1, 4, 16]:
+        outputs = model.render(rays_o, rays_d, 64, bound, 64, staged=False, normal_epsilon_ratio=0.5, sync_every=sync_every)
+        results[sync_every] = outputs
+        print(f"sync_every = {sync_every}, background rays = {(outputs['rgb'] == 1).all(-1).sum().item()} / {N}")
+
+for sync_every in [4, 16]:
+    for key in ['rgb', 'depth', 'normal']:
+        error = (results[sync_every][key] - results[1][key]).abs().max().item()
+        print(f"sync_every = {sync_every}, max {key} error {error}")
+        assert error < 1e-5
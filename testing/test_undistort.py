@@ -0,0 +1,60 @@
+# check the undistortion fixed point against cv2.undistortPoints, and the direction cache of get_rays, runs on CPU.
+import cv2
+import numpy as np
+import torch
+
+from nerf.utils import undistort, get_rays, direction_cache, camera_key
+
+# 1. undistort == cv2.undistortPoints (k1, k2, p1, p2), from mild to strong distortion.
+# cv2.undistortPoints stops after 5 iterations, undistortPointsIter runs the same fixed point to convergence.
+H, W = 48, 64
+intrinsic = np.array([[50., 0., 31.5], [0., 52., 23.5], [0., 0., 1.]], dtype=np.float64)
+j, i = np.meshgrid(np.arange(H, dtype=np.float64), np.arange(W, dtype=np.float64), indexing='ij')
+pixels = np.stack([i.reshape(-1), j.reshape(-1)], axis=-1) # [H * W, 2]
+
+for distortion in [[0.01, 0.0, 0.0, 0.0], [-0.2, 0.05, 0.001, -0.002], [-0.35, 0.12, 0.003, 0.002], [0.25, 0.08, -0.004, 0.003]]:
+    distortion = np.array(distortion, dtype=np.float64)
+    criteria = (cv2.TERM_CRITERIA_COUNT | cv2.TERM_CRITERIA_EPS, 100, 1e-14)
+    if hasattr(cv2, 'undistortPointsIter'): # opencv 4
+        reference = cv2.undistortPointsIter(pixels[:, None, :], intrinsic, distortion, None, None, criteria)
+    else:
+        reference = cv2.undistortPoints(pixels[:, None, :], intrinsic, distortion, criteria=criteria)
+    reference = reference.reshape(-1, 2)
+
+    x = torch.from_numpy((pixels[:, 0] - intrinsic[0, 2]) / intrinsic[0, 0])
+    y = torch.from_numpy((pixels[:, 1] - intrinsic[1, 2]) / intrinsic[1, 1])
+    xu, yu = undistort(x, y, torch.from_numpy(distortion))
+    error = np.abs(np.stack([xu.numpy(), yu.numpy()], axis=-1) - reference).max()
+    error_5 = np.abs(cv2.undistortPoints(pixels[:, None, :], intrinsic, distortion).reshape(-1, 2) - reference).max()
+    print(f"distortion {distortion.tolist()}: max error {error:.2e} (cv2.undistortPoints {error_5:.2e})")
+    assert error < 1e-6
+
+# 2. get_rays with distortion: the sampled rays equal the full frame ones, the table is cached per camera key
+intrinsics = torch.from_numpy(intrinsic).float()[None].repeat(2, 1, 1)
+distortions = torch.tensor([[-0.2, 0.05, 0.001, -0.002], [0.1, 0.0, 0.0, 0.0]])
+poses = torch.eye(4)[None].repeat(2, 1, 1)
+cameras = [camera_key(intrinsics[b], H, W, distortions[b]) for b in range(2)]
+assert cameras[0] != cameras[1]
+
+direction_cache.clear()
+rays_o, rays_d, _ = get_rays(poses, intrinsics, H, W, -1, distortion=distortions, cameras=cameras)
+assert len(direction_cache.tables) == 2
+torch.manual_seed(0)
+rays_o_s, rays_d_s, inds = get_rays(poses, intrinsics, H, W, 256, distortion=distortions, cameras=cameras)
+assert len(direction_cache.tables) == 2
+assert torch.allclose(rays_d_s, torch.gather(rays_d, 1, inds[..., None].expand(-1, -1, 3)))
+
+# without keys the tables are computed, not cached
+rays_o_u, rays_d_u, _ = get_rays(poses, intrinsics, H, W, -1, distortion=distortions)
+assert len(direction_cache.tables) == 2 and torch.equal(rays_d_u, rays_d)
+
+# 3. reserve: one entry per distinct camera, no eviction while iterating them
+direction_cache.clear()
+direction_cache.reserve(12)
+keys = [camera_key(intrinsic * (1 + 0.01 * k), H, W) for k in range(12)]
+for epoch in range(2):
+    for k in range(12):
+        intrinsic_k = torch.from_numpy(intrinsic * (1 + 0.01 * k)).float()
+        get_rays(torch.eye(4)[None], intrinsic_k[None], H, W, -1, cameras=[keys[k]])
+assert len(direction_cache.tables) == 12
+print("direction cache ok")
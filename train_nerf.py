@@ -1,6 +1,6 @@
 import torch
 
-from nerf.provider import NeRFDataset, RayDataset
+from nerf.provider import NeRFDataset, RayDataset, GlobalRaySampler, SequenceDataset
 from nerf.utils import *
 
 import argparse
@@ -20,6 +20,12 @@ if __name__ == '__main__':
     parser.add_argument('--downscale', type=int, default=1)
     parser.add_argument('--upsample_steps', type=int, default=64)
     parser.add_argument('--max_ray_batch', type=int, default=4096)
+    parser.add_argument('--memory_fraction', type=float, default=0.8, help="size staged (full-frame) rendering chunks to this fraction of the free GPU memory, 0 to use fixed max_ray_batch chunks")
+    parser.add_argument('--sync_every', type=int, default=1, help="cuda_ray inference, read the alive ray count back to the host every this many compactions (larger = fewer syncs, more idle threads)")
+    parser.add_argument('--exact_march', action='store_true', help="cuda_ray training, count the sample points of each batch before marching (one extra march) instead of the running mean, no rays are dropped")
+    parser.add_argument('--buffer_pool_mb', type=int, default=0, help="cuda_ray, bound the memory of the pooled run_cuda buffers (MB), the least recently used ones are released past it, 0 for no bound (the pool holds one buffer per name)")
+    parser.add_argument('--min_transmittance', type=float, default=0, help="pytorch sdf inference, stop the rays whose transmittance falls below this (e.g. 1e-3), 0 to shade all samples")
+    parser.add_argument('--segment_steps', type=int, default=16, help="samples shaded per ray between two early termination checks (--min_transmittance)")
     
     #Network Settings
     parser.add_argument('--network', type=str, default='sdf', help="network format, supports ( \
@@ -31,10 +37,25 @@ if __name__ == '__main__':
                                                                     ff: use fully-fused MLP for sdf representation)")
     
     parser.add_argument('--curvature_loss', '--C', action='store_true', help="use curvature loss term, slower but make surface smoother")
+    parser.add_argument('--skip_empty', action='store_true', help="skip empty density grid cells in the pytorch sdf renderer (no effect with --cuda_ray)")
+    parser.add_argument('--grid_resolution', type=int, default=128, help="density grid resolution of the sdf renderer (cuda_ray and --skip_empty)")
+    parser.add_argument('--grid_cascades', type=int, default=1, help="density grid cascades, cascade c covers [-bound, bound] / 2^(C - 1 - c) (for large bounds, --skip_empty without --cuda_ray only)")
+    parser.add_argument('--update_extra_interval', type=int, default=16, help="update the density grid every this many training steps (cuda_ray and --skip_empty)")
+    parser.add_argument('--fd_stencil', type=str, default='central', help="finite difference stencil for sdf normals, supports (central: 6 points, tetrahedron: 4 points)")
 
     #Dataset Settings
     parser.add_argument('--format', type=str, default='colmap', help="dataset format, supports (colmap, blender)")
     parser.add_argument('--bound', type=float, default=1, help="assume the scene is bounded in box(-size, size)")
+    parser.add_argument('--num_workers', type=int, default=None, help="threads used to decode images, default to all cores")
+    parser.add_argument('--compact_images', action='store_true', help="keep training images as uint8 and dequantize sampled rays on the fly, 4x less memory")
+    parser.add_argument('--global_sampler', action='store_true', help="sample each ray batch across all training views instead of one image per step")
+    parser.add_argument('--stream_rays', action='store_true', help="train from the streaming RayDataset (rays generated per chunk), an epoch then covers every ray once")
+    parser.add_argument('--sample_mode', type=str, default='uniform', help="ray sampling in each image, supports (uniform, mask: alpha channel prior, error: alpha prior + per-pixel error map), mask/error not with --global_sampler or --stream_rays")
+    parser.add_argument('--prefetch', type=int, default=0, help="number of training batches prepared ahead on a background thread (CUDA side stream), 0 to disable")
+    parser.add_argument('--cache_dir', type=str, default=None, help="cache decoded images in this directory, later runs memory-map them")
+    parser.add_argument('--sequence', action='store_true', help="path is a 4D sequence (shared transforms.json, one image directory per timestep), train the timesteps in order")
+    parser.add_argument('--max_frames', type=int, default=2, help="number of timesteps kept in memory in sequence mode")
+    parser.add_argument('--warm_epochs', type=int, default=None, help="epochs of each warm-started timestep in sequence mode, default to the same as the first one")
 
     #Others
     parser.add_argument('--cuda_ray', action='store_true', help="use CUDA raymarching instead of pytorch (unstable now)")
@@ -43,6 +64,9 @@ if __name__ == '__main__':
 
     print(opt)
 
+    assert not (opt.cuda_ray and opt.grid_cascades > 1), "--grid_cascades > 1 is only supported by the pytorch renderer (--skip_empty), not with --cuda_ray"
+    assert opt.sample_mode == 'uniform' or not (opt.global_sampler or opt.stream_rays), "--sample_mode mask/error only applies to per-image sampling, not with --global_sampler or --stream_rays"
+
     if opt.network =='ff':
         assert opt.fp16, "fully-fused mode must be used with fp16 mode"
         from nerf.network_ff import NeRFNetwork
@@ -59,20 +83,26 @@ if __name__ == '__main__':
 
     seed_everything(opt.seed)
 
+    # options of the sdf networks only
+    sdf_kwargs = {'fd_stencil': opt.fd_stencil, 'skip_empty': opt.skip_empty, 'grid_resolution': opt.grid_resolution, 'grid_cascades': opt.grid_cascades} if opt.network in ['tcnn', 'enc', 'sdf', 'phasor'] else {}
+
     #network wwith encoding
     if opt.network =='phasor':
         model = NeRFNetwork(
             encoding="phasor", encoding_dir="sphere_harmonics", 
             num_layers=2, hidden_dim=64, geo_feat_dim=15, num_layers_color=3, hidden_dim_color=64, 
-            cuda_ray=opt.cuda_ray, curvature_loss = opt.curvature_loss
+            cuda_ray=opt.cuda_ray, curvature_loss = opt.curvature_loss, **sdf_kwargs
         )
     else:
         model = NeRFNetwork(
             encoding="hashgrid", encoding_dir="sphere_harmonics", 
             num_layers=2, hidden_dim=64, geo_feat_dim=15, num_layers_color=3, hidden_dim_color=64, 
-            cuda_ray=opt.cuda_ray, curvature_loss = opt.curvature_loss
+            cuda_ray=opt.cuda_ray, curvature_loss = opt.curvature_loss, **sdf_kwargs
         )
         
+    if opt.buffer_pool_mb > 0 and hasattr(model, 'buffer_pool'):
+        model.buffer_pool.max_bytes = opt.buffer_pool_mb * 2 ** 20
+        
     #optimizer
     if opt.network in ['tcnn', 'enc', 'sdf', 'phasor']:
         optimizer = lambda model: torch.optim.Adam([
@@ -92,39 +122,90 @@ if __name__ == '__main__':
     #criterion = torch.nn.SmoothL1Loss()
     criterion = torch.nn.HuberLoss()
 
-    trainer = Trainer('ngp', 
-                vars(opt), 
-                model, 
-                workspace=opt.workspace, 
-                optimizer=optimizer, 
-                criterion=criterion, 
-                ema_decay=0.95, 
-                fp16=(opt.network=='fp16'), 
-                lr_scheduler=scheduler, 
-                scheduler_update_every_step=True, 
-                use_checkpoint='latest', 
-                eval_interval=5,
-                )
-
-    if opt.mode == 'train':
-        train_dataset = NeRFDataset(opt.path, type='train', mode=opt.format, bound=opt.bound)
-        valid_dataset = NeRFDataset(opt.path, type='valid', mode=opt.format, downscale=opt.downscale, bound=opt.bound)
-
-        train_loader = torch.utils.data.DataLoader(train_dataset, batch_size=1, shuffle=True)
+    def make_trainer(workspace):
+        return Trainer('ngp', 
+                    vars(opt), 
+                    model, 
+                    workspace=workspace, 
+                    optimizer=optimizer, 
+                    criterion=criterion, 
+                    ema_decay=0.95, 
+                    fp16=(opt.network=='fp16'), 
+                    lr_scheduler=scheduler, 
+                    scheduler_update_every_step=True, 
+                    use_checkpoint='latest', 
+                    eval_interval=5,
+                    )
+
+    if opt.mode == 'train' and opt.sequence:
+        assert not opt.stream_rays, "--stream_rays is not supported with --sequence"
+        # one workspace per timestep, each timestep starts from the previous one's weights.
+        sequence = SequenceDataset(opt.path, mode=opt.format, max_frames=opt.max_frames, bound=opt.bound, cache_dir=opt.cache_dir, num_workers=opt.num_workers)
+        prev_ckpt_path = None
+        trained = False
+        for t, timestep in enumerate(sequence.timesteps):
+            trainer = make_trainer(os.path.join(opt.workspace, timestep))
+            max_epochs = 200 if t == 0 or opt.warm_epochs is None else opt.warm_epochs
+            if trainer.latest_checkpoint() is not None and trainer.epoch >= max_epochs:
+                # resumed run: this timestep is already complete.
+                trainer.log(f"[INFO] Timestep {timestep} already trained for {trainer.epoch} epochs, skipping")
+                prev_ckpt_path = trainer.ckpt_path
+                trained = False
+                continue
+
+            if trainer.epoch == 1 and prev_ckpt_path is not None and not trained:
+                # resumed run: the previous timestep isn't in memory, load its weights.
+                checkpoint = trainer.latest_checkpoint(prev_ckpt_path)
+                if checkpoint is not None:
+                    trainer.log(f"[INFO] Warm-starting from {checkpoint}")
+                    trainer.load_checkpoint(checkpoint, model_only=True)
+
+            train_dataset = sequence.get(t, type='train', compact=opt.compact_images, sample_mode=opt.sample_mode)
+            valid_dataset = sequence.get(t, type='valid', downscale=opt.downscale)
+
+            if opt.global_sampler:
+                train_loader = GlobalRaySampler(train_dataset, num_rays=opt.num_rays, seed=opt.seed)
+            else:
+                train_loader = torch.utils.data.DataLoader(train_dataset, batch_size=1, shuffle=True)
+            valid_loader = torch.utils.data.DataLoader(valid_dataset, batch_size=1)
+
+            trainer.train(train_loader, valid_loader, max_epochs)
+            if trainer.epoch % 50 != 0:
+                # make sure the last epoch is on disk for warm-starting the next timestep.
+                trainer.save_checkpoint(full=True, best=False)
+
+            prev_ckpt_path = trainer.ckpt_path
+            trained = True
+
+    elif opt.mode == 'train':
+        trainer = make_trainer(opt.workspace)
+        if opt.stream_rays:
+            train_dataset = RayDataset(opt.path, type='train', mode=opt.format, bound=opt.bound, chunk_size=opt.num_rays, cache_dir=opt.cache_dir, num_workers=opt.num_workers, seed=opt.seed)
+        else:
+            train_dataset = NeRFDataset(opt.path, type='train', mode=opt.format, bound=opt.bound, cache_dir=opt.cache_dir, num_workers=opt.num_workers, compact=opt.compact_images, sample_mode=opt.sample_mode)
+        valid_dataset = NeRFDataset(opt.path, type='valid', mode=opt.format, downscale=opt.downscale, bound=opt.bound, cache_dir=opt.cache_dir, num_workers=opt.num_workers)
+
+        if opt.global_sampler and not opt.stream_rays:
+            train_loader = GlobalRaySampler(train_dataset, num_rays=opt.num_rays, seed=opt.seed)
+        else:
+            train_loader = torch.utils.data.DataLoader(train_dataset, batch_size=1, shuffle=True)
         valid_loader = torch.utils.data.DataLoader(valid_dataset, batch_size=1)
 
         trainer.train(train_loader, valid_loader, 200)
 
     elif opt.mode == 'mesh':
+        trainer = make_trainer(opt.workspace)
         valid_dataset = NeRFDataset(opt.path, type='valid', mode=opt.format, downscale=opt.downscale, bound=opt.bound)
         trainer.save_mesh(aabb = valid_dataset.aabb, resolution= 512, threshold=0.0, use_sdf=(opt.network=='sdf'))
 
     elif opt.mode == 'render':
+        trainer = make_trainer(opt.workspace)
         test_dataset = NeRFDataset(opt.path, type='test', mode=opt.format, downscale=opt.downscale, bound=opt.bound)
         test_loader = torch.utils.data.DataLoader(test_dataset, batch_size=1)
         trainer.test(test_loader)
 
     elif opt.mode == 'fvv':
+        trainer = make_trainer(opt.workspace)
         test_dataset = NeRFDataset(opt.path, type='fvv', mode='blender', downscale=opt.downscale, bound=opt.bound)
         test_loader = torch.utils.data.DataLoader(test_dataset, batch_size=1)
         trainer.test(test_loader)